@@ -0,0 +1,343 @@
+"""Throughput benchmark for the SecureWallet client.
+
+Runs the real client hot path (ESP32Device, command.py, connServer's server
+session) against a simulated wallet (simDevice.VirtualESP32) and a stand-in
+for the backend server, then reports commands/sec and latency percentiles.
+
+    python benchmark.py --commands 2000 --latency 0.005 --window 8
+    python benchmark.py --framed --async-link --window 32 --json
+    python benchmark.py --workload recorded_commands.txt
+    python benchmark.py --binary --window 16
+    python benchmark.py --workers --window 8
+    python benchmark.py --cold-start --budget 0.5
+
+A workload file holds one server command per line (e.g. "signreqmsg abcd");
+"{n}" in a line is replaced by the command's sequence number. The workload is
+replayed in order, wrapping around until --commands have been sent. A traffic
+trace captured by diagnostics.py works as a workload too: its server commands
+are replayed, with each masked argument replaced by one of the same length.
+
+--binary has the stand-in server ask for the binary server-link protocol
+(binproto.py) after the handshake, as a backend that supports it would.
+
+--workers serves the simulated wallet from a worker process (workers.py), as
+connServer's worker_processes setting does.
+
+--cold-start instead times "import connServer" in fresh interpreters, as a
+headless service restart pays it, lists the slowest imports and exits non-zero
+when the median is over --budget seconds.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import binproto
+import diagnostics
+from framing import SocketFrameReader
+from simDevice import VirtualESP32
+
+DEFAULT_WORKLOAD = [
+    "signreqmsg benchmark-message-{n}",
+    "signauthmsg benchmark-message-{n}",
+    "getreqaddr",
+    "signreqmsg benchmark-message-{n}",
+    "getauthaddr",
+]
+PASSWORD = "benchmark"
+# Seconds a headless "import connServer" may take before --cold-start fails
+COLD_START_BUDGET = 0.5
+
+
+class FakeServer:
+    """Stands in for the backend: validates the wallet's addresses, then drives command load.
+
+    Commands are tagged "#<n>" so replies can be paired with their send time
+    whatever order they come back in; at most window commands are outstanding.
+    """
+
+    def __init__(self, host, port, workload, commands, window, binary=False):
+        self.workload = workload
+        self.commands = commands
+        self.window = window
+        self.binary = binary
+        self.latencies = []
+        self.errors = 0
+        self.handshake = None
+        self.elapsed = None
+        self.done = threading.Event()
+        self._listener = socket.create_server((host, port))
+        self.address = self._listener.getsockname()[:2]
+
+    def start(self):
+        threading.Thread(target=self._serve, name="FakeServer", daemon=True).start()
+        return self
+
+    def _serve(self):
+        conn, _ = self._listener.accept()
+        self._listener.close()
+        reader = SocketFrameReader(conn)
+        self.handshake = reader.read_line()
+        conn.sendall(b"VALIDATED\n")
+        if self.binary:
+            conn.sendall(b"proto binary\n")
+            if reader.read_line() != "OK":
+                raise RuntimeError("client refused the binary protocol")
+            reader.parser.length_prefixed = True
+
+        slots = threading.Semaphore(self.window)
+        sent_at = {}
+        receiver = threading.Thread(target=self._receive, args=(reader, sent_at, slots), daemon=True)
+        start = time.perf_counter()
+        receiver.start()
+        for n in range(self.commands):
+            slots.acquire()
+            command = self.workload[n % len(self.workload)].replace("{n}", str(n))
+            sent_at[n] = time.perf_counter()
+            conn.sendall(self._encode(n, command))
+        receiver.join()
+        self.elapsed = time.perf_counter() - start
+        conn.close()
+        self.done.set()
+
+    def _encode(self, n, command):
+        if not self.binary:
+            return f"#{n} {command}\n".encode('utf-8')
+        name, _, data = command.partition(" ")
+        if name in binproto.BATCH_COMMANDS and data:
+            data = json.loads(data)
+        # Request id 0 means untagged, so number binary requests from 1
+        return binproto.encode_request(name, data or None, request_id=n + 1)
+
+    def _decode(self, reader):
+        """Read one reply as (n, failed); None when the connection closed."""
+        if not self.binary:
+            line = reader.read_line()
+            if line is None:
+                return None
+            tag, _, result = line.partition(" ")
+            return int(tag[1:]), result.startswith("ERROR") or result == "None"
+        frame = reader.read_frame()
+        if frame is None:
+            return None
+        request_id, status, _, _ = binproto.decode_reply(frame)
+        return request_id - 1, status != binproto.STATUS_OK
+
+    def _receive(self, reader, sent_at, slots):
+        for _ in range(self.commands):
+            reply = self._decode(reader)
+            if reply is None:
+                break
+            n, failed = reply
+            self.latencies.append(time.perf_counter() - sent_at.pop(n))
+            if failed:
+                self.errors += 1
+            slots.release()
+
+
+def run_client(server_address, device_port, framed, async_link, workers=False):
+    """Connect the real client code to the simulated wallet and server."""
+    import connServer
+    from command import GetAuthAddr, GetReqAddr, authenticate_device
+    from util import ConnectSocketServer
+
+    connServer.ASYNC_SERVER_LINK = async_link
+    connServer.WORKER_PROCESSES = workers
+    device = connServer.open_device(device_port)
+    if framed:
+        device.negotiate_framing()
+    if not authenticate_device(device, PASSWORD):
+        raise RuntimeError("simulated wallet rejected the benchmark password")
+    requestPubAddr = GetReqAddr(device)
+    authpubAddr = GetAuthAddr(device)
+    client_socket = ConnectSocketServer(remote_server="%s:%d" % server_address)
+    session = threading.Thread(
+        target=connServer.run_server_session,
+        args=(client_socket, device, requestPubAddr, authpubAddr),
+        name="ClientSession",
+        daemon=True,
+    )
+    session.start()
+    return device, session
+
+
+def measure_cold_start(runs, module="connServer"):
+    """Time importing module in fresh interpreters; returns (seconds per run, slowest imports)."""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=repo, SECUREWALLET_PASSWORD_SOURCE="stdin")
+    timings = []
+    # Run from a scratch directory so the imports' log files do not land in the checkout
+    with tempfile.TemporaryDirectory() as scratch:
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", f"import {module}"], cwd=scratch, env=env,
+                           capture_output=True, check=True)
+            timings.append(time.perf_counter() - start)
+
+        # -X importtime lines: "import time: self | cumulative | package"
+        trace = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                               cwd=scratch, env=env, capture_output=True, text=True, check=True).stderr
+    imports = []
+    for line in trace.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]) / 1e6, fields[2].strip()))
+    return timings, sorted(imports, reverse=True)[:10]
+
+
+def run_cold_start(args):
+    timings, slowest = measure_cold_start(args.runs)
+    median = statistics.median(timings)
+    summary = {
+        "runs": args.runs,
+        "median_s": round(median, 3),
+        "max_s": round(max(timings), 3),
+        "budget_s": args.budget,
+        "slowest_imports": [{"module": name, "cumulative_s": round(seconds, 3)} for seconds, name in slowest],
+    }
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        print(f"cold start: median {summary['median_s']} s  max {summary['max_s']} s  "
+              f"budget {args.budget} s over {args.runs} runs")
+        for seconds, name in slowest:
+            print(f"  {seconds * 1000:8.1f} ms  {name}")
+    if median > args.budget:
+        raise SystemExit(f"Cold start {median:.3f} s is over the {args.budget} s budget.")
+    return summary
+
+
+def percentile(ordered, q):
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(server, args):
+    ordered = sorted(server.latencies)
+    completed = len(ordered)
+    summary = {
+        "commands": args.commands,
+        "completed": completed,
+        "errors": server.errors,
+        "elapsed_s": round(server.elapsed, 3),
+        "throughput_cmd_s": round(completed / server.elapsed, 1) if server.elapsed else 0.0,
+        "device_latency_ms": args.latency * 1000,
+        "window": args.window,
+        "framed": args.framed,
+        "async_link": args.async_link,
+        "binary": args.binary,
+        "workers": args.workers,
+    }
+    if ordered:
+        summary.update({
+            f"p{int(q * 100)}_ms": round(percentile(ordered, q) * 1000, 2) for q in (0.5, 0.95, 0.99)
+        })
+        summary["max_ms"] = round(ordered[-1] * 1000, 2)
+    return summary
+
+
+def workload_from_trace(path):
+    """The server commands of a traffic trace as workload lines, tags and deadlines dropped."""
+    lines = []
+    for _, kind, binary, payload in diagnostics.read_trace(path):
+        if kind != diagnostics.SERVER_RX:
+            continue
+        if binary:
+            try:
+                _, _, command, data = binproto.decode_request(payload)
+                if isinstance(data, bytes):
+                    data = json.dumps(binproto.decode_batch(data))
+            except binproto.ProtocolError:
+                # The client rejected it too; nothing to replay
+                continue
+            line = f"{command} {data}" if data else command
+        else:
+            _, line = diagnostics.LINE_PREFIX.match(payload.decode('utf-8', errors="replace").strip()).groups()
+        if not line or line.startswith("proto "):
+            continue
+        # Keep each masked argument's length but make it unique per command
+        lines.append(re.sub(r"\*+", lambda match: "{n}".ljust(len(match.group()), "x"), line))
+    return lines
+
+
+def load_workload(path):
+    if not path:
+        return DEFAULT_WORKLOAD
+    with open(path, "rb") as workload_file:
+        is_trace = workload_file.read(len(diagnostics.TRACE_MAGIC)) == diagnostics.TRACE_MAGIC
+    if is_trace:
+        lines = workload_from_trace(path)
+        if not lines:
+            raise SystemExit(f"Trace {path} has no server commands.")
+        return lines
+    with open(path, encoding="utf-8") as workload_file:
+        lines = [line.strip() for line in workload_file if line.strip() and not line.startswith("#")]
+    if not lines:
+        raise SystemExit(f"Workload file {path} has no commands.")
+    return lines
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the SecureWallet client against a simulated wallet and server.")
+    parser.add_argument("--commands", type=int, default=1000, help="commands to send (default: 1000)")
+    parser.add_argument("--window", type=int, default=1, help="commands the server keeps outstanding (default: 1)")
+    parser.add_argument("--latency", type=float, default=0.005, help="simulated device time per command, seconds")
+    parser.add_argument("--sign-latency", type=float, default=None, help="simulated device time per SIGN_MSG_*, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra device time per command, seconds")
+    parser.add_argument("--baud", type=int, default=None, help="pace simulated replies at this serial line rate")
+    parser.add_argument("--framed", action="store_true", help="negotiate the framed device protocol")
+    parser.add_argument("--async-link", action="store_true", help="use the asyncio server link")
+    parser.add_argument("--binary", action="store_true", help="switch the server link to the binary protocol")
+    parser.add_argument("--workers", action="store_true", help="serve the wallet from a worker process")
+    parser.add_argument("--workload", help="file with one server command per line to replay")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=10080, help="fake server port; 0 picks a free one")
+    parser.add_argument("--log-level", default="WARNING", help="client log level during the run (default: WARNING)")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    parser.add_argument("--cold-start", action="store_true", help="time a headless 'import connServer' instead")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters for --cold-start (default: 5)")
+    parser.add_argument("--budget", type=float, default=COLD_START_BUDGET,
+                        help=f"--cold-start budget in seconds (default: {COLD_START_BUDGET})")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.cold_start:
+        return run_cold_start(args)
+    logging.getLogger("SecureWalletLogger").setLevel(args.log_level.upper())
+
+    wallet = VirtualESP32(password=PASSWORD, latency=args.latency, sign_latency=args.sign_latency,
+                          jitter=args.jitter, baud=args.baud, banner=False).start()
+    server = FakeServer(args.host, args.port, load_workload(args.workload), args.commands, args.window,
+                        args.binary).start()
+    device, session = run_client(server.address, wallet.port, args.framed, args.async_link, args.workers)
+    # Make the client's own logger setup respect the requested level too
+    logging.getLogger("SecureWalletLogger").setLevel(args.log_level.upper())
+
+    server.done.wait()
+    session.join(timeout=5)
+    device.close()
+    wallet.stop()
+
+    summary = summarize(server, args)
+    if args.json:
+        print(json.dumps(summary))
+        return summary
+    print(f"commands: {summary['completed']}/{summary['commands']}  errors: {summary['errors']}  "
+          f"elapsed: {summary['elapsed_s']} s  throughput: {summary['throughput_cmd_s']} cmd/s")
+    if "p50_ms" in summary:
+        print(f"latency ms: p50 {summary['p50_ms']}  p95 {summary['p95_ms']}  "
+              f"p99 {summary['p99_ms']}  max {summary['max_ms']}")
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Binary framing for the server link, negotiated with "proto binary".
+
+Every message is a length-prefixed frame (framing.encode_frame with
+length_prefixed=True) holding a fixed header and a raw payload:
+
+    request:  opcode (u8) | request id (u32) | deadline ms (u32) | payload
+    reply:    status (u8) | request id (u32) | payload
+
+A request id of 0 means untagged and a deadline of 0 means none, as when the
+text protocol omits "#<id>" and "@<ms>". Replies that are hex on the wallet's
+serial line (signatures, addresses) travel as raw bytes, flagged in the status
+byte so the original text can be rebuilt exactly. Batch payloads are a
+sequence of items, each a u32 length and the bytes; batch replies are a
+sequence of status (u8) | u32 length | bytes items.
+"""
+import struct
+from framing import encode_frame
+
+OPCODES = {
+    0x01: "logout",
+    0x02: "getreqnft",
+    0x03: "getauthnft",
+    0x04: "setauthnft",
+    0x05: "setreqnft",
+    0x06: "signauthmsg",
+    0x07: "signreqmsg",
+    0x08: "signauthmsg_batch",
+    0x09: "signreqmsg_batch",
+    0x0A: "removereqnft",
+    0x0B: "removeauthnft",
+    0x0C: "getauthaddr",
+    0x0D: "getreqaddr",
+    0x0E: "cachestats",
+    0x0F: "stats",
+}
+COMMAND_OPCODES = {command: opcode for opcode, command in OPCODES.items()}
+# Commands whose payload stays bytes (a batch) rather than being decoded to text
+BATCH_COMMANDS = ("signauthmsg_batch", "signreqmsg_batch")
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_TIMEOUT = 2
+STATUS_BUSY = 3
+STATUS_EXPIRED = 4
+STATUS_INVALID = 5
+# Status byte flags: the payload is the hex text decoded to bytes, and that text began with "0x"
+FLAG_HEX = 0x80
+FLAG_0X = 0x40
+STATUS_MASK = 0x3F
+
+REQUEST_HEADER = struct.Struct(">BII")
+REPLY_HEADER = struct.Struct(">BI")
+ITEM_LENGTH = struct.Struct(">I")
+ITEM_HEADER = struct.Struct(">BI")
+
+# Text replies from run_command() and the status each maps to; anything else starting "ERROR" is STATUS_ERROR
+ERROR_STATUSES = (
+    ("ERROR: Busy", STATUS_BUSY),
+    ("ERROR: Timeout", STATUS_TIMEOUT),
+    ("ERROR: Expired", STATUS_EXPIRED),
+    ("ERROR: Invalid command", STATUS_INVALID),
+)
+
+
+class ProtocolError(Exception):
+    """Raised for a binary frame that cannot be decoded."""
+
+    def __init__(self, message, tag=None):
+        super().__init__(message)
+        # Tag of the request, when the header could be read, so the error can be answered
+        self.tag = tag
+
+
+def decode_request(frame):
+    """Decode a request frame into (tag, deadline_ms, command, data), as connServer.parse_message does.
+
+    data is None when the payload is empty, bytes for batch commands and text otherwise.
+    """
+    if len(frame) < REQUEST_HEADER.size:
+        raise ProtocolError(f"Request frame of {len(frame)} bytes is shorter than its header")
+    opcode, request_id, deadline_ms = REQUEST_HEADER.unpack_from(frame)
+    tag = f"#{request_id}" if request_id else None
+    command = OPCODES.get(opcode, f"opcode-0x{opcode:02x}")
+    payload = frame[REQUEST_HEADER.size:]
+    data = None
+    if payload:
+        if command in BATCH_COMMANDS:
+            data = bytes(payload)
+        elif b"\n" in payload or b"\r" in payload:
+            # The wallet's serial protocol is line based; a newline would smuggle in a second command
+            raise ProtocolError("Payload contains a line break", tag)
+        else:
+            data = payload.decode('utf-8', errors="replace")
+    return tag, (deadline_ms or None), command, data
+
+
+def encode_reply(tag, result):
+    """Frame a run_command() result (text, or already-encoded batch bytes) as a binary reply."""
+    request_id = int(tag[1:]) if tag and tag[1:].isdigit() else 0
+    if isinstance(result, bytes):
+        status, payload = STATUS_OK, result
+    else:
+        status, payload = _encode_result(result)
+    return encode_frame(REPLY_HEADER.pack(status, request_id) + payload, length_prefixed=True)
+
+
+def _encode_result(result):
+    if result is None or result == "None":
+        return STATUS_ERROR, b""
+    if result.startswith("ERROR"):
+        for prefix, status in ERROR_STATUSES:
+            if result.startswith(prefix):
+                return status, result.encode('utf-8')
+        return STATUS_ERROR, result.encode('utf-8')
+    flags = 0
+    text = result
+    if text.startswith("0x"):
+        flags, text = FLAG_0X, text[2:]
+    # Only lowercase hex round-trips exactly through bytes.hex()
+    if text and len(text) % 2 == 0 and " " not in text and text == text.lower():
+        try:
+            return STATUS_OK | FLAG_HEX | flags, bytes.fromhex(text)
+        except ValueError:
+            pass
+    return STATUS_OK, result.encode('utf-8')
+
+
+def decode_batch(payload):
+    """Split a batch payload into its message strings."""
+    messages = []
+    offset = 0
+    with memoryview(payload) as view:
+        while offset < len(view):
+            if offset + ITEM_LENGTH.size > len(view):
+                raise ProtocolError("Truncated batch item header")
+            (length,) = ITEM_LENGTH.unpack_from(view, offset)
+            offset += ITEM_LENGTH.size
+            if offset + length > len(view):
+                raise ProtocolError("Truncated batch item")
+            message = str(view[offset:offset + length], 'utf-8', errors="replace")
+            if "\n" in message or "\r" in message:
+                raise ProtocolError("Batch message contains a line break")
+            messages.append(message)
+            offset += length
+    return messages
+
+
+def encode_batch(results):
+    """Encode per-message batch results (None marks a failure) as batch reply items."""
+    parts = []
+    for result in results:
+        if result is None:
+            status, payload = STATUS_ERROR, b"No response from device"
+        else:
+            status, payload = _encode_result(result)
+        parts.append(ITEM_HEADER.pack(status, len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+# ----- Server side: building requests and reading replies -----
+
+def encode_request(command, data=None, request_id=0, deadline_ms=0):
+    """Frame a request for command; data may be text, bytes or, for batches, a list of strings."""
+    if command not in COMMAND_OPCODES:
+        raise ProtocolError(f"No opcode for command '{command}'")
+    if isinstance(data, list):
+        payload = b"".join(ITEM_LENGTH.pack(len(item)) + item for item in (m.encode('utf-8') for m in data))
+    elif isinstance(data, str):
+        payload = data.encode('utf-8')
+    else:
+        payload = data or b""
+    header = REQUEST_HEADER.pack(COMMAND_OPCODES[command], request_id, deadline_ms)
+    return encode_frame(header + payload, length_prefixed=True)
+
+
+def decode_reply(frame):
+    """Decode a reply frame into (request_id, status, payload bytes, flags)."""
+    if len(frame) < REPLY_HEADER.size:
+        raise ProtocolError(f"Reply frame of {len(frame)} bytes is shorter than its header")
+    status, request_id = REPLY_HEADER.unpack_from(frame)
+    return request_id, status & STATUS_MASK, frame[REPLY_HEADER.size:], status & ~STATUS_MASK
+
+
+def reply_text(payload, flags):
+    """Rebuild the text the wallet sent from a reply payload and its flags."""
+    if flags & FLAG_HEX:
+        return ("0x" if flags & FLAG_0X else "") + payload.hex()
+    return payload.decode('utf-8', errors="replace")
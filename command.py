@@ -1,209 +1,1003 @@
-import sys
 import threading
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import hashlib
+import itertools
+import re
 import serial
 import serial.tools.list_ports
 import time
+import weakref
+import zlib
+import diagnostics
 from logger import setup_logger  # Import the setup_logger function
+from metrics import METRICS
 
 # Initialize the logger
 logger = setup_logger(log_file="logs/securewalletOpr.log", log_level="DEBUG")
 
+# Serial settings; config.py can override any of them per host
 BAUD_RATE = 115200
+# Faster rate to switch to once the wallet has authenticated, if the firmware accepts "BAUD <rate>"; None stays at BAUD_RATE
+TARGET_BAUD_RATE = None
 READ_TIMEOUT = 1
+# Silence that ends a serial read once bytes have started arriving; None waits for READ_TIMEOUT
+INTER_BYTE_TIMEOUT = None
+# Ask the USB-serial driver to push received bytes immediately (Linux ASYNC_LOW_LATENCY)
+LOW_LATENCY = False
+# Driver buffer sizes in bytes, applied only where pyserial supports it (Windows)
+RX_BUFFER_SIZE = None
+TX_BUFFER_SIZE = None
+COMMAND_TIMEOUT = 5
+# Seconds each device command may take; commands not listed get COMMAND_TIMEOUT
+COMMAND_TIMEOUTS = {
+    "GET_STATUS": 1,
+    "PING": 1,
+    "GET_ADDR_REQ": 1,
+    "GET_ADDR_AUTH": 1,
+    "GET_NFT_REQ": 2,
+    "GET_NFT_AUTH": 2,
+    "LOGOUT": 2,
+    "PASS": 3,
+    "REMOVE_NFT_REQ": 3,
+    "REMOVE_NFT_AUTH": 3,
+    "SIGN_MSG_REQ": 5,
+    "SIGN_MSG_AUTH": 5,
+    "SET_NFT_REQ": 5,
+    "SET_NFT_AUTH": 5,
+}
+# After a line-mode timeout, how long the next command waits for the late reply before
+# assuming it was lost; without this the late reply would be taken as the next answer
+STALE_REPLY_GRACE = 2
+MAX_UNSOLICITED_LINES = 100
+# Commands a framed-mode device may have in flight at once through AsyncESP32Device
+FRAMED_CONCURRENCY = 4
+# Commands a batch keeps outstanding on the wallet, so its UART buffer never overflows
+PIPELINE_WINDOW = 8
+
+# Replies in framed mode look like "#<seq> <payload>"
+FRAME_PATTERN = re.compile(r"^#(\d+) ?(.*)$")
+
+# Reads that only change when the wallet's NFTs change or it re-authenticates
+CACHEABLE_COMMANDS = ("GET_ADDR_REQ", "GET_ADDR_AUTH", "GET_NFT_REQ", "GET_NFT_AUTH")
+# Signing commands whose results the signature cache may keep (see SIGN_CACHE_ENABLED)
+SIGN_CACHE_COMMANDS = ("SIGN_MSG_REQ", "SIGN_MSG_AUTH")
+# Cached reads and signatures made stale by each state-changing command
+CACHE_INVALIDATIONS = {
+    "SET_NFT_REQ": ("GET_NFT_REQ", "GET_ADDR_REQ", "SIGN_MSG_REQ"),
+    "REMOVE_NFT_REQ": ("GET_NFT_REQ", "GET_ADDR_REQ", "SIGN_MSG_REQ"),
+    "SET_NFT_AUTH": ("GET_NFT_AUTH", "GET_ADDR_AUTH", "SIGN_MSG_AUTH"),
+    "REMOVE_NFT_AUTH": ("GET_NFT_AUTH", "GET_ADDR_AUTH", "SIGN_MSG_AUTH"),
+    "NFT_END": CACHEABLE_COMMANDS + SIGN_CACHE_COMMANDS,
+    "PASS": CACHEABLE_COMMANDS + SIGN_CACHE_COMMANDS,
+    "LOGOUT": CACHEABLE_COMMANDS + SIGN_CACHE_COMMANDS,
+}
+RESPONSE_CACHE_ENABLED = True
+# Answer a repeated signing request (a backend retry) from the signatures already made,
+# and let identical requests in flight share one device operation. Off unless configured.
+SIGN_CACHE_ENABLED = False
+# Signatures kept per wallet; the least recently used are dropped first
+SIGN_CACHE_SIZE = 1024
+# Seconds a signature stays usable for retries
+SIGN_CACHE_TTL = 30
+
+# NFTs longer than one chunk are uploaded as NFT_BEGIN / NFT_CHUNK... / NFT_END when the firmware supports it
+CHUNKED_UPLOAD_ENABLED = True
+# Characters of NFT data per NFT_CHUNK line; keeps each line inside the firmware's line buffer
+NFT_CHUNK_SIZE = 192
+# Chunks sent ahead of their acknowledgements
+NFT_CHUNK_WINDOW = 4
+# Boot banner; seeing it means the wallet restarted and lost its session
+STARTUP_BANNER = "Secure Wallet Starting"
+# Commands logged without their arguments: the supervisor re-sends the password on every reconnect
+LOG_MASKED_COMMANDS = ("PASS",)
+LOG_MASK = "***"
+
+
+def command_name(command):
+    """The command verb of a device command line, ignoring any "#<seq>" tag."""
+    parts = command.split(" ", 2)
+    if parts[0].startswith("#") and len(parts) > 1:
+        return parts[1]
+    return parts[0]
+
+
+def loggable_command(command):
+    """The command line as it may appear in the log, with the arguments of LOG_MASKED_COMMANDS masked."""
+    name = command_name(command)
+    if name not in LOG_MASKED_COMMANDS:
+        return command
+    end = command.find(name) + len(name)
+    return command[:end] + (f" {LOG_MASK}" if end < len(command) else "")
 
-serial_lock = threading.Lock()
 
 class ESP32Device:
-    def __init__(self, port):
+    """Serial link to a SecureWallet.
+
+    In the default line mode every reply is simply the next line the device
+    sends, so commands must run one at a time. In framed mode each command is
+    prefixed with "#<seq> " and the firmware echoes that tag on its reply,
+    which lets several commands be in flight at once and complete out of order.
+    Untagged lines (boot banner, GET_STATUS output) never satisfy a request.
+    """
+
+    def __init__(self, port, framed=False):
         self.port = port
+        self.framed = framed
+        self._buffer = bytearray()
+        self._lines = collections.deque(maxlen=MAX_UNSOLICITED_LINES)
+        self._lines_ready = threading.Condition()
+        self._closed = threading.Event()
+        self._write_lock = threading.Lock()
+        self._command_lock = threading.Lock()
+        self._seq = itertools.count(1)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._reset_listeners = []
+        # Line-mode replies still owed for commands that timed out; the reader thread clears it on a reboot
+        self._stale_replies = 0
+        self._stale_lock = threading.Lock()
+        # Monotonic time the device last sent anything; the heartbeat uses it to stay quiet
+        self.last_activity = time.monotonic()
         try:
-            with serial_lock:
-                self.ser = serial.Serial(port, BAUD_RATE, timeout=READ_TIMEOUT)
-                logger.info(f"Opened serial connection on {port}")
+            self.ser = serial.Serial(port, BAUD_RATE, timeout=READ_TIMEOUT, inter_byte_timeout=INTER_BYTE_TIMEOUT)
+            logger.info(f"Opened serial connection on {port}")
         except Exception as e:
             logger.error(f"Failed to open serial port {port}: {e}")
-            sys.exit(1)
+            raise
+        self._tune_port()
+
+        self._reader = threading.Thread(target=self._reader_loop, name=f"ESP32Reader-{port}", daemon=True)
+        self._reader.start()
+
+    def _tune_port(self):
+        """Apply the optional driver settings; a port that refuses one is still usable."""
+        if LOW_LATENCY:
+            try:
+                self.ser.set_low_latency_mode(True)
+                logger.info(f"Low-latency mode enabled on {self.port}")
+            except (AttributeError, ValueError, OSError) as e:
+                logger.warning(f"Low-latency mode not available on {self.port}: {e}")
+        if RX_BUFFER_SIZE or TX_BUFFER_SIZE:
+            if hasattr(self.ser, "set_buffer_size"):
+                self.ser.set_buffer_size(rx_size=RX_BUFFER_SIZE or 4096, tx_size=TX_BUFFER_SIZE)
+            else:
+                logger.debug(f"Serial buffer sizes are fixed by the driver on {self.port}")
+
+    def _reader_loop(self):
+        """Drain the serial port continuously and route every complete line."""
+        line_started = time.perf_counter()
+        while not self._closed.is_set():
+            try:
+                # Block for the first byte (up to READ_TIMEOUT), then take whatever else is buffered
+                with diagnostics.profiled():
+                    chunk = self.ser.read(self.ser.in_waiting or 1)
+            except Exception as e:
+                if not self._closed.is_set():
+                    logger.error(f"Error reading from serial: {e}")
+                break
+            if not chunk:
+                continue
+
+            self.last_activity = time.monotonic()
+            if not self._buffer:
+                line_started = time.perf_counter()
+            self._buffer += chunk
+            lines = []
+            while True:
+                end = self._buffer.find(b"\n")
+                if end < 0:
+                    break
+                METRICS.observe("reply", "serial_read", time.perf_counter() - line_started)
+                line_started = time.perf_counter()
+                if diagnostics.tracer:
+                    diagnostics.tracer.record(diagnostics.SERIAL_RX, bytes(self._buffer[:end]))
+                line = self._buffer[:end].decode(errors="replace").strip()
+                del self._buffer[:end + 1]
+                if STARTUP_BANNER in line:
+                    self._notify_reset()
+                if line and not self._dispatch_framed(line):
+                    lines.append(line)
+
+            if lines:
+                with self._lines_ready:
+                    self._lines.extend(lines)
+                    self._lines_ready.notify_all()
+
+        # Wake any caller still waiting so it does not sit out its full timeout
+        self._closed.set()
+        self._notify_reset()
+        with self._lines_ready:
+            self._lines_ready.notify_all()
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(serial.SerialException(f"Serial port {self.port} closed"))
+
+    def add_reset_listener(self, callback):
+        """Call callback whenever the wallet reboots or the serial link goes away."""
+        self._reset_listeners.append(callback)
+
+    def _notify_reset(self):
+        # A rebooted wallet will never answer what it was asked before
+        with self._stale_lock:
+            self._stale_replies = 0
+        if not self._closed.is_set() and self.ser.baudrate != BAUD_RATE:
+            # It also boots at BAUD_RATE, so the link follows it back until renegotiated
+            try:
+                self.ser.baudrate = BAUD_RATE
+                logger.info(f"Wallet on {self.port} restarted; serial link back at {BAUD_RATE} baud")
+            except (serial.SerialException, OSError, ValueError) as e:
+                logger.error(f"Could not return {self.port} to {BAUD_RATE} baud: {e}")
+        invalidate_cache(self)
+        for callback in self._reset_listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Reset listener failed for {self.port}: {e}")
+
+    def _dispatch_framed(self, line):
+        """Resolve the pending request a "#<seq> reply" line belongs to; False if the line is untagged."""
+        match = FRAME_PATTERN.match(line)
+        if not match:
+            return False
+        seq = int(match.group(1))
+        with self._pending_lock:
+            future = self._pending.pop(seq, None)
+        if future is None:
+            logger.debug(f"Discarding reply for unknown sequence {seq}: {match.group(2)}")
+        else:
+            future.set_result(match.group(2))
+        return True
+
+    @property
+    def closed(self):
+        """True once the serial link is gone, whether closed by us or lost."""
+        return self._closed.is_set()
+
+    @property
+    def concurrency(self):
+        """How many commands this device can usefully have in flight at once."""
+        return FRAMED_CONCURRENCY if self.framed else 1
 
     def send_command(self, command):
         """Send a command string terminated by newline."""
-        full_command = command + "\n"
-        self.ser.write(full_command.encode())
-        logger.info(f"Sent: {command}")
+        full_command = (command + "\n").encode()
+        with METRICS.timer(command_name(command), "serial_write"), self._write_lock, diagnostics.profiled():
+            self.ser.write(full_command)
+        if diagnostics.tracer:
+            diagnostics.tracer.record(diagnostics.SERIAL_TX, full_command)
+        logger.info(f"Sent: {loggable_command(command)}")
 
-    def read_line(self):
-        """Read one line from the serial port."""
-        try:
-            line = self.ser.readline().decode(errors="replace").strip()
-            return line
-        except Exception as e:
-            logger.error(f"Error reading from serial: {e}")
+    def read_line(self, timeout=READ_TIMEOUT):
+        """Wait for the next untagged line from the device; returns "" on timeout or if the port is closed."""
+        with self._lines_ready:
+            self._lines_ready.wait_for(lambda: self._lines or self._closed.is_set(), timeout)
+            if self._lines:
+                return self._lines.popleft()
             return ""
 
+    def discard_lines(self):
+        """Drop any untagged lines that arrived while nobody was waiting for them."""
+        with self._lines_ready:
+            for line in self._lines:
+                logger.debug(f"Discarding unsolicited line: {line}")
+            self._lines.clear()
+
+    def submit(self, command):
+        """Send a framed command and return a Future resolved with the device's reply."""
+        if not self.framed:
+            raise RuntimeError("submit() requires framed mode; use request() on legacy firmware")
+        seq = next(self._seq)
+        future = concurrent.futures.Future()
+        with self._pending_lock:
+            self._pending[seq] = future
+        try:
+            self.send_command(f"#{seq} {command}")
+        except Exception:
+            with self._pending_lock:
+                self._pending.pop(seq, None)
+            raise
+        future.seq = seq
+        future.sent_at = time.perf_counter()
+        return future
+
+    def cancel(self, future):
+        """Forget a submitted command; a late reply for it will be discarded."""
+        with self._pending_lock:
+            self._pending.pop(future.seq, None)
+        future.cancel()
+
+    def request(self, command, timeout=COMMAND_TIMEOUT, expect=None):
+        """Send a command and return its reply, or "" if none arrives before the timeout.
+
+        expect optionally lists the replies that may answer the command; in line
+        mode any other line received meanwhile is skipped as unsolicited.
+        """
+        name = command_name(command)
+        if self.framed:
+            future = self.submit(command)
+            try:
+                response = future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                self.cancel(future)
+                response = ""
+            except Exception as e:
+                logger.error(f"Error waiting for reply to {name}: {e}")
+                response = ""
+            self._record_reply(name, future.sent_at, response)
+            return response
+
+        with self._command_lock:
+            self._drain_stale_replies()
+            self.discard_lines()
+            self.send_command(command)
+            sent_at = time.perf_counter()
+            deadline = time.monotonic() + timeout
+            response = ""
+            while (remaining := deadline - time.monotonic()) > 0:
+                response = self.read_line(timeout=remaining)
+                if not response or expect is None or response in expect:
+                    break
+                logger.debug(f"Skipping unsolicited line: {response}")
+                response = ""
+            if not response and not self.closed:
+                self._owe_replies(1)
+            self._record_reply(name, sent_at, response)
+            return response
+
+    def _drain_stale_replies(self):
+        """Consume the late replies of timed-out line-mode commands; caller holds the command lock.
+
+        The firmware answers in order, so each owed reply arrives before the
+        reply to anything sent after it. One that does not show up within
+        STALE_REPLY_GRACE is taken as lost.
+        """
+        while self._stale_replies:
+            line = self.read_line(timeout=STALE_REPLY_GRACE)
+            with self._stale_lock:
+                if not line:
+                    if self._stale_replies:
+                        logger.warning(f"{self._stale_replies} late reply(ies) from {self.port} never arrived.")
+                    self._stale_replies = 0
+                    break
+                if STARTUP_BANNER in line:
+                    # Not a reply: the reboot it announces has already written the owed ones off
+                    logger.debug(f"Discarding boot banner: {line}")
+                    continue
+                logger.debug(f"Discarding late reply: {line}")
+                self._stale_replies = max(self._stale_replies - 1, 0)
+
+    def _owe_replies(self, count):
+        with self._stale_lock:
+            self._stale_replies += count
+
+    @staticmethod
+    def _record_reply(name, sent_at, response):
+        if response:
+            METRICS.observe(name, "device", time.perf_counter() - sent_at)
+        else:
+            METRICS.increment("timeouts", name)
+
+    def request_many(self, commands, timeout=COMMAND_TIMEOUT, window=PIPELINE_WINDOW):
+        """Send several commands back-to-back and return their replies in order.
+
+        Up to window commands are outstanding at once, and each reply may take up
+        to timeout after the previous one. Missing replies come back as "".
+        commands may be any iterable; it is consumed only as the window frees up,
+        so a generator never has more than window commands built at once.
+        """
+        commands = iter(commands)
+        if self.framed:
+            return self._request_many_framed(commands, timeout, window)
+
+        responses = []
+        with self._command_lock:
+            self._drain_stale_replies()
+            self.discard_lines()
+            outstanding = 0
+            for command in itertools.islice(commands, window):
+                self.send_command(command)
+                outstanding += 1
+            while outstanding:
+                response = self.read_line(timeout=timeout)
+                if not response:
+                    # Line-mode replies are matched by position only, so after one
+                    # missing reply the rest cannot be attributed any more.
+                    logger.error(f"No reply to batched command {len(responses) + 1}; abandoning the rest.")
+                    responses.extend([""] * outstanding)
+                    responses.extend("" for _ in commands)
+                    if not self.closed:
+                        self._owe_replies(outstanding)
+                    break
+                responses.append(response)
+                outstanding -= 1
+                for command in itertools.islice(commands, 1):
+                    self.send_command(command)
+                    outstanding += 1
+        return responses
+
+    def _request_many_framed(self, commands, timeout, window):
+        responses = []
+        in_flight = collections.deque(self.submit(command) for command in itertools.islice(commands, window))
+        while in_flight:
+            future = in_flight.popleft()
+            try:
+                responses.append(future.result(timeout))
+            except concurrent.futures.TimeoutError:
+                self.cancel(future)
+                responses.append("")
+            except Exception as e:
+                logger.error(f"Error waiting for batched reply: {e}")
+                responses.append("")
+            for command in itertools.islice(commands, 1):
+                in_flight.append(self.submit(command))
+        return responses
+
+    def negotiate_framing(self, timeout=READ_TIMEOUT):
+        """Switch to framed mode if the firmware acknowledges it; otherwise stay in line mode."""
+        self.framed = True
+        response = self.request("PROTO FRAMED", timeout=timeout)
+        if response == "OK":
+            logger.info(f"Framed protocol enabled on {self.port}")
+            return True
+        self.framed = False
+        # Legacy firmware answers the unknown command with a plain line (or not at all);
+        # line-mode requests discard such leftovers before sending anyway.
+        self.discard_lines()
+        logger.info(f"Firmware on {self.port} does not support framing; using line mode")
+        return False
+
+    def negotiate_baud(self, rate, timeout=READ_TIMEOUT):
+        """Move the link to a faster rate if the firmware agrees; returns True if it did.
+
+        The firmware acknowledges "BAUD <rate>" at the current rate and then
+        switches, so we switch after the OK and confirm with a status query. If
+        that goes unanswered we fall back to the old rate. A wallet that reboots
+        comes back at BAUD_RATE; the link returns there when the reset is seen
+        and is renegotiated when the wallet is next authenticated.
+        """
+        previous = self.ser.baudrate
+        if previous == rate:
+            return True
+        # A boot banner still in flight must not be taken for the answer
+        if self.request(f"BAUD {rate}", timeout=timeout, expect=("OK", "ERROR: Unknown command")) != "OK":
+            self.discard_lines()
+            logger.info(f"Firmware on {self.port} keeps {previous} baud")
+            return False
+        self.ser.baudrate = rate
+        if self.request("GET_STATUS", timeout=timeout):
+            logger.info(f"Serial link on {self.port} now at {rate} baud")
+            return True
+        logger.warning(f"No reply at {rate} baud on {self.port}; returning to {previous}")
+        self.ser.baudrate = previous
+        return False
+
     def close(self):
+        self._closed.set()
         self.ser.close()
+        self._reader.join(timeout=READ_TIMEOUT + 1)
+
+
+class AsyncESP32Device:
+    """asyncio wrapper around ESP32Device (or a DevicePool of them).
+
+    Blocking serial work runs on a small per-device thread pool, bounded by
+    max_concurrency, which defaults to what the device can pipeline: one at a
+    time in line mode, FRAMED_CONCURRENCY for framed firmware, the sum of its
+    members for a pool.
+    """
+
+    def __init__(self, device, max_concurrency=None):
+        if max_concurrency is None:
+            max_concurrency = device.concurrency
+        self.device = device
+        self.max_concurrency = max_concurrency
+        # asyncio is imported on demand: it is a large share of start-up time and
+        # only the async server link needs it
+        import asyncio
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix=f"ESP32Worker-{device.port}"
+        )
+
+    async def call(self, func, *args):
+        """Run a blocking function that talks to the device without blocking the event loop."""
+        import asyncio
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class ResponseCache:
+    """Read-through cache of one device's CACHEABLE_COMMANDS replies, with hit/miss counters.
+
+    It also holds the signature cache: recent SIGN_CACHE_COMMANDS results keyed
+    by (verb, message digest, request id), evicted least recently used beyond
+    SIGN_CACHE_SIZE and expired after SIGN_CACHE_TTL, plus the signing
+    operations still in flight so identical requests can wait on them.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.sign_hits = 0
+        self.sign_coalesced = 0
+        self.sign_misses = 0
+        self._entries = {}
+        self._signatures = collections.OrderedDict()
+        self._signing = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, command, count_miss=True):
+        with self._lock:
+            response = self._entries.get(command)
+            if response is not None:
+                self.hits += 1
+            elif count_miss:
+                self.misses += 1
+            return response
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def put(self, command, response, generation):
+        """Store a reply unless an invalidation happened since the request was sent."""
+        with self._lock:
+            if generation == self._generation:
+                self._entries[command] = response
+
+    def invalidate(self, commands=CACHEABLE_COMMANDS + SIGN_CACHE_COMMANDS):
+        with self._lock:
+            self._generation += 1
+            for command in commands:
+                self._entries.pop(command, None)
+            for key in [key for key in self._signatures if key[0] in commands]:
+                del self._signatures[key]
+            # Signing already under way used the old state; later requests must not join it
+            for key in [key for key in self._signing if key[0] in commands]:
+                del self._signing[key]
+
+    def claim_signature(self, key):
+        """Look up a signature: returns (reply, None, False) on a hit, else (None, future, owner).
+
+        The future is that of an identical request already in flight, or, when
+        owner is True, a new one the caller must settle with finish_signature()
+        once it has asked the wallet.
+        """
+        with self._lock:
+            entry = self._signatures.get(key)
+            if entry is not None:
+                expires, response = entry
+                if expires > time.monotonic():
+                    self._signatures.move_to_end(key)
+                    self.sign_hits += 1
+                    return response, None, False
+                del self._signatures[key]
+            future = self._signing.get(key)
+            if future is not None:
+                self.sign_coalesced += 1
+                return None, future, False
+            future = self._signing[key] = concurrent.futures.Future()
+            future.generation = self._generation
+            self.sign_misses += 1
+            return None, future, True
+
+    def finish_signature(self, key, future, response):
+        """Publish the wallet's reply to the requests waiting on future, caching it if still valid."""
+        with self._lock:
+            if self._signing.get(key) is future:
+                del self._signing[key]
+            # Only signatures are kept: a retry after an error must reach the wallet again
+            if response and not response.startswith("ERROR") and future.generation == self._generation:
+                self._signatures[key] = (time.monotonic() + SIGN_CACHE_TTL, response)
+                self._signatures.move_to_end(key)
+                while len(self._signatures) > SIGN_CACHE_SIZE:
+                    self._signatures.popitem(last=False)
+        future.set_result(response)
+
+    def stats(self):
+        with self._lock:
+            stats = {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+            if SIGN_CACHE_ENABLED:
+                stats.update({
+                    "sign_hits": self.sign_hits,
+                    "sign_coalesced": self.sign_coalesced,
+                    "sign_misses": self.sign_misses,
+                    "signatures": len(self._signatures),
+                })
+            return stats
+
+
+_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+
+def get_cache(device):
+    """Return the ResponseCache belonging to device, creating it on first use.
+
+    A wrapper that shares another device's replies (see multiplex.Channel)
+    names that device as its cache_owner.
+    """
+    device = getattr(device, "cache_owner", device)
+    with _caches_lock:
+        cache = _caches.get(device)
+        if cache is None:
+            cache = _caches[device] = ResponseCache()
+        return cache
+
+
+def invalidate_cache(device):
+    """Forget everything cached for device, e.g. after it reconnects or reboots."""
+    device = getattr(device, "cache_owner", device)
+    with _caches_lock:
+        cache = _caches.get(device)
+    if cache is not None:
+        cache.invalidate()
+
+
+def cached_response(device, command):
+    """Return a cached reply for command without touching the device, or None."""
+    if not RESPONSE_CACHE_ENABLED or command not in CACHEABLE_COMMANDS:
+        return None
+    return get_cache(device).get(command, count_miss=False)
+
+
+class RequestContext:
+    """Deadline of the server request being served, and whether a device command timed out for it."""
+
+    def __init__(self, deadline=None):
+        # time.monotonic() by which the reply is due; None means only per-command timeouts apply
+        self.deadline = deadline
+        self.timed_out = None
+
+
+_request_context = contextvars.ContextVar("request_context", default=None)
+
+
+@contextlib.contextmanager
+def request_context(deadline=None):
+    """Scope the device commands run on this thread (or task) to one server request."""
+    context = RequestContext(deadline)
+    token = _request_context.set(context)
+    try:
+        yield context
+    finally:
+        _request_context.reset(token)
+
+
+def command_timeout(command, timeout=None):
+    """Seconds to allow command: its own timeout, cut short by the current request's deadline."""
+    if timeout is None:
+        timeout = COMMAND_TIMEOUTS.get(command_name(command), COMMAND_TIMEOUT)
+    context = _request_context.get()
+    if context is not None and context.deadline is not None:
+        timeout = min(timeout, context.deadline - time.monotonic())
+    return timeout
+
+
+def _note_timeout(command, timeout):
+    context = _request_context.get()
+    if context is not None and context.timed_out is None:
+        context.timed_out = (command_name(command), timeout)
+
+
+def exchange(device, command, timeout=None, expect=None):
+    """Send command to the device and return its reply, going through the response cache.
+
+    timeout defaults to the command's entry in COMMAND_TIMEOUTS. Inside a
+    request_context() it is also capped by the request's deadline; a command
+    whose deadline has already passed is not sent at all.
+    """
+    name = command.split(" ", 1)[0]
+    timeout = command_timeout(command, timeout)
+    if timeout <= 0:
+        _note_timeout(command, 0)
+        return ""
+    if not RESPONSE_CACHE_ENABLED:
+        response = device.request(command, timeout, expect)
+        if not response:
+            _note_timeout(command, timeout)
+        return response
+
+    cache = get_cache(device)
+    if name in CACHEABLE_COMMANDS:
+        response = cache.get(name)
+        if response is not None:
+            return response
+        generation = cache.generation
+        response = device.request(command, timeout, expect)
+        if not response:
+            _note_timeout(command, timeout)
+        elif not response.startswith("ERROR"):
+            # A firmware error may be transient; the next read asks the wallet again
+            cache.put(name, response, generation)
+        return response
+
+    stale = CACHE_INVALIDATIONS.get(name)
+    if stale:
+        cache.invalidate(stale)
+    response = device.request(command, timeout, expect)
+    if stale:
+        # Drop anything a concurrent read cached while the change was in flight
+        cache.invalidate(stale)
+    if not response:
+        _note_timeout(command, timeout)
+    return response
+
+
+def sign_exchange(device, command, request_id=None):
+    """exchange() for a SIGN_MSG_* command, made idempotent by the signature cache.
+
+    A retry of a message signed within SIGN_CACHE_TTL gets the same reply
+    without reaching the wallet, and a request identical to one still in
+    flight waits for that one's reply. request_id, when the caller has one,
+    keeps requests that happen to carry the same message apart.
+    """
+    if not SIGN_CACHE_ENABLED:
+        return exchange(device, command)
+    verb, _, msg = command.partition(" ")
+    key = (verb, hashlib.sha256(msg.encode('utf-8')).digest(), request_id)
+    cache = get_cache(device)
+    response, future, owner = cache.claim_signature(key)
+    if future is None:
+        METRICS.increment("sign_cache", "hit")
+        return response
+    if not owner:
+        METRICS.increment("sign_cache", "coalesced")
+        timeout = command_timeout(command)
+        try:
+            return future.result(max(timeout, 0))
+        except concurrent.futures.TimeoutError:
+            _note_timeout(command, timeout)
+            return ""
+
+    response = ""
+    try:
+        response = exchange(device, command)
+    finally:
+        cache.finish_signature(key, future, response)
+    return response
+
+
+def check_password(device, password):
+    """True if the wallet accepts password, False if it answers FAIL, None if it does not answer at all."""
+    response = exchange(device, f"PASS {password}", expect=("PASSWORD_OK", "FAIL"))
+    if not response:
+        return None
+    return response == "PASSWORD_OK"
 
 
 def authenticate_device(device, password):
     """Send password to the ESP32 and wait for authentication response."""
-    device.send_command(f"PASS {password}")
-    start_time = time.time()
-    while time.time() - start_time < 5:
-        response = device.read_line()
-        if response:
-            # response = response.decode('utf-8').strip()
-            if response == "PASSWORD_OK":
-                return True
-            elif response == "FAIL":
-                return False
-        time.sleep(0.5)
-    return False
+    if check_password(device, password) is not True:
+        return False
+    negotiate_target_baud(device)
+    return True
+
+
+def negotiate_target_baud(device):
+    """Move the link to TARGET_BAUD_RATE, if one is set, once the wallet has answered.
+
+    Not done on open: the port opening reboots the ESP32, which would miss the
+    request. Channels and pools leave the rate to the devices behind them.
+    """
+    if TARGET_BAUD_RATE and TARGET_BAUD_RATE != BAUD_RATE and hasattr(device, "negotiate_baud"):
+        device.negotiate_baud(TARGET_BAUD_RATE)
 
 
 def logout_device(device):
     """Send logout command to the ESP32."""
-    device.send_command("LOGOUT")
-    start_time = time.time()
-    while time.time() - start_time < 5:
-        response = device.read_line()
-        if response:
-            response = response.strip()
-            if response == "Logged out":
-                logger.info("Logged out successfully.")
-                return True
-            else:
-                logger.error("Logout failed.")
-                return False
-        time.sleep(0.5)
+    response = exchange(device, "LOGOUT")
+    if response:
+        if response == "Logged out":
+            logger.info("Logged out successfully.")
+            return True
+        else:
+            logger.error("Logout failed.")
+            return False
     return False
 
 def getreqnft(device):
-    device.send_command("GET_NFT_REQ")
-    start_time = time.time()
-    while time.time() - start_time < 5:
-        response = device.read_line()
-        if response:
-            response = response.strip()
-            logger.info(f"Received NFT request response: {response}")
-            return response
-        time.sleep(0.5)
+    response = exchange(device, "GET_NFT_REQ")
+    if response:
+        logger.info(f"Received NFT request response: {response}")
+        return response
     logger.error("Failed to get NFT request response.")
     return None
 
 def getauthnft(device):
-    device.send_command("GET_NFT_AUTH")
-    start_time = time.time()
-    while time.time() - start_time < 5:
-        response = device.read_line()
-        if response:
-            response = response.strip()
-            logger.info(f"Received NFT auth response: {response}")
-            return response
-        time.sleep(0.5)
+    response = exchange(device, "GET_NFT_AUTH")
+    if response:
+        logger.info(f"Received NFT auth response: {response}")
+        return response
     logger.error("Failed to get NFT auth response.")
     return None
 
 def setreqnft(device, nft):
-    device.send_command(f"SET_NFT_REQ {nft}")
-    start_time = time.time()
-    while time.time() - start_time < 5:
-        response = device.read_line()
-        if response:
-            response = response.strip()
-            logger.info(f"Received NFT request set response: {response}")
-            return response
-        time.sleep(0.5)
+    response = upload_nft(device, "REQ", nft)
+    if response:
+        logger.info(f"Received NFT request set response: {response}")
+        return response
     logger.error("Failed to set NFT request response.")
     return None
 
-def setauthnft(device,nft):
-    device.send_command(f"SET_NFT_AUTH {nft}")
-    start_time = time.time()
-    while time.time() - start_time < 5:
-        response = device.read_line()
-        if response:
-            response = response.strip()
-            logger.info(f"Received NFT auth set response: {response}")
-            return response
-        time.sleep(0.5)
+def setauthnft(device, nft):
+    response = upload_nft(device, "AUTH", nft)
+    if response:
+        logger.info(f"Received NFT auth set response: {response}")
+        return response
     logger.error("Failed to set NFT auth response.")
     return None
 
-def signauthnft(device,msg):
-    device.send_command(f"SIGN_MSG_AUTH {msg}")
-    print(f"SIGN_MSG_AUTH {msg}")
-    start_time = time.time()
-    while time.time() - start_time < 5:
-        response = device.read_line()
-        if response:
-            response = response.strip()
-            logger.info(f"Received NFT auth sign response: {response}")
-            return response
-        time.sleep(0.5)
+def signauthnft(device, msg, request_id=None):
+    response = sign_exchange(device, f"SIGN_MSG_AUTH {msg}", request_id)
+    if response:
+        logger.info(f"Received NFT auth sign response: {response}")
+        return response
     logger.error("Failed to sign NFT auth response.")
     return None
 
-def Signreqnft(device,msg):
-    device.send_command(f"SIGN_MSG_REQ {msg}")
-    start_time = time.time()
-    while time.time() - start_time < 5:
-        response = device.read_line()
-        if response:
-            response = response.strip()
-            logger.info(f"Received NFT request sign response: {response}")
-            return response
-        time.sleep(0.5)
+def Signreqnft(device, msg, request_id=None):
+    response = sign_exchange(device, f"SIGN_MSG_REQ {msg}", request_id)
+    if response:
+        logger.info(f"Received NFT request sign response: {response}")
+        return response
     logger.error("Failed to sign NFT request response.")
     return None
 
 def RemoveReqNFT(device):
-    device.send_command("REMOVE_NFT_REQ")
-    start_time = time.time()
-    while time.time() - start_time < 5:
-        response = device.read_line()
-        if response:
-            response = response.strip()
-            logger.info(f"Received NFT request remove response: {response}")
-            return response
-        time.sleep(0.5)
+    response = exchange(device, "REMOVE_NFT_REQ")
+    if response:
+        logger.info(f"Received NFT request remove response: {response}")
+        return response
     logger.error("Failed to remove NFT request response.")
     return None
 
 def RemoveAuthNFT(device):
-    device.send_command("REMOVE_NFT_AUTH")
-    start_time = time.time()
-    while time.time() - start_time < 5:
-        response = device.read_line()
-        if response:
-            response = response.strip()
-            logger.info(f"Received NFT auth remove response: {response}")
-            return response
-        time.sleep(0.5)
+    response = exchange(device, "REMOVE_NFT_AUTH")
+    if response:
+        logger.info(f"Received NFT auth remove response: {response}")
+        return response
     logger.error("Failed to remove NFT auth response.")
     return None
 
 
 def GetReqAddr(device):
-    device.send_command("GET_ADDR_REQ")
-    start_time = time.time()
-    while time.time() - start_time < 5:
-        response = device.read_line()
-        if response:
-            response = response.strip()
-            logger.info(f"Received request address: {response}")
-            return response
-        time.sleep(0.5)
+    response = exchange(device, "GET_ADDR_REQ")
+    if response:
+        logger.info(f"Received request address: {response}")
+        return response
     logger.error("Failed to get request address.")
     return None
 
 def GetAuthAddr(device):
-    device.send_command("GET_ADDR_AUTH")
-    start_time = time.time()
-    while time.time() - start_time < 5:
-        response = device.read_line()
-        if response:
-            response = response.strip()
-            logger.info(f"Received auth address: {response}")
-            return response
-        time.sleep(0.5)
+    response = exchange(device, "GET_ADDR_AUTH")
+    if response:
+        logger.info(f"Received auth address: {response}")
+        return response
     logger.error("Failed to get auth address.")
-    return None
\ No newline at end of file
+    return None
+
+
+def signauthnft_batch(device, msgs):
+    """Sign several messages with the auth NFT in one pipelined exchange; None marks a failed item."""
+    return _sign_batch(device, "SIGN_MSG_AUTH", "auth", msgs)
+
+def Signreqnft_batch(device, msgs):
+    """Sign several messages with the request NFT in one pipelined exchange; None marks a failed item."""
+    return _sign_batch(device, "SIGN_MSG_REQ", "request", msgs)
+
+def _sign_batch(device, verb, label, msgs):
+    timeout = command_timeout(verb)
+    if timeout <= 0:
+        _note_timeout(verb, 0)
+        return [None] * len(msgs)
+    responses = device.request_many([f"{verb} {msg}" for msg in msgs], timeout)
+    if "" in responses:
+        _note_timeout(verb, timeout)
+    failed = responses.count("")
+    logger.info(f"Received {len(responses) - failed}/{len(responses)} NFT {label} batch sign responses.")
+    if failed:
+        logger.error(f"Failed to sign {failed} message(s) in NFT {label} batch.")
+    return [response or None for response in responses]
+
+
+# Wallets whose firmware answered NFT_BEGIN with anything but READY
+_no_chunked_upload = weakref.WeakSet()
+# One upload at a time per wallet: the firmware holds a single NFT_BEGIN..NFT_END in progress
+_upload_locks = weakref.WeakKeyDictionary()
+_upload_locks_lock = threading.Lock()
+
+
+def _upload_lock(device):
+    device = getattr(device, "cache_owner", device)
+    with _upload_locks_lock:
+        lock = _upload_locks.get(device)
+        if lock is None:
+            lock = _upload_locks[device] = threading.Lock()
+        return lock
+
+
+def upload_nft(device, slot, nft, chunk_size=None, window=None, timeout=None):
+    """Store nft in the REQ or AUTH slot and return the wallet's reply ("" on failure).
+
+    Short NFTs, and any NFT on firmware without chunked upload, go as one
+    SET_NFT_<slot> line. Longer ones are streamed in NFT_CHUNK lines of
+    chunk_size characters, window of them ahead of their ACKs, each built
+    from a slice only when the window has room; NFT_END then carries the
+    CRC-32 of everything sent so the wallet can reject a damaged upload.
+    Each step may take timeout seconds (default: the SET_NFT_<slot> timeout).
+    The firmware keeps one upload open at a time, so uploads to the same
+    wallet wait for each other, whichever session or Channel they come from.
+    """
+    chunk_size = chunk_size or NFT_CHUNK_SIZE
+    window = window or NFT_CHUNK_WINDOW
+    pool = getattr(device, "cache_owner", device)
+    if getattr(pool, "members", None) is not None:
+        if pool is not device:
+            # A Channel in front of a DevicePool (multi-wallet mode): the upload is one scheduled job
+            return device.call(upload_nft, slot, nft, chunk_size, window, timeout)
+        # A pool broadcasts state changes; each wallet needs its own chunk stream, run from its queue
+        responses = device.broadcast(upload_nft, slot, nft, chunk_size, window, timeout)
+        invalidate_cache(device)
+        if len(set(responses)) > 1:
+            logger.warning(f"Wallets in pool {device.port} disagree on the NFT {slot} upload: {responses}")
+        return responses[0]
+
+    with _upload_lock(device):
+        return _upload_nft(device, slot, nft, chunk_size, window, timeout)
+
+
+def _upload_nft(device, slot, nft, chunk_size, window, timeout):
+    # Remembered for the wallet itself, not for each Channel in front of it
+    wallet = getattr(device, "cache_owner", device)
+    if not CHUNKED_UPLOAD_ENABLED or len(nft) <= chunk_size or wallet in _no_chunked_upload:
+        return exchange(device, f"SET_NFT_{slot} {nft}", timeout)
+
+    def step_timeout():
+        return max(command_timeout(f"SET_NFT_{slot}", timeout), 0)
+
+    response = device.request(f"NFT_BEGIN {slot} {len(nft)}", step_timeout())
+    if response != "READY":
+        if response:
+            # Legacy firmware rejects NFT_BEGIN in its own words; whatever they are, it is not READY
+            logger.info(f"Firmware on {device.port} has no chunked upload ({response}); sending one line.")
+            _no_chunked_upload.add(wallet)
+        else:
+            # Silence says nothing about what the firmware supports, so only this upload falls back
+            _note_timeout("NFT_BEGIN", step_timeout())
+            logger.warning(f"No reply to NFT_BEGIN from {device.port}; sending NFT {slot} as one line.")
+        return exchange(device, f"SET_NFT_{slot} {nft}", step_timeout())
+
+    crc = 0
+
+    def chunks():
+        nonlocal crc
+        for offset in range(0, len(nft), chunk_size):
+            chunk = nft[offset:offset + chunk_size]
+            crc = zlib.crc32(chunk.encode(), crc)
+            yield f"NFT_CHUNK {offset} {chunk}"
+
+    expected = (f"ACK {min(offset + chunk_size, len(nft))}" for offset in range(0, len(nft), chunk_size))
+    start = time.perf_counter()
+    for index, (reply, ack) in enumerate(zip(device.request_many(chunks(), step_timeout(), window), expected)):
+        if reply != ack:
+            logger.error(f"NFT {slot} chunk {index + 1} was not acknowledged ({reply or 'no reply'}); aborting upload.")
+            if not reply:
+                _note_timeout("NFT_CHUNK", step_timeout())
+            device.request("NFT_ABORT", max(command_timeout("NFT_ABORT"), 0))
+            return ""
+
+    response = exchange(device, f"NFT_END {slot} {crc:08x}", step_timeout())
+    elapsed = time.perf_counter() - start
+    METRICS.observe(f"SET_NFT_{slot}", "upload", elapsed)
+    logger.info(f"Uploaded {len(nft)}-character NFT {slot} in {elapsed * 1000:.1f} ms: {response or 'no reply'}")
+    return response
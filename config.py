@@ -0,0 +1,145 @@
+import os
+import re
+
+# Read from the checkout, not the working directory, so a service started elsewhere finds it
+ENV_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+# Every setting can be given as SECUREWALLET_<NAME> in the environment or .env
+ENV_PREFIX = "SECUREWALLET_"
+
+_TRUE = ("1", "true", "yes", "on")
+_FALSE = ("0", "false", "no", "off", "")
+
+
+def _bool(value):
+    value = str(value).strip().lower()
+    if value in _TRUE:
+        return True
+    if value in _FALSE:
+        return False
+    raise ValueError(f"expected a boolean, got '{value}'")
+
+
+def _optional(convert):
+    def parse(value):
+        if str(value).strip().lower() in ("", "none", "off"):
+            return None
+        return convert(value)
+    return parse
+
+
+def _endpoints(value):
+    """Accept "host:port", a URL such as "http://host:port/", or a comma-separated list of them."""
+    endpoints = []
+    for endpoint in str(value).split(","):
+        endpoint = re.sub(r"^[a-z]+://", "", endpoint.strip()).rstrip("/")
+        host, _, port = endpoint.rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError(f"expected host:port, got '{endpoint}'")
+        endpoints.append(endpoint)
+    return ",".join(endpoints)
+
+
+def _timeouts(value):
+    """Parse "COMMAND=seconds,..." into a dict, e.g. "SIGN_MSG_REQ=8,GET_ADDR_REQ=0.5"."""
+    timeouts = {}
+    for item in str(value).split(","):
+        command, _, seconds = item.strip().partition("=")
+        if not command or not seconds:
+            raise ValueError(f"expected COMMAND=seconds, got '{item.strip()}'")
+        timeouts[command.strip().upper()] = float(seconds)
+    return timeouts
+
+
+# name: (parser, help). A setting left unset keeps the default of the module that owns it.
+SETTINGS = {
+    "remote_server": (_endpoints, "socket server as host:port, or a comma-separated failover list"),
+    "server_sessions": (int, "server sessions sharing each wallet"),
+    "baud_rate": (int, "serial rate the wallet boots at"),
+    "target_baud_rate": (_optional(int), "faster rate to negotiate with the firmware once the wallet has authenticated"),
+    "read_timeout": (float, "seconds a serial read blocks waiting for the first byte"),
+    "inter_byte_timeout": (_optional(float), "seconds of silence that end a serial read early"),
+    "low_latency": (_bool, "set ASYNC_LOW_LATENCY on the tty (Linux USB-serial drivers)"),
+    "rx_buffer_size": (_optional(int), "driver receive buffer in bytes, where the platform allows it"),
+    "tx_buffer_size": (_optional(int), "driver transmit buffer in bytes, where the platform allows it"),
+    "command_timeout": (float, "seconds a device command may take unless listed in command_timeouts"),
+    "command_timeouts": (_timeouts, "per-command timeouts as COMMAND=seconds,..."),
+    "sign_cache": (_bool, "answer retried signing requests from recent signatures and coalesce duplicates"),
+    "sign_cache_size": (int, "signatures kept per wallet for retries"),
+    "sign_cache_ttl": (float, "seconds a signature stays usable for retries"),
+    "nft_chunk_size": (int, "characters of NFT data per chunk in a chunked upload"),
+    "nft_chunk_window": (int, "NFT chunks sent ahead of their acknowledgements"),
+    "known_wallets_file": (_optional(str), "file listing wallets seen before, for reattaching without probing; none disables it"),
+    "probe_timeout": (float, "seconds the identify handshake waits on an ambiguous USB-serial port"),
+    "password_source": (str, "gui, stdin, fd:<n> or keyring"),
+    "framed": (_bool, "negotiate the framed device protocol"),
+    "async_link": (_bool, "serve the server link on asyncio"),
+    "worker_processes": (_bool, "run each wallet's serial link in a worker process of its own"),
+    "binary_protocol": (_bool, "accept the server's request to switch the link to binary framing"),
+    "supervised": (_bool, "run under the reconnecting supervisor"),
+    "multi_wallet": (_bool, "drive every attached wallet"),
+    "metrics_port": (_optional(int), "serve Prometheus metrics on this port"),
+    "diagnostics_socket": (_optional(str), "Unix socket for switching profiling and the traffic trace on and off"),
+    "trace_traffic": (_bool, "capture the redacted traffic trace from startup"),
+    "trace_file": (str, "file the traffic trace is written to"),
+    "trace_max_bytes": (int, "size at which the traffic trace file rotates"),
+}
+
+
+def read_env_file(path=ENV_FILE):
+    """Parse KEY=VALUE lines of a .env file; a missing file is simply empty."""
+    values = {}
+    try:
+        with open(path, encoding="utf-8") as env_file:
+            for line in env_file:
+                line = line.strip()
+                if not line or line.startswith("#") or "=" not in line:
+                    continue
+                key, _, value = line.partition("=")
+                key = key.strip()
+                if key.startswith("export "):
+                    key = key[len("export "):].strip()
+                values[key] = value.strip().strip("\"'")
+    except FileNotFoundError:
+        pass
+    return values
+
+
+def _from_env(env):
+    # Only SECUREWALLET_* keys are read: REMORT_SERVER/PORT in older .env files name an HTTP
+    # service, not the socket server, and must not redirect the server link
+    raw = {}
+    for name in SETTINGS:
+        key = ENV_PREFIX + name.upper()
+        if key in env:
+            raw[name] = env[key]
+    return raw
+
+
+def build_parser():
+    # argparse is only needed when there is a command line to parse; keep it off the import path
+    import argparse
+    parser = argparse.ArgumentParser(description="SecureWallet client.")
+    for name, (_, help_text) in SETTINGS.items():
+        parser.add_argument("--" + name.replace("_", "-"), dest=name, default=None, help=help_text)
+    return parser
+
+
+def load_config(argv=None, env_file=ENV_FILE, environ=None):
+    """Collect settings from .env, then the environment, then the command line (later wins).
+
+    Returns only the settings that were given, parsed to their types; raises
+    ValueError naming the setting when a value does not parse.
+    """
+    raw = _from_env(read_env_file(env_file)) if env_file else {}
+    raw.update(_from_env(os.environ if environ is None else environ))
+    if argv is not None:
+        raw.update({name: value for name, value in vars(build_parser().parse_args(argv)).items() if value is not None})
+
+    config = {}
+    for name, value in raw.items():
+        parse, _ = SETTINGS[name]
+        try:
+            config[name] = parse(value)
+        except ValueError as e:
+            raise ValueError(f"Invalid {name}: {e}") from None
+    return config
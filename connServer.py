@@ -1,64 +1,304 @@
 import sys
 import os 
+import json
+import signal
 import threading
-from command import ESP32Device, RemoveAuthNFT, RemoveReqNFT, Signreqnft, authenticate_device,GetAuthAddr,GetReqAddr, getauthnft, getreqnft, logout_device, setauthnft, setreqnft, signauthnft
-from gui import prompt_user_password
+import time
+import command
+import config
+import diagnostics
+import fingerprint
+from command import AsyncESP32Device, ESP32Device, cached_response, get_cache, request_context, RemoveAuthNFT, RemoveReqNFT, Signreqnft, Signreqnft_batch, signauthnft_batch, authenticate_device,GetAuthAddr,GetReqAddr, getauthnft, getreqnft, logout_device, setauthnft, setreqnft, signauthnft
+from binproto import ProtocolError, decode_batch, decode_request, encode_batch, encode_reply
+from credentials import read_password
+from deviceManager import DeviceManager
+from fingerprint import remember_wallet
+from framing import FrameParser, FrameTooLarge, SocketFrameReader, LENGTH_HEADER_SIZE, RECV_SIZE
 from logger import setup_logger
-from util import ConnectSocketServer, monitor_wallet_status, wait_for_device
+from metrics import METRICS, start_http_server
+from multiplex import FairScheduler, RequestExpired, SchedulerBusy
+from supervisor import SecretPassword, Supervisor
+from util import ConnectSocketServer, monitor_wallet_status, set_notifications_enabled, wait_for_device, wait_for_devices
 
 
-serial_lock = threading.Lock()
+# Defaults below can be overridden per host through config.py (.env, environment, command line)
+# Backend endpoints as "host:port[,host:port...]"; sessions spread over them and fail over in order
+REMOTE_SERVER = "127.0.0.1:10080"
+# Concurrent server sessions sharing each wallet (supervised and multi-wallet modes)
+SERVER_SESSIONS = 1
+
+# Where the wallet password comes from: "gui", "stdin", "fd:<n>" or "keyring".
+# Any source other than "gui" runs headless: no GUI or desktop notification imports.
+PASSWORD_SOURCE = "gui"
+
+# Keep the process alive and reconnect the wallet and server link when either drops
+SUPERVISED = True
+# Drive every attached wallet from this process instead of just the first one found
+MULTI_WALLET = False
+# Tag device commands with sequence IDs when the firmware supports it
+USE_FRAMED_PROTOCOL = False
+# Serve server commands concurrently on an asyncio loop instead of one at a time
+ASYNC_SERVER_LINK = False
+# Run each wallet's serial link in a worker process of its own (workers.py), off this process's GIL
+WORKER_PROCESSES = False
+# Commands read from the server but not yet answered, per connection (async mode)
+MAX_PENDING_COMMANDS = 64
+
+# Switch to the binary framing of binproto.py when the server asks with "proto binary"
+BINARY_PROTOCOL_ENABLED = True
+
+# Local port for the Prometheus /metrics endpoint; None disables it
+METRICS_PORT = None
+
+# Commands that take a payload after the command name
+DATA_COMMANDS = ("setauthnft", "setreqnft", "signauthmsg", "signreqmsg", "signauthmsg_batch", "signreqmsg_batch")
+# Data commands whose handler also takes the message's "#<id>" tag (the signature cache keys on it)
+TAGGED_COMMANDS = ("signauthmsg", "signreqmsg")
+# Most messages accepted in one signauthmsg_batch/signreqmsg_batch command
+MAX_BATCH_SIZE = 1000
+# Server commands whose reply may already be in the device's response cache
+CACHED_SERVER_COMMANDS = {
+    "getreqaddr": "GET_ADDR_REQ",
+    "getauthaddr": "GET_ADDR_AUTH",
+    "getreqnft": "GET_NFT_REQ",
+    "getauthnft": "GET_NFT_AUTH",
+}
 
 logger = setup_logger(log_file="logs/connServer.log", log_level="DEBUG")
 
-def handle_server_commands(client_socket, esp_device):
-    command_function_map = {
+def build_command_map(esp_device, binary=False):
+    """Map server command names to the device operations that serve them.
+
+    binary selects how batch payloads are read and answered: JSON on the text
+    protocol, length-prefixed items on the binary one.
+    """
+    read_batch, write_batch = (parse_binary_batch, encode_batch) if binary else (parse_batch, format_batch)
+    return {
         "logout": lambda: logout_device(esp_device),
         "getreqnft": lambda: getreqnft(esp_device),
         "getauthnft": lambda: getauthnft(esp_device),
-        "setauthnft": lambda data: setauthnft(esp_device, data),
-        "setreqnft": lambda data: setreqnft(esp_device, data), 
-        "signauthmsg": lambda data: signauthnft(esp_device, data),
-        "signreqmsg": lambda data: Signreqnft(esp_device, data),
+        "setauthnft": lambda data: setauthnft(esp_device, check_single_line(data)),
+        "setreqnft": lambda data: setreqnft(esp_device, check_single_line(data)), 
+        "signauthmsg": lambda data, tag=None: signauthnft(esp_device, check_single_line(data), tag),
+        "signreqmsg": lambda data, tag=None: Signreqnft(esp_device, check_single_line(data), tag),
+        "signauthmsg_batch": lambda data: write_batch(signauthnft_batch(esp_device, read_batch(data))),
+        "signreqmsg_batch": lambda data: write_batch(Signreqnft_batch(esp_device, read_batch(data))),
         "removereqnft": lambda: RemoveReqNFT(esp_device),
         "removeauthnft": lambda: RemoveAuthNFT(esp_device),
         "getauthaddr": lambda: GetAuthAddr(esp_device),
         "getreqaddr": lambda: GetReqAddr(esp_device),
+        "cachestats": lambda: format_cache_stats(esp_device),
+        "stats": lambda: METRICS.render_json(),
     }
 
+
+def parse_batch(data):
+    """Decode a batch payload: a JSON array of message strings."""
+    messages = json.loads(data)
+    if not isinstance(messages, list) or not all(isinstance(message, str) for message in messages):
+        raise ValueError("batch payload must be a JSON array of strings")
+    for message in messages:
+        check_single_line(message)
+    return check_batch_size(messages)
+
+
+def parse_binary_batch(data):
+    """Decode a binary-protocol batch payload (see binproto.py)."""
+    return check_batch_size(decode_batch(data))
+
+
+def check_single_line(message):
+    """Reject a payload that would reach the wallet's serial line as more than one command."""
+    if "\n" in message or "\r" in message:
+        raise ValueError("payload contains a line break")
+    return message
+
+
+def check_batch_size(messages):
+    if len(messages) > MAX_BATCH_SIZE:
+        raise ValueError(f"batch of {len(messages)} messages exceeds {MAX_BATCH_SIZE}")
+    return messages
+
+
+def format_batch(results):
+    """Encode batch results as one JSON array line, in request order, with per-item errors."""
+    return json.dumps([
+        result if result is not None else "ERROR: No response from device"
+        for result in results
+    ], separators=(",", ":"))
+
+
+def format_cache_stats(esp_device):
+    return " ".join(f"{key}={value}" for key, value in get_cache(esp_device).stats().items())
+
+
+def parse_message(message):
+    """Split a server message into (tag, deadline_ms, command, data).
+
+    A message may start with an optional "#<id>" tag; the reply to a tagged
+    message carries the same tag so the server can match out-of-order replies.
+    An optional "@<ms>" after it gives the milliseconds, from receipt, within
+    which the server still wants an answer.
+    """
+    tag = None
+    deadline_ms = None
+    if message.startswith("#"):
+        tag, _, message = message.partition(" ")
+    if message.startswith("@"):
+        budget, _, rest = message.partition(" ")
+        if budget[1:].isdigit():
+            deadline_ms, message = int(budget[1:]), rest
+
+    # Split the message into command and optional data
+    parts = message.split(" ", 1)
+    command = parts[0]
+    data = parts[1] if len(parts) > 1 else None
+    return tag, deadline_ms, command, data
+
+
+def run_command(command_function_map, command, data, received_at=None, deadline_ms=None, tag=None):
+    """Execute one server command and return the reply line (without newline).
+
+    With deadline_ms, device commands are cut short so the reply is ready that
+    long after received_at. A device command that times out turns the reply
+    into "ERROR: Timeout command=<device command> timeout_ms=<n>". tag, the
+    message's "#<id>", is handed to the commands in TAGGED_COMMANDS.
+    """
+    # Validate the command
+    if command not in command_function_map:
+        logger.warning(f"Invalid command received: {command}")
+        METRICS.increment("errors", "invalid")
+        return f"ERROR: Invalid command '{command}'"
+
+    if received_at is not None:
+        METRICS.observe(command, "dispatch", time.perf_counter() - received_at)
+    METRICS.increment("commands", command)
+    deadline = None
+    if deadline_ms is not None:
+        elapsed = time.perf_counter() - received_at if received_at is not None else 0
+        deadline = time.monotonic() + deadline_ms / 1000 - elapsed
+    try:
+        with METRICS.in_flight(command), request_context(deadline) as context, diagnostics.profiled():
+            # Execute the corresponding function and get the result
+            if command in TAGGED_COMMANDS and data:
+                result = command_function_map[command](data, tag)
+            elif command in DATA_COMMANDS and data:
+                result = command_function_map[command](data)
+            else:
+                result = command_function_map[command]()
+
+        # Helpers report failure as None, or False for yes/no commands such as logout
+        if context.timed_out and (result is None or result is False):
+            device_command, timeout = context.timed_out
+            logger.warning(f"Command '{command}' timed out waiting for {device_command}.")
+            METRICS.increment("errors", command)
+            return f"ERROR: Timeout command={device_command} timeout_ms={int(timeout * 1000)}"
+        logger.info(f"Command '{command}' executed. Result: {result}")
+        if result is None:
+            METRICS.increment("errors", command)
+        # Binary-protocol batches come back already encoded
+        return result if isinstance(result, (str, bytes)) else str(result)
+    except SchedulerBusy as e:
+        # Backpressure: the server should slow down and retry rather than queue more
+        logger.warning(f"Rejected command '{command}': {e}")
+        return "ERROR: Busy"
+    except RequestExpired as e:
+        logger.warning(f"Dropped command '{command}': {e}")
+        METRICS.increment("errors", command)
+        return "ERROR: Expired"
+    except Exception as e:
+        logger.error(f"Error executing command '{command}': {e}")
+        METRICS.increment("errors", command)
+        return f"ERROR: Failed to execute command '{command}'"
+
+
+def metrics_label(command_function_map, command):
+    # Unknown names share one label so a misbehaving peer cannot grow the metric set
+    return command if command in command_function_map else "invalid"
+
+
+def format_reply(tag, response):
+    return f"{tag} {response}\n" if tag else f"{response}\n"
+
+
+def encode_result(tag, result, binary):
+    reply = encode_reply(tag, result) if binary else format_reply(tag, result).encode('utf-8')
+    if diagnostics.tracer:
+        # Traced without the length prefix, like the frames read from the server
+        frame = reply[LENGTH_HEADER_SIZE:] if binary else reply
+        diagnostics.tracer.record(diagnostics.SERVER_TX | (diagnostics.BINARY if binary else 0), frame)
+    return reply
+
+
+def switch_protocol(data, parser):
+    """Handle the server's "proto <name>" request; returns the reply and whether the link is now binary.
+
+    Backends that never ask keep the text protocol. The reply still goes out as
+    text; every frame after it, in both directions, is binary.
+    """
+    if data == "binary" and BINARY_PROTOCOL_ENABLED:
+        parser.length_prefixed = True
+        logger.info("Server link switched to the binary protocol.")
+        return "OK", True
+    return f"ERROR: Unsupported protocol '{data}'", False
+
+
+def decode_message(frame, binary):
+    """Decode one server frame into (tag, deadline_ms, command, data); None for an empty text line."""
+    if diagnostics.tracer:
+        diagnostics.tracer.record(diagnostics.SERVER_RX | (diagnostics.BINARY if binary else 0), frame)
+    if binary:
+        tag, deadline_ms, command, data = decode_request(frame)
+        logger.debug(f"Received binary request: {command} {tag or ''}")
+        return tag, deadline_ms, command, data
+    message = frame.decode('utf-8', errors="replace").strip()
+    if not message:
+        return None
+    logger.info(f"Received message from server: {message}")
+    return parse_message(message)
+
+
+def handle_server_commands(client_socket, esp_device, frame_reader=None):
+    command_maps = {False: build_command_map(esp_device), True: build_command_map(esp_device, binary=True)}
+    # Reuse the handshake reader so commands that arrived with VALIDATED are not lost
+    frame_reader = frame_reader or SocketFrameReader(client_socket)
+    binary = False
+
     try:
         while True:
             # Receive command from the socket server
-            message = client_socket.recv(1024).decode('utf-8').strip()  # Adjust buffer size as needed
-            logger.info(f"Received message from server: {message}")
-
-            # Split the message into command and optional data
-            parts = message.split(" ", 1)
-            command = parts[0]
-            data = parts[1] if len(parts) > 1 else None
-
-            # Validate the command
-            if command not in command_function_map:
-                logger.warning(f"Invalid command received: {command}")
-                client_socket.sendall(f"ERROR: Invalid command '{command}'\n".encode('utf-8'))
+            frame = frame_reader.read_frame()
+            if frame is None:
+                logger.info("Server closed the connection.")
+                break
+            received_at = time.perf_counter()
+            try:
+                message = decode_message(frame, binary)
+            except ProtocolError as e:
+                logger.warning(f"Undecodable request from server: {e}")
+                client_socket.sendall(encode_reply(e.tag, f"ERROR: Invalid command payload: {e}"))
+                continue
+            if message is None:
                 continue
+            tag, deadline_ms, command, data = message
 
-            try:
-                # Execute the corresponding function and get the result
-                if ("setauthnft" in command or "setreqnft" in command or "signauthmsg" in command or "signreqmsg" in command) and data:
-                    result = command_function_map[command](data)
-                else:
-                    result = command_function_map[command]()
-                
-                logger.info(f"Command '{command}' executed. Result: {result}")
+            if command == "proto" and not binary:
+                result, binary = switch_protocol(data, frame_reader.parser)
+                client_socket.sendall(format_reply(tag, result).encode('utf-8'))
+                continue
 
-                # Send the result back to the socket server with a newline character
-                client_socket.sendall((result + "\n").encode('utf-8') if isinstance(result, str) else (str(result) + "\n").encode('utf-8'))
-                logger.info(f"Sent result back to server: {result}")
-            except Exception as e:
-                logger.error(f"Error executing command '{command}': {e}")
-                client_socket.sendall(f"ERROR: Failed to execute command '{command}'\n".encode('utf-8'))
+            command_function_map = command_maps[binary]
+            result = run_command(command_function_map, command, data, received_at, deadline_ms, tag)
 
+            # Send the result back to the socket server
+            label = metrics_label(command_function_map, command)
+            with METRICS.timer(label, "socket_write"):
+                client_socket.sendall(encode_result(tag, result, binary))
+            METRICS.observe(label, "total", time.perf_counter() - received_at)
+            logger.info(f"Sent result back to server: {result}")
+
+    except FrameTooLarge as e:
+        logger.error(f"Dropping server connection: {e}")
     except Exception as e:
         logger.error(f"Error while handling server commands: {e}")
     finally:
@@ -66,20 +306,313 @@ def handle_server_commands(client_socket, esp_device):
         logger.info("Socket connection closed.")
 
 
+async def handle_server_commands_async(reader, writer, esp_device, max_concurrency=None, parser=None):
+    """Serve server commands concurrently over asyncio streams.
+
+    Each command is dispatched as its own task as soon as it is read, so a slow
+    signature no longer holds up the commands queued behind it. Device work is
+    bounded by the AsyncESP32Device concurrency limit. Tagged replies are written
+    as soon as they complete; untagged replies keep the order the commands
+    arrived in, since the server has no other way to pair them.
+    """
+    import asyncio
+    async_device = AsyncESP32Device(esp_device, max_concurrency)
+    command_maps = {False: build_command_map(esp_device), True: build_command_map(esp_device, binary=True)}
+    parser = parser or FrameParser()
+    write_lock = asyncio.Lock()
+    tasks = set()
+    previous_untagged = None
+    binary = False
+
+    async def process(message, previous, received_at, binary):
+        tag, deadline_ms, command, data = message
+        command_function_map = command_maps[binary]
+        # Answer cached reads on the event loop instead of queueing behind device work
+        result = cached_response(esp_device, CACHED_SERVER_COMMANDS.get(command))
+        if result is not None:
+            logger.info(f"Command '{command}' served from cache. Result: {result}")
+        else:
+            result = await async_device.call(run_command, command_function_map, command, data, received_at, deadline_ms, tag)
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with write_lock:
+            write_start = time.perf_counter()
+            writer.write(encode_result(tag, result, binary))
+            await writer.drain()
+        label = metrics_label(command_function_map, command)
+        METRICS.observe(label, "socket_write", time.perf_counter() - write_start)
+        METRICS.observe(label, "total", time.perf_counter() - received_at)
+        logger.info(f"Sent result back to server: {result}")
+
+    try:
+        while True:
+            # Stop reading once enough work is queued so a flood cannot grow memory without bound
+            while len(tasks) >= MAX_PENDING_COMMANDS:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+            frame = parser.next_frame()
+            if frame is None:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                parser.feed(data)
+                continue
+            received_at = time.perf_counter()
+            try:
+                message = decode_message(frame, binary)
+            except ProtocolError as e:
+                logger.warning(f"Undecodable request from server: {e}")
+                async with write_lock:
+                    writer.write(encode_reply(e.tag, f"ERROR: Invalid command payload: {e}"))
+                continue
+            if message is None:
+                continue
+            tag, _, command, data = message
+
+            if command == "proto" and not binary:
+                # Let replies already in flight go out as text before the switch
+                if tasks:
+                    await asyncio.wait(tasks)
+                result, binary = switch_protocol(data, parser)
+                writer.write(format_reply(tag, result).encode('utf-8'))
+                await writer.drain()
+                continue
+
+            tagged = tag is not None
+            task = asyncio.create_task(process(message, None if tagged else previous_untagged, received_at, binary))
+            if not tagged:
+                previous_untagged = task
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
+    except FrameTooLarge as e:
+        logger.error(f"Dropping server connection: {e}")
+    except Exception as e:
+        logger.error(f"Error while handling server commands: {e}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        async_device.close()
+        writer.close()
+        logger.info("Socket connection closed.")
+
+
+async def serve_server_link_async(client_socket, esp_device, frame_reader=None):
+    """Run the asyncio command loop over an already connected and validated socket."""
+    import asyncio
+    reader, writer = await asyncio.open_connection(sock=client_socket)
+    parser = frame_reader.parser if frame_reader else None
+    await handle_server_commands_async(reader, writer, esp_device, parser=parser)
+
+
+def run_server_session(client_socket, esp_device, requestPubAddr, authpubAddr):
+    """Register the wallet's addresses with the server, then serve its commands until the link closes."""
+    try:
+        # Send addresses to server
+        message = f"{requestPubAddr},{authpubAddr}\n"
+        client_socket.sendall(message.encode('utf-8'))
+        logger.info(f"Sent to server: {message}")
+
+        # Wait for server validation
+        frame_reader = SocketFrameReader(client_socket)
+        while True:
+            response = frame_reader.read_line()
+            if response is None:
+                logger.warning("Server closed the connection during validation.")
+                break
+            if response == "VALIDATED":
+                logger.info("Addresses validated by server. Starting communication...")
+                if ASYNC_SERVER_LINK:
+                    # Imported here so the default threaded link never pays for asyncio
+                    import asyncio
+                    asyncio.run(serve_server_link_async(client_socket, esp_device, frame_reader))
+                else:
+                    handle_server_commands(client_socket, esp_device, frame_reader)
+                break
+            elif response == "RETRY":
+                logger.warning("Server requested retry. Waiting for further instructions...")
+            else:
+                logger.warning(f"Server response: {response}. Authentication failed.")
+                break
+    except Exception as e:
+        logger.error(f"Communication error: {e}")
+    finally:
+        client_socket.close()
+
+
+def open_device(port):
+    """Open the wallet on port, in a worker process when WORKER_PROCESSES is set."""
+    if WORKER_PROCESSES:
+        # Imported here so the default in-process mode never loads multiprocessing
+        from workers import WorkerDevice
+        return WorkerDevice(port)
+    return ESP32Device(port)
+
+
+def run_multi_wallet():
+    """Drive every attached wallet from this process, one server session per pool of identical wallets."""
+    manager = DeviceManager()
+    if not manager.open_all(wait_for_devices(), negotiate_framing=USE_FRAMED_PROTOCOL,
+                            device_factory=open_device):
+        logger.error("No wallet could be opened.")
+        return
+
+    # Prompt user for the password (GUI by default, or a headless source)
+    password = read_password(PASSWORD_SOURCE)
+    if not password:
+        logger.info("No password entered. Exiting.")
+        manager.close()
+        sys.exit(0)
+
+    if not manager.authenticate(password):
+        logger.warning("Authentication failed on every wallet.")
+        manager.close()
+        return
+
+    sessions = []
+    schedulers = []
+    for pool in manager.pools():
+        logger.info(f"Serving wallets {pool.port} as {pool.request_addr},{pool.auth_addr}")
+        scheduler = FairScheduler(pool)
+        schedulers.append(scheduler)
+        for n in range(SERVER_SESSIONS):
+            link = scheduler.channel(f"session-{n}")
+            client_socket = ConnectSocketServer(remote_server=REMOTE_SERVER, first=n)
+            if not client_socket:
+                logger.error(f"Could not connect to the socket server for wallets {pool.port}.")
+                continue
+            session = threading.Thread(
+                target=run_server_session,
+                args=(client_socket, link, pool.request_addr, pool.auth_addr),
+                name=f"ServerSession-{link.port}",
+            )
+            session.start()
+            sessions.append(session)
+
+    for session in sessions:
+        session.join()
+
+    for scheduler in schedulers:
+        scheduler.close()
+    manager.close()
+    logger.info("ESP32 device connections closed.")
+
+
+def run_supervised():
+    """Serve one wallet under a Supervisor, recovering from serial and socket failures."""
+    # Wait for the SecureWallet (ESP32 device) to be connected
+    wait_for_device()
+
+    # Prompt user for the password (GUI by default, or a headless source)
+    password = read_password(PASSWORD_SOURCE)
+    if not password:
+        logger.info("No password entered. Exiting.")
+        sys.exit(0)
+
+    supervisor = Supervisor(SecretPassword(password), REMOTE_SERVER, run_server_session,
+                            negotiate_framing=USE_FRAMED_PROTOCOL, sessions=SERVER_SESSIONS,
+                            device_factory=open_device)
+    del password
+    signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+    supervisor.run()
+    logger.info("ESP32 device connection closed.")
+
+
+# Where each config.py setting lands
+CONFIG_TARGETS = {
+    "remote_server": (sys.modules[__name__], "REMOTE_SERVER"),
+    "server_sessions": (sys.modules[__name__], "SERVER_SESSIONS"),
+    "password_source": (sys.modules[__name__], "PASSWORD_SOURCE"),
+    "framed": (sys.modules[__name__], "USE_FRAMED_PROTOCOL"),
+    "async_link": (sys.modules[__name__], "ASYNC_SERVER_LINK"),
+    "worker_processes": (sys.modules[__name__], "WORKER_PROCESSES"),
+    "binary_protocol": (sys.modules[__name__], "BINARY_PROTOCOL_ENABLED"),
+    "supervised": (sys.modules[__name__], "SUPERVISED"),
+    "multi_wallet": (sys.modules[__name__], "MULTI_WALLET"),
+    "metrics_port": (sys.modules[__name__], "METRICS_PORT"),
+    "diagnostics_socket": (diagnostics, "CONTROL_SOCKET"),
+    "trace_traffic": (diagnostics, "TRACE_ON_START"),
+    "trace_file": (diagnostics, "TRACE_FILE"),
+    "trace_max_bytes": (diagnostics, "TRACE_MAX_BYTES"),
+    "known_wallets_file": (fingerprint, "KNOWN_WALLETS_FILE"),
+    "probe_timeout": (fingerprint, "PROBE_TIMEOUT"),
+    "baud_rate": (command, "BAUD_RATE"),
+    "target_baud_rate": (command, "TARGET_BAUD_RATE"),
+    "read_timeout": (command, "READ_TIMEOUT"),
+    "inter_byte_timeout": (command, "INTER_BYTE_TIMEOUT"),
+    "low_latency": (command, "LOW_LATENCY"),
+    "rx_buffer_size": (command, "RX_BUFFER_SIZE"),
+    "tx_buffer_size": (command, "TX_BUFFER_SIZE"),
+    "command_timeout": (command, "COMMAND_TIMEOUT"),
+    "command_timeouts": (command, "COMMAND_TIMEOUTS"),
+    "sign_cache": (command, "SIGN_CACHE_ENABLED"),
+    "sign_cache_size": (command, "SIGN_CACHE_SIZE"),
+    "sign_cache_ttl": (command, "SIGN_CACHE_TTL"),
+    "nft_chunk_size": (command, "NFT_CHUNK_SIZE"),
+    "nft_chunk_window": (command, "NFT_CHUNK_WINDOW"),
+}
+
+
+def configure(settings):
+    """Apply settings from config.load_config() over the module defaults."""
+    for name, value in settings.items():
+        module, attribute = CONFIG_TARGETS[name]
+        current = getattr(module, attribute)
+        if isinstance(current, dict):
+            # Tables such as COMMAND_TIMEOUTS are extended, not replaced
+            value = {**current, **value}
+        setattr(module, attribute, value)
+    if settings:
+        logger.info(f"Configuration: {', '.join(f'{name}={value}' for name, value in sorted(settings.items()))}")
+
+
 # ----- Main Application Flow -----
-def main():
+def main(argv=None):
+    try:
+        configure(config.load_config(sys.argv[1:] if argv is None else argv))
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(2)
+
+    if PASSWORD_SOURCE != "gui":
+        set_notifications_enabled(False)
+
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+        logger.info(f"Serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+
+    # Profiling and traffic capture can be switched on later without a restart
+    diagnostics.install_signal_handlers()
+    if diagnostics.CONTROL_SOCKET:
+        diagnostics.serve_control_socket()
+    if diagnostics.TRACE_ON_START:
+        diagnostics.start_trace()
+
+    if MULTI_WALLET:
+        run_multi_wallet()
+        return
+    if SUPERVISED:
+        run_supervised()
+        return
+
     # Wait for the SecureWallet (ESP32 device) to be connected
     port = wait_for_device()
     if not port:
         logger.error("Device not found.")
         return
 
-    esp_device = ESP32Device(port)
-    remote_server = "127.0.0.1:10080" 
-    client_socket = ConnectSocketServer(remote_server=remote_server)
+    try:
+        esp_device = open_device(port)
+    except Exception:
+        sys.exit(1)
+    if USE_FRAMED_PROTOCOL:
+        esp_device.negotiate_framing()
+    client_socket = ConnectSocketServer(remote_server=REMOTE_SERVER)
     #print(client_socket)
-    # Prompt user for the password using a GUI
-    password = prompt_user_password()
+    # Prompt user for the password (GUI by default, or a headless source)
+    password = read_password(PASSWORD_SOURCE)
     if not password:
         logger.info("No password entered. Exiting.")
         esp_device.close()
@@ -89,35 +622,15 @@ def main():
         logger.info("Authentication successful.")
 
         # Start wallet monitor
-        #threading.Thread(target=monitor_wallet_status, args=(port, esp_device, client_socket), daemon=True).start()
+        threading.Thread(target=monitor_wallet_status, args=(port, esp_device, client_socket), daemon=True).start()
 
         # Get public addresses
         requestPubAddr = GetReqAddr(esp_device)
         authpubAddr = GetAuthAddr(esp_device)
+        remember_wallet(port, requestPubAddr, authpubAddr)
 
         if client_socket:
-            try:
-                # Send addresses to server
-                message = f"{requestPubAddr},{authpubAddr}\n"
-                client_socket.sendall(message.encode('utf-8'))
-                logger.info(f"Sent to server: {message}")
-
-                # Wait for server validation
-                while True:
-                    response = client_socket.recv(1024).decode('utf-8')
-                    if response.strip() == "VALIDATED":
-                        logger.info("Addresses validated by server. Starting communication...")
-                        handle_server_commands(client_socket, esp_device)
-                        break
-                    elif response.strip() == "RETRY":
-                        logger.warning("Server requested retry. Waiting for further instructions...")
-                    else:
-                        logger.warning(f"Server response: {response}. Authentication failed.")
-                        break
-            except Exception as e:
-                logger.error(f"Communication error: {e}")
-            finally:
-                client_socket.close()
+            run_server_session(client_socket, esp_device, requestPubAddr, authpubAddr)
         else:
             logger.error("Could not connect to the socket server.")
     else:
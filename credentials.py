@@ -0,0 +1,50 @@
+import getpass
+import os
+import sys
+from logger import setup_logger
+
+logger = setup_logger(log_file="logs/connServer.log", log_level="DEBUG")
+
+# keyring entry consulted by the "keyring" password source
+KEYRING_SERVICE = "SecureWallet"
+KEYRING_USERNAME = "wallet"
+
+PASSWORD_SOURCES = ("gui", "stdin", "fd:<n>", "keyring")
+
+
+def read_password(source="gui"):
+    """Obtain the wallet password from the configured source; None if none was given.
+
+    Sources:
+        gui      - DearPyGui prompt (imported only when used)
+        stdin    - interactive prompt on a terminal, otherwise the first line of stdin
+        fd:<n>   - first line read from an inherited file descriptor, which is then closed
+        keyring  - the KEYRING_SERVICE/KEYRING_USERNAME entry of the system keyring
+    """
+    if source == "gui":
+        # DearPyGui and OpenGL are slow to import and missing on headless hosts
+        from gui import prompt_user_password
+        return prompt_user_password()
+
+    if source == "stdin":
+        if sys.stdin.isatty():
+            return getpass.getpass("Enter Wallet Password: ") or None
+        return sys.stdin.readline().rstrip("\r\n") or None
+
+    if source.startswith("fd:"):
+        try:
+            fd = int(source[3:])
+        except ValueError:
+            raise ValueError(f"Invalid password source '{source}'; expected fd:<number>")
+        with os.fdopen(fd, "r", encoding="utf-8") as password_file:
+            return password_file.readline().rstrip("\r\n") or None
+
+    if source == "keyring":
+        try:
+            import keyring
+        except ImportError:
+            logger.error("The keyring password source needs the 'keyring' package.")
+            return None
+        return keyring.get_password(KEYRING_SERVICE, KEYRING_USERNAME)
+
+    raise ValueError(f"Unknown password source '{source}'; expected one of {', '.join(PASSWORD_SOURCES)}")
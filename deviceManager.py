@@ -0,0 +1,218 @@
+import concurrent.futures
+import queue
+import threading
+from command import COMMAND_TIMEOUT, ESP32Device, GetAuthAddr, GetReqAddr, authenticate_device, command_name, invalidate_cache
+from fingerprint import remember_wallet
+from heartbeat import HeartbeatMonitor
+from logger import setup_logger
+
+logger = setup_logger(log_file="logs/securewalletOpr.log", log_level="DEBUG")
+
+# Commands that change wallet state and must reach every wallet in a pool
+BROADCAST_COMMANDS = ("PASS", "LOGOUT", "SET_NFT_REQ", "SET_NFT_AUTH", "REMOVE_NFT_REQ", "REMOVE_NFT_AUTH")
+# Consecutive unanswered commands before a wallet is taken out of rotation
+MAX_CONSECUTIVE_FAILURES = 3
+
+
+class ManagedDevice:
+    """An ESP32Device with its own command queue, worker threads and health state."""
+
+    def __init__(self, device):
+        self.device = device
+        self.port = device.port
+        self.request_addr = None
+        self.auth_addr = None
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.completed = 0
+        self._queue = queue.Queue()
+        self._in_flight = 0
+        self._state_lock = threading.Lock()
+        # One worker per command the device can have in flight keeps framed firmware pipelined
+        self._workers = [
+            threading.Thread(target=self._worker_loop, name=f"WalletWorker-{self.port}-{i}", daemon=True)
+            for i in range(device.concurrency)
+        ]
+        for worker in self._workers:
+            worker.start()
+        self.heartbeat = HeartbeatMonitor(device, on_down=self._heartbeat_down, on_up=self._heartbeat_up).start()
+
+    @property
+    def load(self):
+        """Commands queued for or running on this wallet."""
+        return self._queue.qsize() + self._in_flight
+
+    def submit(self, command, timeout=COMMAND_TIMEOUT, expect=None):
+        """Queue a command for this wallet and return a Future for its reply."""
+        return self._submit(command_name(command), self.device.request, command, timeout, expect)
+
+    def submit_call(self, func, *args):
+        """Queue func(device, *args), a multi-command exchange such as an upload, as one job."""
+        return self._submit(func.__name__, func, self.device, *args)
+
+    def _submit(self, label, func, *args):
+        future = concurrent.futures.Future()
+        self._queue.put((label, func, args, future))
+        return future
+
+    def _worker_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            label, func, args, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self._state_lock:
+                self._in_flight += 1
+            try:
+                response = func(*args)
+            except Exception as e:
+                logger.error(f"Wallet on {self.port} failed to run {label}: {e}")
+                self._record(False)
+                future.set_exception(e)
+            else:
+                self._record(bool(response))
+                future.set_result(response)
+            finally:
+                with self._state_lock:
+                    self._in_flight -= 1
+
+    def _record(self, answered):
+        with self._state_lock:
+            if answered:
+                self.completed += 1
+                self.consecutive_failures = 0
+                if not self.healthy:
+                    logger.info(f"Wallet on {self.port} is responding again.")
+                self.healthy = True
+                return
+            self.consecutive_failures += 1
+            if self.healthy and self.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                self.healthy = False
+                logger.warning(f"Wallet on {self.port} missed {self.consecutive_failures} replies; taking it out of rotation.")
+
+    def _heartbeat_down(self):
+        with self._state_lock:
+            self.healthy = False
+        logger.warning(f"Wallet on {self.port} stopped answering heartbeats; taking it out of rotation.")
+
+    def _heartbeat_up(self):
+        with self._state_lock:
+            self.healthy = True
+            self.consecutive_failures = 0
+
+    def close(self):
+        self.heartbeat.stop()
+        for _ in self._workers:
+            self._queue.put(None)
+        self.device.close()
+
+
+class DevicePool:
+    """Several wallets holding the same keys, driven as one device.
+
+    DevicePool offers the same request() interface as ESP32Device, so the
+    command.py helpers and the server loops work on it unchanged. Signing and
+    reads go to the least loaded healthy wallet; commands that change wallet
+    state are broadcast so every member stays identical.
+    """
+
+    framed = False
+
+    def __init__(self, members):
+        self.members = list(members)
+        self.port = ",".join(member.port for member in self.members)
+        self.request_addr = self.members[0].request_addr
+        self.auth_addr = self.members[0].auth_addr
+        # The pool has its own response cache; drop it whenever any member resets
+        for member in self.members:
+            member.device.add_reset_listener(lambda: invalidate_cache(self))
+
+    @property
+    def concurrency(self):
+        return sum(member.device.concurrency for member in self.members)
+
+    def select(self):
+        """Pick the healthy wallet with the shortest queue, falling back to any wallet."""
+        candidates = [member for member in self.members if member.healthy] or self.members
+        return min(candidates, key=lambda member: member.load)
+
+    def request(self, command, timeout=COMMAND_TIMEOUT, expect=None):
+        if command.split(" ", 1)[0] in BROADCAST_COMMANDS:
+            futures = [member.submit(command, timeout, expect) for member in self.members]
+            responses = [future.result() for future in futures]
+            if len(set(responses)) > 1:
+                logger.warning(f"Wallets in pool {self.port} disagree on {command.split(' ', 1)[0]}: {responses}")
+            return responses[0]
+        return self.select().submit(command, timeout, expect).result()
+
+    def broadcast(self, func, *args):
+        """Run func(wallet, *args) on every member through its queue; returns the results in member order."""
+        futures = [member.submit_call(func, *args) for member in self.members]
+        return [future.result() for future in futures]
+
+    def request_many(self, commands, timeout=COMMAND_TIMEOUT, window=None):
+        """Spread a batch over the pool's wallets and return the replies in order.
+
+        window is accepted for parity with ESP32Device; each wallet's queue already bounds its load.
+        """
+        futures = [self.select().submit(command, timeout) for command in commands]
+        responses = []
+        for future in futures:
+            try:
+                responses.append(future.result())
+            except Exception:
+                responses.append("")
+        return responses
+
+
+class DeviceManager:
+    """Opens every attached SecureWallet and groups them into pools by their addresses."""
+
+    def __init__(self):
+        self.devices = []
+
+    def open_all(self, ports, negotiate_framing=False, device_factory=ESP32Device):
+        for port in ports:
+            try:
+                device = device_factory(port)
+                if negotiate_framing:
+                    device.negotiate_framing()
+                self.devices.append(ManagedDevice(device))
+            except Exception as e:
+                logger.error(f"Skipping wallet on {port}: {e}")
+        return self.devices
+
+    def authenticate(self, password):
+        """Authenticate all wallets in parallel; those that reject the password are closed and dropped."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.devices), 1)) as executor:
+            results = list(executor.map(lambda member: self._authenticate(member, password), self.devices))
+
+        for member, ok in zip(list(self.devices), results):
+            if not ok:
+                logger.warning(f"Authentication failed for wallet on {member.port}; dropping it.")
+                member.close()
+                self.devices.remove(member)
+        return self.devices
+
+    @staticmethod
+    def _authenticate(member, password):
+        if not authenticate_device(member.device, password):
+            return False
+        member.request_addr = GetReqAddr(member.device)
+        member.auth_addr = GetAuthAddr(member.device)
+        remember_wallet(member.port, member.request_addr, member.auth_addr)
+        return True
+
+    def pools(self):
+        """Group authenticated wallets that share request and auth addresses into DevicePools."""
+        groups = {}
+        for member in self.devices:
+            groups.setdefault((member.request_addr, member.auth_addr), []).append(member)
+        return [DevicePool(members) for members in groups.values()]
+
+    def close(self):
+        for member in self.devices:
+            member.close()
+        self.devices = []
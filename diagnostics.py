@@ -0,0 +1,404 @@
+"""Profiling and traffic capture that can be switched on in a running client.
+
+    kill -USR1 <pid>    start or stop profiling (cProfile and tracemalloc)
+    kill -USR2 <pid>    start or stop the traffic trace
+
+With CONTROL_SOCKET set, the same switches are available over a local Unix
+socket, one command per line: "profile on|off", "trace on|off" or "status".
+
+Profiling covers server commands (connServer.run_command) and the wallet's
+serial I/O; each covered section runs under its own thread's cProfile (from
+Python 3.12, one profiler covers every thread for the whole session) and is
+merged into one pstats file in DIAGNOSTICS_DIR when profiling stops, next to
+the top tracemalloc allocation sites. The traffic trace records every serial
+line and server frame, with secrets and signatures masked, to a rotating
+binary file that benchmark.py --workload can replay. While both are off the
+hooks cost one attribute check.
+"""
+import contextlib
+import json
+import os
+import re
+import signal
+import struct
+import sys
+import threading
+import time
+from logger import setup_logger
+
+logger = setup_logger(log_file="logs/connServer.log", log_level="DEBUG")
+
+# Where profiles and allocation reports are written
+DIAGNOSTICS_DIR = "logs"
+# Unix socket accepting "profile on|off", "trace on|off" and "status"; None disables it
+CONTROL_SOCKET = None
+# Start the traffic trace as soon as the client starts
+TRACE_ON_START = False
+TRACE_FILE = os.path.join("logs", "traffic.trace")
+# Size at which the trace rotates to TRACE_FILE.1, keeping TRACE_BACKUPS old files
+TRACE_MAX_BYTES = 16 * 1024 * 1024
+TRACE_BACKUPS = 3
+# Stack frames tracemalloc keeps per allocation, and allocation sites listed in the report
+TRACEMALLOC_FRAMES = 5
+TRACEMALLOC_TOP = 25
+
+# Trace file layout: TRACE_MAGIC, then records of TRACE_RECORD (unix time, kind, length) and the payload
+TRACE_MAGIC = b"SWTRACE\x01"
+TRACE_RECORD = struct.Struct(">dBI")
+SERIAL_TX = 1
+SERIAL_RX = 2
+SERVER_RX = 3
+SERVER_TX = 4
+# Kind flag: the frame uses the binary server protocol (binproto.py)
+BINARY = 0x80
+
+# Commands whose arguments are masked in the trace, device and server names alike
+REDACTED_COMMANDS = {
+    "PASS", "SET_NFT_REQ", "SET_NFT_AUTH", "NFT_CHUNK", "SIGN_MSG_REQ", "SIGN_MSG_AUTH",
+    "setreqnft", "setauthnft", "signreqmsg", "signauthmsg", "signreqmsg_batch", "signauthmsg_batch",
+}
+# Replies kept as they are; anything else (signatures, addresses, NFTs) is masked
+KEPT_REPLIES = ("ERROR", "OK", "READY", "ACK", "STATUS", "PASSWORD_OK", "FAIL", "Logged out",
+                "Secure Wallet Starting", "VALIDATED", "RETRY")
+MASK = "*"
+# Leading "#<tag> " and "@<ms> " of a line, which are kept
+LINE_PREFIX = re.compile(r"^((?:[#@]\S*\s+)*)(.*)$", re.DOTALL)
+
+# The active TraceWriter; hooks test this before doing any work
+tracer = None
+# From Python 3.12 cProfile runs on sys.monitoring: one profiler at a time per
+# interpreter, seeing every thread, so a single profiler covers the whole session
+SHARED_PROFILER = sys.version_info >= (3, 12)
+# Seconds stop_profiling() waits for sections still running before leaving them out
+PROFILE_STOP_WAIT = 5
+
+# Profiles of the current profiling session, one per thread (a single one with SHARED_PROFILER); None while off
+_profile_session = None
+# Profiles whose thread is inside a section right now
+_active_profiles = set()
+_profile_lock = threading.Lock()
+_profile_idle = threading.Condition(_profile_lock)
+_local = threading.local()
+_not_profiling = contextlib.nullcontext()
+
+
+# ----- Profiling -----
+
+class _ProfiledSection:
+    """Profile the enclosed code with this thread's profiler; nested sections fold into the outermost."""
+
+    def __enter__(self):
+        import cProfile
+        self.profile = None
+        with _profile_lock:
+            session = _profile_session
+            if session is None or getattr(_local, "active", False):
+                return self
+            if getattr(_local, "session", None) is not session:
+                _local.session, _local.profile = session, cProfile.Profile()
+                session.append(_local.profile)
+            self.profile = _local.profile
+            _local.active = True
+            _active_profiles.add(self.profile)
+        try:
+            self.profile.enable()
+        except ValueError as e:
+            # Another profiler is active; the section runs unprofiled rather than failing
+            logger.debug(f"Section not profiled: {e}")
+            self._release()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self._release()
+
+    def _release(self):
+        with _profile_lock:
+            _local.active = False
+            _active_profiles.discard(self.profile)
+            _profile_idle.notify_all()
+        self.profile = None
+
+
+def profiled():
+    """Context manager covering a hot section; does nothing unless profiling is on."""
+    return _not_profiling if _profile_session is None or SHARED_PROFILER else _ProfiledSection()
+
+
+def start_profiling():
+    global _profile_session
+    import cProfile
+    import tracemalloc
+    with _profile_lock:
+        if _profile_session is not None:
+            return False
+        session = []
+        if SHARED_PROFILER:
+            session.append(cProfile.Profile())
+            try:
+                session[0].enable()
+            except ValueError as e:
+                logger.warning(f"Profiling not started: {e}")
+                return False
+        _profile_session = session
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    logger.info("Profiling started.")
+    return True
+
+
+def stop_profiling():
+    """Stop profiling and write the results; returns the paths written, or None if it was not on."""
+    global _profile_session
+    import pstats
+    import tracemalloc
+    with _profile_lock:
+        session, _profile_session = _profile_session, None
+        if session is None:
+            return None
+        if SHARED_PROFILER:
+            session[0].disable()
+        # Sections already under way finish with their profiler; one blocked too long is left out
+        _profile_idle.wait_for(lambda: not _active_profiles.intersection(session), PROFILE_STOP_WAIT)
+        finished = [profile for profile in session if profile not in _active_profiles]
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = pstats.Stats()
+    for profile in finished:
+        # pstats refuses a profiler that never got to run (another one was active)
+        profile.create_stats()
+        if profile.stats:
+            stats.add(profile)
+    os.makedirs(DIAGNOSTICS_DIR, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    profile_path = os.path.join(DIAGNOSTICS_DIR, f"profile-{stamp}.pstats")
+    memory_path = os.path.join(DIAGNOSTICS_DIR, f"tracemalloc-{stamp}.txt")
+    stats.dump_stats(profile_path)
+    with open(memory_path, "w", encoding="utf-8") as report:
+        for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+            report.write(f"{stat}\n")
+    logger.info(f"Profiling stopped; wrote {profile_path} and {memory_path}")
+    return profile_path, memory_path
+
+
+def profiling():
+    return _profile_session is not None
+
+
+# ----- Traffic trace -----
+
+def _mask_batch(data):
+    try:
+        messages = json.loads(data)
+        if isinstance(messages, list):
+            return json.dumps([MASK * len(str(message)) for message in messages])
+    except ValueError:
+        pass
+    return MASK * len(data)
+
+
+def _redact_line(line, request):
+    prefix, body = LINE_PREFIX.match(line.decode('utf-8', errors="replace")).groups()
+    if request:
+        verb, separator, rest = body.partition(" ")
+        if rest and verb in REDACTED_COMMANDS:
+            rest = _mask_batch(rest) if verb.endswith("_batch") else MASK * len(rest)
+        body = verb + separator + rest
+    elif not body.startswith(KEPT_REPLIES):
+        body = MASK * len(body)
+    return (prefix + body).encode('utf-8')
+
+
+def _redact_binary(frame, request):
+    import binproto
+    mask = MASK.encode()
+    if request:
+        header, payload = frame[:binproto.REQUEST_HEADER.size], frame[binproto.REQUEST_HEADER.size:]
+        if payload and binproto.OPCODES.get(header[0]) in binproto.BATCH_COMMANDS:
+            try:
+                items = binproto.decode_batch(payload)
+                payload = b"".join(binproto.ITEM_LENGTH.pack(len(item.encode())) + mask * len(item.encode())
+                                   for item in items)
+            except binproto.ProtocolError:
+                payload = mask * len(payload)
+        else:
+            payload = mask * len(payload)
+        return bytes(header) + payload
+    header, payload = frame[:binproto.REPLY_HEADER.size], frame[binproto.REPLY_HEADER.size:]
+    if header and header[0] & binproto.STATUS_MASK != binproto.STATUS_OK:
+        return bytes(frame)
+    return bytes(header) + mask * len(payload)
+
+
+def redact(kind, payload):
+    """Mask the secrets in one traced frame: passwords, NFTs, messages to sign and their signatures."""
+    request = kind & ~BINARY in (SERIAL_TX, SERVER_RX)
+    if kind & BINARY:
+        return _redact_binary(payload, request)
+    return _redact_line(payload.rstrip(b"\r\n"), request)
+
+
+class TraceWriter:
+    """Appends redacted frames to a trace file, rotating it at max_bytes."""
+
+    def __init__(self, path=None, max_bytes=None, backups=None):
+        self.path = path or TRACE_FILE
+        self.max_bytes = max_bytes or TRACE_MAX_BYTES
+        self.backups = TRACE_BACKUPS if backups is None else backups
+        self.records = 0
+        self._lock = threading.Lock()
+        self._file = self._open()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        trace_file = open(self.path, "ab")
+        if trace_file.tell() == 0:
+            trace_file.write(TRACE_MAGIC)
+        return trace_file
+
+    def record(self, kind, payload):
+        payload = redact(kind, payload)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(TRACE_RECORD.pack(time.time(), kind, len(payload)))
+            self._file.write(payload)
+            self.records += 1
+            if self._file.tell() >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{n}"):
+                os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = self._open()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def start_trace(path=None):
+    global tracer
+    if tracer is not None:
+        return False
+    tracer = TraceWriter(path)
+    logger.info(f"Traffic trace started: {tracer.path}")
+    return True
+
+
+def stop_trace():
+    """Stop the trace; returns the number of records written, or None if it was not on."""
+    global tracer
+    writer, tracer = tracer, None
+    if writer is None:
+        return None
+    writer.close()
+    logger.info(f"Traffic trace stopped after {writer.records} records: {writer.path}")
+    return writer.records
+
+
+def read_trace(path):
+    """Yield (unix time, kind, binary, payload) for each record of a trace file."""
+    with open(path, "rb") as trace_file:
+        if trace_file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a SecureWallet traffic trace")
+        while header := trace_file.read(TRACE_RECORD.size):
+            if len(header) < TRACE_RECORD.size:
+                break
+            timestamp, kind, length = TRACE_RECORD.unpack(header)
+            payload = trace_file.read(length)
+            if len(payload) < length:
+                break
+            yield timestamp, kind & ~BINARY, bool(kind & BINARY), payload
+
+
+# ----- Control -----
+
+def toggle_profiling():
+    return stop_profiling() if profiling() else start_profiling()
+
+
+def toggle_trace():
+    return stop_trace() if tracer is not None else start_trace()
+
+
+def status():
+    return {
+        "profiling": profiling(),
+        "trace": tracer.path if tracer is not None else None,
+        "trace_records": tracer.records if tracer is not None else 0,
+    }
+
+
+def control(line):
+    """Run one control command and return its reply line."""
+    words = line.split()
+    if words == ["status"]:
+        return "OK " + json.dumps(status())
+    if len(words) == 2 and words[1] in ("on", "off"):
+        what, on = words[0], words[1] == "on"
+        if what == "profile":
+            result = start_profiling() if on else stop_profiling()
+            return f"OK {result}" if result else f"OK profiling already {words[1]}"
+        if what == "trace":
+            result = start_trace() if on else stop_trace()
+            return f"OK {result}" if result is not None and result is not False else f"OK trace already {words[1]}"
+    return "ERROR: expected 'profile on|off', 'trace on|off' or 'status'"
+
+
+def install_signal_handlers():
+    """SIGUSR1 toggles profiling and SIGUSR2 the traffic trace, where the platform has them."""
+    if not hasattr(signal, "SIGUSR1"):
+        return False
+
+    def in_thread(toggle):
+        # The handler interrupts the main thread, maybe inside a section holding the locks toggle needs
+        return lambda signum, frame: threading.Thread(target=toggle, name="DiagnosticsToggle", daemon=True).start()
+
+    signal.signal(signal.SIGUSR1, in_thread(toggle_profiling))
+    signal.signal(signal.SIGUSR2, in_thread(toggle_trace))
+    return True
+
+
+def serve_control_socket(path=None):
+    """Accept control commands on a Unix socket at path (default CONTROL_SOCKET) on a daemon thread."""
+    import socket
+    path = path or CONTROL_SOCKET
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    # Only the service's own user may switch diagnostics on
+    os.chmod(path, 0o600)
+    server.listen()
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            with conn, conn.makefile("rw", encoding="utf-8", newline="\n") as stream:
+                for line in stream:
+                    try:
+                        reply = control(line)
+                    except Exception as e:
+                        reply = f"ERROR: {e}"
+                    stream.write(reply + "\n")
+                    stream.flush()
+
+    threading.Thread(target=serve, name="DiagnosticsControl", daemon=True).start()
+    logger.info(f"Diagnostics control socket listening on {path}")
+    return server
@@ -0,0 +1,185 @@
+"""Recognising SecureWallets among the serial ports by their USB identity.
+
+Ports are matched by USB vendor/product ID and serial number rather than by
+description, which most USB-serial adapters share. Ports behind generic
+USB-serial bridges, which other devices use too, and ports with unlisted IDs
+whose description looks like one are confirmed with a short GET_STATUS
+handshake; all of them are probed at once on a thread pool.
+Every wallet found is recorded in KNOWN_WALLETS_FILE, with its port, serial
+number and addresses, so a restart reattaches to it without probing.
+"""
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import serial
+import serial.tools.list_ports
+import command
+import logger
+
+Wallet_logger = logger.setup_logger("logs/securewallet.log", log_level="DEBUG")
+
+# USB IDs only an ESP32 presents itself: Espressif's native USB-Serial/JTAG and USB-OTG CDC
+WALLET_USB_IDS = {(0x303A, 0x1001), (0x303A, 0x0002)}
+# USB-serial bridges found on ESP32 boards (CP210x, CH340, CH9102, FTDI); other devices use them too
+BRIDGE_USB_IDS = {(0x10C4, 0xEA60), (0x1A86, 0x7523), (0x1A86, 0x55D4), (0x0403, 0x6001), (0x0403, 0x6015)}
+# Description hints for ports whose USB IDs are missing or not listed above (custom PIDs, other bridges)
+DESCRIPTION_HINTS = ("USB", "ESP32", "CDC")
+# Seconds the identify handshake waits for the wallet to answer
+PROBE_TIMEOUT = 1.0
+# Ports probed at the same time
+PROBE_WORKERS = 8
+# Seconds before a port that failed the handshake is probed again
+PROBE_RETRY_INTERVAL = 30
+# Wallets seen before; None keeps them in memory only
+KNOWN_WALLETS_FILE = os.path.join(os.path.expanduser("~"), ".securewallet", "known_wallets.json")
+
+_known = None
+_known_lock = threading.Lock()
+# fingerprint -> time.monotonic() of the last failed handshake
+_not_wallets = {}
+
+
+def port_fingerprint(port):
+    """Identify a port's device: "vid:pid:serial", or "vid:pid@path" / "@path" when the device reports less."""
+    if port.vid is None:
+        return f"@{port.device}"
+    usb_id = f"{port.vid:04x}:{port.pid:04x}"
+    if port.serial_number:
+        return f"{usb_id}:{port.serial_number}"
+    return f"{usb_id}@{port.device}"
+
+
+def known_wallets():
+    """The fingerprint -> record index of wallets seen before, loaded from KNOWN_WALLETS_FILE once."""
+    global _known
+    with _known_lock:
+        if _known is None:
+            _known = {}
+            if KNOWN_WALLETS_FILE:
+                try:
+                    with open(KNOWN_WALLETS_FILE, encoding="utf-8") as known_file:
+                        _known = json.load(known_file).get("wallets", {})
+                except FileNotFoundError:
+                    pass
+                except (OSError, ValueError, AttributeError) as e:
+                    Wallet_logger.warning(f"Ignoring unreadable wallet index {KNOWN_WALLETS_FILE}: {e}")
+        return _known
+
+
+def _save_known_wallets():
+    # Caller holds _known_lock. Write a new file and rename it, so a crash never leaves half an index.
+    if not KNOWN_WALLETS_FILE:
+        return
+    try:
+        os.makedirs(os.path.dirname(KNOWN_WALLETS_FILE), exist_ok=True)
+        temp_path = f"{KNOWN_WALLETS_FILE}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as known_file:
+            json.dump({"wallets": _known}, known_file, indent=2, sort_keys=True)
+        os.replace(temp_path, KNOWN_WALLETS_FILE)
+    except OSError as e:
+        Wallet_logger.warning(f"Could not save the wallet index to {KNOWN_WALLETS_FILE}: {e}")
+
+
+def remember_wallet(port, request_addr=None, auth_addr=None, ports=None):
+    """Record the wallet on port (a device path) in the index, with its addresses once they are known."""
+    ports = ports if ports is not None else serial.tools.list_ports.comports()
+    info = next((candidate for candidate in ports if candidate.device == port), None)
+    if info is None:
+        return
+    known = known_wallets()
+    fingerprint = port_fingerprint(info)
+    with _known_lock:
+        record = known.setdefault(fingerprint, {})
+        record.update({
+            "port": info.device,
+            "vid": info.vid,
+            "pid": info.pid,
+            "serial_number": info.serial_number,
+            "last_seen": round(time.time(), 3),
+        })
+        if request_addr:
+            record["request_addr"] = request_addr
+        if auth_addr:
+            record["auth_addr"] = auth_addr
+        _save_known_wallets()
+
+
+def forget_wallet(fingerprint):
+    known = known_wallets()
+    with _known_lock:
+        if known.pop(fingerprint, None) is not None:
+            _save_known_wallets()
+
+
+def probe_port(port, timeout=None):
+    """Short identify handshake: True if a SecureWallet answers GET_STATUS (or boots) on port."""
+    timeout = timeout or PROBE_TIMEOUT
+    ser = serial.Serial()
+    ser.port = port
+    ser.baudrate = command.BAUD_RATE
+    ser.timeout = timeout
+    # Leave DTR/RTS low so opening the port does not reset an ESP32 behind a bridge
+    ser.dtr = False
+    ser.rts = False
+    try:
+        ser.open()
+        ser.reset_input_buffer()
+        ser.write(b"GET_STATUS\n")
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            line = ser.readline().decode(errors="replace").strip()
+            if line.startswith("STATUS:") or command.STARTUP_BANNER in line:
+                return True
+    except (serial.SerialException, OSError) as e:
+        Wallet_logger.debug(f"Probe of {port} failed: {e}")
+    finally:
+        ser.close()
+    return False
+
+
+def identify_wallets(ports):
+    """Return the device paths of the SecureWallets among ports (ListPortInfo objects).
+
+    Known wallets come first, most recently used first, then ports with
+    wallet-only USB IDs, then bridge ports that passed the handshake. A known
+    port is trusted without a handshake only if its fingerprint includes a
+    serial number; one recognised by its path alone may now be another
+    adapter of the same type, so it is probed like any bridge port.
+    """
+    known = known_wallets()
+    found, confident, ambiguous = [], [], []
+    now = time.monotonic()
+    for port in ports:
+        fingerprint = port_fingerprint(port)
+        record = known.get(fingerprint)
+        if record is not None and (port.serial_number or (port.vid, port.pid) in WALLET_USB_IDS):
+            found.append((record.get("last_seen", 0), port))
+        elif (port.vid, port.pid) in WALLET_USB_IDS:
+            confident.append(port)
+        elif record is not None or (port.vid, port.pid) in BRIDGE_USB_IDS or any(
+                hint in (port.description or "") for hint in DESCRIPTION_HINTS):
+            if now - _not_wallets.get(fingerprint, float("-inf")) >= PROBE_RETRY_INTERVAL:
+                ambiguous.append(port)
+
+    probed = []
+    if ambiguous:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(ambiguous), PROBE_WORKERS)) as executor:
+            results = list(executor.map(lambda port: probe_port(port.device), ambiguous))
+        for port, is_wallet in zip(ambiguous, results):
+            if is_wallet:
+                _not_wallets.pop(port_fingerprint(port), None)
+                probed.append(port)
+            else:
+                _not_wallets[port_fingerprint(port)] = now
+        Wallet_logger.info(f"Probed {len(ambiguous)} port(s); {len(probed)} answered as a SecureWallet.")
+
+    # Known ports confirmed by the handshake keep their place among the known wallets
+    found += [(known[port_fingerprint(port)].get("last_seen", 0), port)
+              for port in probed if port_fingerprint(port) in known]
+    probed = [port for port in probed if port_fingerprint(port) not in known]
+    for port in confident + probed:
+        remember_wallet(port.device, ports=ports)
+    found.sort(key=lambda item: item[0], reverse=True)
+    return [port.device for _, port in found] + [port.device for port in confident + probed]
@@ -0,0 +1,136 @@
+# Largest frame a peer may send before we drop the connection
+MAX_FRAME_SIZE = 64 * 1024
+# Bytes requested from the socket per read
+RECV_SIZE = 4096
+# Size of the big-endian length header in length-prefixed mode
+LENGTH_HEADER_SIZE = 4
+
+
+class FrameTooLarge(Exception):
+    """Raised when a peer sends a frame larger than the configured limit."""
+
+
+class FrameParser:
+    """Incremental frame parser over a single reusable bytearray.
+
+    Frames are either newline-terminated lines or, with length_prefixed=True,
+    payloads preceded by a 4-byte big-endian length. Incoming bytes are received
+    straight into free space at the end of the buffer (see writable()), and a
+    frame is copied out exactly once when it is complete. Consumed bytes are
+    reclaimed by sliding the tail to the front instead of reallocating.
+    """
+
+    def __init__(self, max_frame=MAX_FRAME_SIZE, length_prefixed=False):
+        self.max_frame = max_frame
+        self.length_prefixed = length_prefixed
+        self._buf = bytearray(RECV_SIZE)
+        self._start = 0
+        self._end = 0
+        # Line mode: offset up to which the buffer is known to hold no newline
+        self._scanned = 0
+
+    def writable(self, size=RECV_SIZE):
+        """Return a memoryview over at least size bytes of free space; commit() what was filled.
+
+        Release the view (use it as a context manager) before calling any other method.
+        """
+        if len(self._buf) - self._end < size:
+            self._compact()
+            if len(self._buf) - self._end < size:
+                self._buf.extend(bytes(size - (len(self._buf) - self._end)))
+        return memoryview(self._buf)[self._end:]
+
+    def commit(self, count):
+        """Mark count bytes written into the last writable() view as received."""
+        self._end += count
+
+    def feed(self, data):
+        """Append received bytes to the buffer."""
+        with self.writable(len(data)) as view:
+            view[:len(data)] = data
+        self.commit(len(data))
+
+    def pending(self):
+        """Bytes received but not yet returned as part of a frame."""
+        return bytes(self._buf[self._start:self._end])
+
+    def next_frame(self):
+        """Return the next complete frame as bytes, or None if more data is needed."""
+        if self.length_prefixed:
+            return self._next_length_prefixed()
+        return self._next_line()
+
+    def _next_line(self):
+        newline = self._buf.find(b"\n", max(self._start, self._scanned), self._end)
+        if newline < 0:
+            self._scanned = self._end
+            if self._end - self._start > self.max_frame:
+                raise FrameTooLarge(f"Line exceeds {self.max_frame} bytes without a newline")
+            return None
+        if newline - self._start > self.max_frame:
+            raise FrameTooLarge(f"Line of {newline - self._start} bytes exceeds {self.max_frame} bytes")
+        frame = self._take(self._start, newline)
+        self._start = newline + 1
+        self._scanned = self._start
+        return frame
+
+    def _next_length_prefixed(self):
+        available = self._end - self._start
+        if available < LENGTH_HEADER_SIZE:
+            return None
+        header_end = self._start + LENGTH_HEADER_SIZE
+        length = int.from_bytes(self._buf[self._start:header_end], "big")
+        if length > self.max_frame:
+            raise FrameTooLarge(f"Frame of {length} bytes exceeds {self.max_frame} bytes")
+        if available - LENGTH_HEADER_SIZE < length:
+            return None
+        frame = self._take(header_end, header_end + length)
+        self._start = header_end + length
+        return frame
+
+    def _take(self, start, end):
+        with memoryview(self._buf) as view:
+            return bytes(view[start:end])
+
+    def _compact(self):
+        if self._start == 0:
+            return
+        remaining = self._end - self._start
+        self._buf[:remaining] = self._buf[self._start:self._end]
+        self._scanned = max(self._scanned - self._start, 0)
+        self._start = 0
+        self._end = remaining
+
+
+def encode_frame(payload, length_prefixed=False):
+    """Frame a bytes payload for sending in the given mode."""
+    if length_prefixed:
+        return len(payload).to_bytes(LENGTH_HEADER_SIZE, "big") + payload
+    return payload + b"\n"
+
+
+class SocketFrameReader:
+    """Blocking frame reader for a connected socket, built on FrameParser."""
+
+    def __init__(self, sock, parser=None):
+        self.sock = sock
+        self.parser = parser or FrameParser()
+
+    def read_frame(self):
+        """Block until a complete frame arrives; returns None once the peer closes the connection."""
+        while True:
+            frame = self.parser.next_frame()
+            if frame is not None:
+                return frame
+            with self.parser.writable() as view:
+                count = self.sock.recv_into(view, RECV_SIZE)
+            if count == 0:
+                return None
+            self.parser.commit(count)
+
+    def read_line(self):
+        """Read one newline-terminated message as a stripped str; None on EOF."""
+        frame = self.read_frame()
+        if frame is None:
+            return None
+        return frame.decode('utf-8', errors="replace").strip()
@@ -0,0 +1,110 @@
+import threading
+import time
+import logger
+from metrics import METRICS
+
+Wallet_logger = logger.setup_logger("logs/securewallet.log", log_level="DEBUG")
+
+# Seconds between liveness checks
+HEARTBEAT_INTERVAL = 2
+# Seconds to wait for a heartbeat reply
+HEARTBEAT_TIMEOUT = 1
+# Consecutive unanswered heartbeats before the wallet is declared down
+MAX_MISSED_HEARTBEATS = 3
+# Cheap status query every firmware version answers
+HEARTBEAT_COMMAND = "GET_STATUS"
+
+
+class HeartbeatMonitor:
+    """Tracks whether a wallet is alive using the connection ESP32Device already holds.
+
+    A heartbeat is only sent when the device has been silent for a whole
+    interval: any line it sends (a signature, a status report) already proves
+    it is alive, so busy wallets are never interrupted. Heartbeats go through
+    ESP32Device.request(), so they are correlated like any other command and
+    never reopen or reset the port.
+    """
+
+    def __init__(self, device, interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT,
+                 max_missed=MAX_MISSED_HEARTBEATS, on_down=None, on_up=None, command=HEARTBEAT_COMMAND):
+        self.device = device
+        self.interval = interval
+        self.timeout = timeout
+        self.max_missed = max_missed
+        self.on_down = on_down
+        self.on_up = on_up
+        self.command = command
+        self.alive = True
+        self.missed = 0
+        self.last_rtt = None
+        self.avg_rtt = None
+        self.max_rtt = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=f"Heartbeat-{self.device.port}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.interval + self.timeout + 1)
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            if time.monotonic() - self.device.last_activity < self.interval:
+                self._mark_alive()
+                continue
+            self.beat()
+
+    def beat(self):
+        """Send one heartbeat and update the wallet's state from the reply."""
+        start = time.monotonic()
+        try:
+            response = self.device.request(self.command, self.timeout)
+        except Exception as e:
+            Wallet_logger.error(f"Heartbeat to {self.device.port} failed: {e}")
+            response = ""
+        if response:
+            self._record_rtt(time.monotonic() - start)
+            self._mark_alive()
+            return True
+
+        self.missed += 1
+        METRICS.increment("heartbeat_missed", self.command)
+        if self.alive:
+            Wallet_logger.warning(f"Missed heartbeat from {self.device.port} ({self.missed}/{self.max_missed}).")
+        if self.alive and self.missed >= self.max_missed:
+            self.alive = False
+            Wallet_logger.error(f"SecureWallet on {self.device.port} is not responding.")
+            if self.on_down:
+                self.on_down()
+        return False
+
+    def _record_rtt(self, rtt):
+        METRICS.observe(self.command, "heartbeat", rtt)
+        self.last_rtt = rtt
+        self.max_rtt = rtt if self.max_rtt is None else max(self.max_rtt, rtt)
+        # Exponentially weighted, so a single slow reply does not dominate
+        self.avg_rtt = rtt if self.avg_rtt is None else 0.8 * self.avg_rtt + 0.2 * rtt
+
+    def _mark_alive(self):
+        self.missed = 0
+        if not self.alive:
+            self.alive = True
+            Wallet_logger.info(f"SecureWallet on {self.device.port} is responding again.")
+            if self.on_up:
+                self.on_up()
+
+    def stats(self):
+        def ms(value):
+            return None if value is None else round(value * 1000, 1)
+        return {
+            "alive": self.alive,
+            "missed": self.missed,
+            "last_rtt_ms": ms(self.last_rtt),
+            "avg_rtt_ms": ms(self.avg_rtt),
+            "max_rtt_ms": ms(self.max_rtt),
+        }
@@ -0,0 +1,179 @@
+import collections
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import logger
+
+Wallet_logger = logger.setup_logger("logs/securewallet.log", log_level="DEBUG")
+
+# Fallback rescan interval when no device-event source is available
+POLL_INTERVAL = 2
+# Kernel names of the USB serial devices a SecureWallet shows up as
+SERIAL_NAME_PREFIXES = ("ttyUSB", "ttyACM")
+
+# <sys/inotify.h>
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+DeviceEvent = collections.namedtuple("DeviceEvent", ["action", "port"])
+
+
+class DeviceWatcher:
+    """Reports serial ports appearing and disappearing as they happen.
+
+    On Linux the events come from udev (when pyudev is installed) or from an
+    inotify watch on /dev; elsewhere, or if neither is available, the watcher
+    falls back to comparing port lists every POLL_INTERVAL seconds. Events are
+    delivered to subscribed callbacks and can also be waited on with
+    wait_for_event().
+    """
+
+    def __init__(self, backend="auto", poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.backend = backend
+        self._events = queue.Queue()
+        self._callbacks = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._inotify_fd = None
+        # Self-pipe written by stop() so a watcher blocked in select() returns at once
+        self._wake_r = self._wake_w = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def subscribe(self, callback):
+        """Call callback(DeviceEvent) from the watcher thread for every event."""
+        self._callbacks.append(callback)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        run = self._select_backend()
+        if self.backend != "poll":
+            self._wake_r, self._wake_w = os.pipe()
+        self._thread = threading.Thread(target=run, name=f"DeviceWatcher-{self.backend}", daemon=True)
+        self._thread.start()
+        Wallet_logger.info(f"Watching for SecureWallet hot-plug events using {self.backend}.")
+
+    def stop(self):
+        self._stop.set()
+        if self._wake_w is not None:
+            os.write(self._wake_w, b"\0")
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_interval + 1)
+            self._thread = None
+        for name in ("_inotify_fd", "_wake_r", "_wake_w"):
+            fd = getattr(self, name)
+            if fd is not None:
+                os.close(fd)
+                setattr(self, name, None)
+
+    def wait_for_event(self, timeout=None):
+        """Block until the next event (or timeout) and return it, or None on timeout."""
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _emit(self, action, port):
+        event = DeviceEvent(action, port)
+        Wallet_logger.debug(f"Serial port {action}: {port}")
+        self._events.put(event)
+        for callback in self._callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                Wallet_logger.error(f"Device event callback failed: {e}")
+
+    def _select_backend(self):
+        if self.backend in ("auto", "udev") and sys.platform.startswith("linux"):
+            try:
+                import pyudev
+                self._udev_monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+                self._udev_monitor.filter_by(subsystem="tty")
+                self._udev_monitor.start()
+                self.backend = "udev"
+                return self._run_udev
+            except Exception as e:
+                if self.backend == "udev":
+                    Wallet_logger.warning(f"udev monitor unavailable ({e}); falling back.")
+        if self.backend in ("auto", "udev", "inotify") and sys.platform.startswith("linux"):
+            try:
+                self._inotify_fd = _inotify_watch("/dev", IN_CREATE | IN_DELETE)
+                self.backend = "inotify"
+                return self._run_inotify
+            except (OSError, AttributeError) as e:
+                Wallet_logger.warning(f"inotify watch on /dev unavailable ({e}); falling back to polling.")
+        self.backend = "poll"
+        return self._run_poll
+
+    def _run_udev(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._udev_monitor, self._wake_r], [], [], self.poll_interval)
+            if self._udev_monitor not in ready:
+                continue
+            device = self._udev_monitor.poll(timeout=0)
+            if device is None or not device.device_node:
+                continue
+            if device.action in ("add", "remove") and _is_serial_name(os.path.basename(device.device_node)):
+                self._emit(device.action, device.device_node)
+
+    def _run_inotify(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._inotify_fd, self._wake_r], [], [], self.poll_interval)
+            if self._inotify_fd not in ready:
+                continue
+            try:
+                data = os.read(self._inotify_fd, 4096)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+                offset += length
+                if _is_serial_name(name):
+                    self._emit("add" if mask & IN_CREATE else "remove", f"/dev/{name}")
+
+    def _run_poll(self):
+        from util import list_serial_ports
+
+        known = {port.device for port in list_serial_ports()}
+        while not self._stop.wait(self.poll_interval):
+            current = {port.device for port in list_serial_ports()}
+            for port in sorted(current - known):
+                self._emit("add", port)
+            for port in sorted(known - current):
+                self._emit("remove", port)
+            known = current
+
+
+def _is_serial_name(name):
+    return name.startswith(SERIAL_NAME_PREFIXES)
+
+
+def _inotify_watch(path, mask):
+    """Open a non-blocking inotify descriptor watching path; raises OSError if unsupported."""
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    if libc.inotify_add_watch(fd, path.encode(), mask) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, f"inotify_add_watch({path}) failed")
+    return fd
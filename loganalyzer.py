@@ -0,0 +1,390 @@
+"""Per-command latency, throughput and error analysis of the SecureWallet logs.
+
+    python loganalyzer.py                       # every log in logs/, rotated and gzipped ones included
+    python loganalyzer.py logs/securewalletOpr.log* --window 300
+    python loganalyzer.py /var/log/securewallet --json
+
+Files are read line by line (gzip-compressed ones decompressed on the fly)
+and each is analysed in its own worker process. Two kinds of timing are
+reconstructed: device commands, from a "Sent: <COMMAND>" line to the
+"Received ..." or "Failed to ..." line of the helper that sent it, and
+server commands, from "Received message from server" to "Command '<name>'
+executed" (or the line reporting its timeout or error). Lines are paired
+first in, first out per command, as the commands are served. Latencies are
+kept in fixed log-scale buckets, so memory grows with the number of time
+windows reported, not with the size of the logs.
+
+logs/error.log only repeats the ERROR records of the other logs, so it is
+skipped unless named explicitly.
+"""
+import argparse
+import collections
+import concurrent.futures
+import functools
+import glob
+import gzip
+import json
+import math
+import os
+import re
+import sys
+import time
+
+LOG_DIR = "logs"
+# Default --window, in seconds
+WINDOW = 60
+# Errors closer together than BURST_GAP seconds belong to one burst; bursts of fewer than BURST_MIN are not reported
+BURST_GAP = 10
+BURST_MIN = 5
+# Unanswered sends remembered per command; older ones are assumed lost
+MAX_OUTSTANDING = 1024
+# Seconds after which an unanswered send is no longer paired: longer than any command timeout
+MAX_PAIRING_AGE = 120
+# Logged once per process start; sends still unanswered at a restart never will be
+STARTUP_MESSAGE = "Logger initialized successfully."
+# Ratio between latency bucket bounds: percentiles are accurate to about 10%
+BUCKET_BASE = 1.1
+
+LINE_PATTERN = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - \S+ - (\w+) - (.*)$")
+# Device helper messages that end a device command: prefix -> (command, answered)
+DEVICE_OUTCOMES = {
+    "Received NFT request response": ("GET_NFT_REQ", True),
+    "Received NFT auth response": ("GET_NFT_AUTH", True),
+    "Received NFT request sign response": ("SIGN_MSG_REQ", True),
+    "Received NFT auth sign response": ("SIGN_MSG_AUTH", True),
+    "Received NFT request set response": ("SET_NFT_REQ", True),
+    "Received NFT auth set response": ("SET_NFT_AUTH", True),
+    "Received NFT request remove response": ("REMOVE_NFT_REQ", True),
+    "Received NFT auth remove response": ("REMOVE_NFT_AUTH", True),
+    "Received request address": ("GET_ADDR_REQ", True),
+    "Received auth address": ("GET_ADDR_AUTH", True),
+    "Authentication successful": ("PASS", True),
+    "Logged out successfully": ("LOGOUT", True),
+    "Failed to get NFT request response": ("GET_NFT_REQ", False),
+    "Failed to get NFT auth response": ("GET_NFT_AUTH", False),
+    "Failed to sign NFT request response": ("SIGN_MSG_REQ", False),
+    "Failed to sign NFT auth response": ("SIGN_MSG_AUTH", False),
+    "Failed to set NFT request response": ("SET_NFT_REQ", False),
+    "Failed to set NFT auth response": ("SET_NFT_AUTH", False),
+    "Failed to remove NFT request response": ("REMOVE_NFT_REQ", False),
+    "Failed to remove NFT auth response": ("REMOVE_NFT_AUTH", False),
+    "Failed to get request address": ("GET_ADDR_REQ", False),
+    "Failed to get auth address": ("GET_ADDR_AUTH", False),
+    "Authentication failed": ("PASS", False),
+    "Logout failed": ("LOGOUT", False),
+}
+# Server command outcomes: pattern -> outcome ("ok", "timeout" or "error")
+SERVER_OUTCOMES = (
+    (re.compile(r"^Command '(\S+)' executed\."), "ok"),
+    (re.compile(r"^Command '(\S+)' served from cache\."), "ok"),
+    (re.compile(r"^Command '(\S+)' timed out waiting for "), "timeout"),
+    (re.compile(r"^Error executing command '(\S+)'"), "error"),
+    (re.compile(r"^Rejected command '(\S+)'"), "error"),
+    (re.compile(r"^Dropped command '(\S+)'"), "timeout"),
+    (re.compile(r"^Invalid command received: (\S+)"), "error"),
+)
+SERVER_REQUEST = re.compile(r"^(?:Received message from server: |Received binary request: )(.*)$")
+
+
+@functools.lru_cache(maxsize=4096)
+def _epoch(second):
+    return time.mktime(time.strptime(second, "%Y-%m-%d %H:%M:%S"))
+
+
+def _bucket(seconds):
+    ms = seconds * 1000
+    return 0 if ms < 1 else 1 + int(math.log(ms, BUCKET_BASE))
+
+
+def _bucket_bound(bucket):
+    """Upper bound, in ms, of a latency bucket."""
+    return 1.0 if bucket == 0 else BUCKET_BASE ** bucket
+
+
+class CommandStats:
+    """Outcome counts and a latency histogram for one command (or one window)."""
+
+    def __init__(self):
+        self.count = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = collections.Counter()
+
+    def add(self, latency, outcome):
+        self.count += 1
+        if outcome == "timeout":
+            self.timeouts += 1
+        elif outcome == "error":
+            self.errors += 1
+        if latency is not None:
+            self.total += latency
+            self.max = max(self.max, latency)
+            self.buckets[_bucket(latency)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.timeouts += other.timeouts
+        self.errors += other.errors
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets.update(other.buckets)
+        return self
+
+    def percentile(self, q):
+        timed = sum(self.buckets.values())
+        if not timed:
+            return None
+        rank = q * timed
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return round(min(_bucket_bound(bucket), self.max * 1000), 2)
+        return round(self.max * 1000, 2)
+
+    def summary(self):
+        timed = sum(self.buckets.values())
+        return {
+            "count": self.count,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "mean_ms": round(self.total / timed * 1000, 2) if timed else None,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max * 1000, 2) if timed else None,
+        }
+
+
+class LogAnalysis:
+    """Everything reconstructed from one or more log files; analyses of several files merge."""
+
+    def __init__(self, window):
+        self.window = window
+        self.lines = 0
+        self.first = None
+        self.last = None
+        # (level, command) -> CommandStats, level being "server" or "device"
+        self.commands = collections.defaultdict(CommandStats)
+        # (window start, level) -> CommandStats
+        self.windows = collections.defaultdict(CommandStats)
+        # [start, end, count] runs of ERROR records, chained while less than BURST_GAP apart
+        self.error_runs = []
+
+    def record(self, level, command, when, latency, outcome):
+        self.commands[(level, command)].add(latency, outcome)
+        self.windows[(when - when % self.window, level)].add(latency, outcome)
+
+    def error(self, when):
+        if self.error_runs and when - self.error_runs[-1][1] <= BURST_GAP:
+            self.error_runs[-1][1] = when
+            self.error_runs[-1][2] += 1
+        else:
+            self.error_runs.append([when, when, 1])
+
+    def merge(self, other):
+        self.lines += other.lines
+        self.first = min(filter(None, (self.first, other.first)), default=None)
+        self.last = max(filter(None, (self.last, other.last)), default=None)
+        for key, stats in other.commands.items():
+            self.commands[key].merge(stats)
+        for key, stats in other.windows.items():
+            self.windows[key].merge(stats)
+        self.error_runs.extend(other.error_runs)
+        return self
+
+    def bursts(self):
+        """Error runs from every file, joined across file boundaries, of at least BURST_MIN errors."""
+        joined = []
+        for start, end, count in sorted(self.error_runs):
+            if joined and start - joined[-1][1] <= BURST_GAP:
+                joined[-1][1] = max(joined[-1][1], end)
+                joined[-1][2] += count
+            else:
+                joined.append([start, end, count])
+        return [run for run in joined if run[2] >= BURST_MIN]
+
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+def analyze_file(path, window=WINDOW):
+    """Stream one log file and return its LogAnalysis."""
+    analysis = LogAnalysis(window)
+    device_sent = collections.defaultdict(lambda: collections.deque(maxlen=MAX_OUTSTANDING))
+    server_received = collections.defaultdict(lambda: collections.deque(maxlen=MAX_OUTSTANDING))
+    with open_log(path) as log_file:
+        for line in log_file:
+            match = LINE_PATTERN.match(line)
+            if not match:
+                continue
+            second, millis, level, message = match.groups()
+            when = _epoch(second) + int(millis) / 1000
+            analysis.lines += 1
+            if analysis.first is None:
+                analysis.first = when
+            analysis.last = when
+            if level in ("ERROR", "CRITICAL"):
+                analysis.error(when)
+
+            if message == STARTUP_MESSAGE:
+                device_sent.clear()
+                server_received.clear()
+                continue
+            if message.startswith("Sent: "):
+                words = message[6:].split(" ", 2)
+                name = words[1] if words[0].startswith("#") and len(words) > 1 else words[0]
+                device_sent[name].append(when)
+                continue
+            request = SERVER_REQUEST.match(message)
+            if request:
+                words = [word for word in request.group(1).split() if not word.startswith(("#", "@"))]
+                if words:
+                    server_received[words[0]].append(when)
+                continue
+            outcome = _device_outcome(message)
+            if outcome:
+                name, answered = outcome
+                sent = _pair(device_sent[name], when)
+                analysis.record("device", name, when, when - sent if sent is not None else None,
+                                "ok" if answered else "error")
+                continue
+            for pattern, result in SERVER_OUTCOMES:
+                found = pattern.match(message)
+                if found:
+                    name = found.group(1)
+                    received = _pair(server_received[name], when)
+                    analysis.record("server", name, when, when - received if received is not None else None, result)
+                    break
+    return analysis
+
+
+def _pair(outstanding, when):
+    """Take the oldest unanswered start time still young enough to pair with an outcome at when."""
+    while outstanding:
+        started = outstanding.popleft()
+        if when - started <= MAX_PAIRING_AGE:
+            return started
+    return None
+
+
+def _device_outcome(message):
+    for prefix, outcome in DEVICE_OUTCOMES.items():
+        if message.startswith(prefix):
+            return outcome
+    return None
+
+
+def find_logs(paths):
+    """Expand files and directories into log files; directories skip error.log, which duplicates the others."""
+    files = []
+    for path in paths or [LOG_DIR]:
+        if os.path.isdir(path):
+            files.extend(candidate for candidate in sorted(glob.glob(os.path.join(path, "*.log*")))
+                         if not os.path.basename(candidate).startswith("error.log"))
+        else:
+            files.extend(sorted(glob.glob(path)) or [path])
+    return [path for path in files if os.path.isfile(path)]
+
+
+def analyze(paths, window=WINDOW, workers=None):
+    """Analyse every file, in parallel processes when there are several, and merge the results."""
+    analysis = LogAnalysis(window)
+    workers = workers or os.cpu_count() or 1
+    if len(paths) > 1 and workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+            for result in executor.map(analyze_file, paths, [window] * len(paths)):
+                analysis.merge(result)
+    else:
+        for path in paths:
+            analysis.merge(analyze_file(path, window))
+    return analysis
+
+
+def _timestamp(when):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when))
+
+
+def report(analysis):
+    windows = []
+    for (start, level), stats in sorted(analysis.windows.items()):
+        row = {"start": _timestamp(start), "level": level, **stats.summary()}
+        row["throughput_cmd_s"] = round(stats.count / analysis.window, 3)
+        windows.append(row)
+    return {
+        "lines": analysis.lines,
+        "first": _timestamp(analysis.first) if analysis.first else None,
+        "last": _timestamp(analysis.last) if analysis.last else None,
+        "window_s": analysis.window,
+        "commands": [
+            {"level": level, "command": command, **stats.summary()}
+            for (level, command), stats in sorted(analysis.commands.items())
+        ],
+        "windows": windows,
+        "error_bursts": [
+            {"start": _timestamp(start), "end": _timestamp(end), "errors": count}
+            for start, end, count in analysis.bursts()
+        ],
+    }
+
+
+def _cell(value):
+    return "-" if value is None else value
+
+
+def print_report(summary):
+    print(f"{summary['lines']} log lines from {summary['first']} to {summary['last']}")
+    print()
+    print(f"{'level':<7}{'command':<20}{'count':>8}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}{'max ms':>11}"
+          f"{'timeouts':>10}{'errors':>8}")
+    for row in summary["commands"]:
+        print(f"{row['level']:<7}{row['command']:<20}{row['count']:>8}{_cell(row['p50_ms']):>11}"
+              f"{_cell(row['p95_ms']):>11}{_cell(row['p99_ms']):>11}{_cell(row['max_ms']):>11}"
+              f"{row['timeouts']:>10}{row['errors']:>8}")
+    print()
+    print(f"Per {summary['window_s']} s window:")
+    print(f"{'start':<21}{'level':<8}{'count':>8}{'cmd/s':>9}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}"
+          f"{'timeouts':>10}{'errors':>8}")
+    for row in summary["windows"]:
+        print(f"{row['start']:<21}{row['level']:<8}{row['count']:>8}{row['throughput_cmd_s']:>9}"
+              f"{_cell(row['p50_ms']):>11}{_cell(row['p95_ms']):>11}{_cell(row['p99_ms']):>11}"
+              f"{row['timeouts']:>10}{row['errors']:>8}")
+    print()
+    if summary["error_bursts"]:
+        print(f"Error bursts ({BURST_MIN}+ errors less than {BURST_GAP} s apart):")
+        for burst in summary["error_bursts"]:
+            print(f"  {burst['start']} to {burst['end']}: {burst['errors']} errors")
+    else:
+        print("No error bursts.")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Summarise command latency and errors from the SecureWallet logs.")
+    parser.add_argument("paths", nargs="*", help=f"log files, globs or directories (default: {LOG_DIR}/)")
+    parser.add_argument("--window", type=int, default=WINDOW, help=f"seconds per report window (default: {WINDOW})")
+    parser.add_argument("--workers", type=int, default=None, help="processes reading files in parallel (default: one per CPU)")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    paths = find_logs(args.paths)
+    if not paths:
+        raise SystemExit("No log files found.")
+    summary = report(analyze(paths, args.window, args.workers))
+    if args.json:
+        json.dump(summary, sys.stdout)
+        print()
+    else:
+        print_report(summary)
+    return summary
+
+
+if __name__ == "__main__":
+    main()
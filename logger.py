@@ -1,18 +1,118 @@
+import atexit
 import logging
 import logging.handlers
 import os
+import queue
+import sys
 
-def setup_logger(log_file="logs/application.log", log_level=logging.DEBUG):
+# Write log records from a background thread so callers never wait on disk or console I/O
+ASYNC_LOGGING = True
+# Records buffered for the background writer
+LOG_QUEUE_SIZE = 10000
+# Queue fill levels above which DEBUG, then INFO, records are shed
+DROP_DEBUG_THRESHOLD = 0.8
+DROP_INFO_THRESHOLD = 0.95
+# Name prefix of the wallet worker processes started by workers.py
+WORKER_PROCESS_PREFIX = "WalletWorker-"
+
+# The handler holding this process's records for forward_records(), once there is one
+_forwarding_handler = None
+# The background writer of this process's records, when async logging set one up
+_listener = None
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the caller.
+
+    As the queue fills, DEBUG records are dropped first, then INFO; WARNING and
+    above only when the queue is completely full. A summary of how many records
+    were dropped is logged once the backlog has drained.
+    """
+
+    def __init__(self, maxsize=None):
+        maxsize = maxsize or LOG_QUEUE_SIZE
+        super().__init__(queue.Queue(maxsize))
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._reported = 0
+
+    def _should_drop(self, record):
+        depth = self.queue.qsize()
+        if record.levelno <= logging.DEBUG:
+            return depth >= self.maxsize * DROP_DEBUG_THRESHOLD
+        if record.levelno <= logging.INFO:
+            return depth >= self.maxsize * DROP_INFO_THRESHOLD
+        return False
+
+    def emit(self, record):
+        # Decide before prepare() so shed records cost no formatting
+        if self._should_drop(record):
+            self.dropped += 1
+            return
+        self._report_drops()
+        super().emit(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _report_drops(self):
+        if self.dropped == self._reported or self.queue.qsize() >= self.maxsize // 2:
+            return
+        count, self._reported = self.dropped - self._reported, self.dropped
+        self.enqueue(logging.makeLogRecord({
+            "name": "SecureWalletLogger",
+            "levelno": logging.WARNING,
+            "levelname": "WARNING",
+            "msg": f"Dropped {count} log records while the log writer was behind.",
+        }))
+
+
+def _starting_wallet_worker():
+    # A spawned process gets its name before it imports anything, so the modules a wallet worker
+    # loads (and the front's main module, loaded again) do not open the log files before
+    # workers._worker_main calls forward_records(). multiprocessing is always loaded in a
+    # process it started, and is not imported here for anyone else.
+    multiprocessing = sys.modules.get("multiprocessing")
+    return multiprocessing is not None and multiprocessing.current_process().name.startswith(WORKER_PROCESS_PREFIX)
+
+
+def forward_records():
+    """Queue this process's records for another process to write, and return the queue.
+
+    workers._worker_main calls this so that only the front process writes and
+    rotates the log files; records already held since start-up stay queued.
+    """
+    global _forwarding_handler, _listener
+    logger = logging.getLogger("SecureWalletLogger")
+    if _forwarding_handler is None:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        if _listener is not None:
+            atexit.unregister(_listener.stop)
+            _listener.stop()
+            _listener = None
+        _forwarding_handler = BoundedQueueHandler()
+        logger.addHandler(_forwarding_handler)
+    return _forwarding_handler.queue
+
+
+def setup_logger(log_file="logs/application.log", log_level=logging.DEBUG, async_logging=None):
     """
     Set up a sophisticated logging system with console and file handlers.
 
     Args:
         log_file (str): Path to the log file.
         log_level (int): Logging level (e.g., logging.DEBUG, logging.INFO).
+        async_logging (bool): Hand records to a background writer thread through a
+            bounded queue instead of writing on the caller's thread. Defaults to ASYNC_LOGGING.
 
     Returns:
         logging.Logger: Configured logger instance.
     """
+    global _listener
     # Create a logger
     logger = logging.getLogger("SecureWalletLogger")
     logger.setLevel(log_level)
@@ -21,6 +121,10 @@ def setup_logger(log_file="logs/application.log", log_level=logging.DEBUG):
     if logger.hasHandlers():
         return logger
 
+    if _starting_wallet_worker():
+        forward_records()
+        return logger
+
     # Create a formatter for consistent log messages
     formatter = logging.Formatter(
         "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -52,6 +156,20 @@ def setup_logger(log_file="logs/application.log", log_level=logging.DEBUG):
     except (OSError, IOError) as e:
         logger.error(f"Failed to set up error file handler: {e}")
 
+    if async_logging is None:
+        async_logging = ASYNC_LOGGING
+    if async_logging:
+        # Move the handlers behind a queue served by a background writer thread
+        handlers = list(logger.handlers)
+        for handler in handlers:
+            logger.removeHandler(handler)
+        queue_handler = BoundedQueueHandler()
+        _listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        # Drain whatever is still queued before the handlers are closed at exit
+        atexit.register(_listener.stop)
+        logger.addHandler(queue_handler)
+
     logger.info("Logger initialized successfully.")
 
     return logger
\ No newline at end of file
@@ -0,0 +1,159 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+
+# Samples kept per (command, stage) for percentile estimates
+WINDOW_SIZE = 2048
+QUANTILES = (0.5, 0.95, 0.99)
+METRICS_PREFIX = "securewallet"
+
+
+class Histogram:
+    """Latency samples over a rolling window plus lifetime count and sum."""
+
+    def __init__(self, window=WINDOW_SIZE):
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def quantiles(self, quantiles=QUANTILES):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {q: None for q in quantiles}
+        return {q: ordered[min(int(q * len(ordered)), len(ordered) - 1)] for q in quantiles}
+
+
+class Metrics:
+    """Per-command latency histograms by stage, outcome counters and in-flight gauges.
+
+    Stages recorded across the client: "dispatch" (message parsed until device
+    work starts), "serial_write", "device" (command written until its reply
+    line is complete: firmware think time plus the serial read), "serial_read"
+    (first byte until end of a reply line), "socket_write", "total"
+    (message received until its reply is sent) and "heartbeat" (round trip
+    of a liveness check).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = collections.defaultdict(Histogram)
+        self._counters = collections.Counter()
+        self._in_flight = collections.Counter()
+        self.started = time.time()
+
+    def observe(self, command, stage, seconds):
+        with self._lock:
+            self._histograms[(command, stage)].observe(seconds)
+
+    def increment(self, name, command, amount=1):
+        with self._lock:
+            self._counters[(name, command)] += amount
+
+    @contextlib.contextmanager
+    def timer(self, command, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(command, stage, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def in_flight(self, command):
+        with self._lock:
+            self._in_flight[command] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight[command] -= 1
+
+    def snapshot(self):
+        """Return all metrics as plain data: latencies in milliseconds."""
+        with self._lock:
+            histograms = {key: (hist.count, hist.total, hist.quantiles()) for key, hist in self._histograms.items()}
+            counters = dict(self._counters)
+            in_flight = {command: value for command, value in self._in_flight.items() if value}
+
+        latency = collections.defaultdict(dict)
+        for (command, stage), (count, total, quantiles) in sorted(histograms.items()):
+            latency[command][stage] = {
+                "count": count,
+                "avg_ms": round(total / count * 1000, 2) if count else None,
+                **{f"p{int(q * 100)}_ms": None if value is None else round(value * 1000, 2) for q, value in quantiles.items()},
+            }
+        totals = collections.defaultdict(dict)
+        for (name, command), value in sorted(counters.items()):
+            totals[name][command] = value
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "latency": dict(latency),
+            "counters": dict(totals),
+            "in_flight": in_flight,
+        }
+
+    def render_json(self):
+        return json.dumps(self.snapshot(), separators=(",", ":"))
+
+    def render_prometheus(self):
+        """Render the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = {key: (hist.count, hist.total, hist.quantiles()) for key, hist in self._histograms.items()}
+            counters = dict(self._counters)
+            in_flight = dict(self._in_flight)
+
+        lines = [f"# TYPE {METRICS_PREFIX}_command_seconds summary"]
+        for (command, stage), (count, total, quantiles) in sorted(histograms.items()):
+            labels = f'command="{command}",stage="{stage}"'
+            for q, value in quantiles.items():
+                if value is not None:
+                    lines.append(f'{METRICS_PREFIX}_command_seconds{{{labels},quantile="{q}"}} {value:.6f}')
+            lines.append(f"{METRICS_PREFIX}_command_seconds_sum{{{labels}}} {total:.6f}")
+            lines.append(f"{METRICS_PREFIX}_command_seconds_count{{{labels}}} {count}")
+
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name}_total counter")
+            for (counter, command), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f'{METRICS_PREFIX}_{name}_total{{command="{command}"}} {value}')
+
+        lines.append(f"# TYPE {METRICS_PREFIX}_in_flight gauge")
+        for command, value in sorted(in_flight.items()):
+            lines.append(f'{METRICS_PREFIX}_in_flight{{command="{command}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry used by command.py and connServer.py
+METRICS = Metrics()
+
+
+def start_http_server(port, host="127.0.0.1"):
+    """Serve /metrics in Prometheus text format on a daemon thread; returns the server."""
+    # http.server (and the email package behind it) is only paid for when metrics are exported
+    import http.server
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("", "/metrics"):
+                self.send_error(404)
+                return
+            body = METRICS.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes would otherwise flood stderr
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="MetricsHTTP", daemon=True).start()
+    return server
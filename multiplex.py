@@ -0,0 +1,207 @@
+import collections
+import concurrent.futures
+import itertools
+import threading
+import time
+from command import COMMAND_TIMEOUT, PIPELINE_WINDOW, command_name
+from logger import setup_logger
+from metrics import METRICS
+
+logger = setup_logger(log_file="logs/securewalletOpr.log", log_level="DEBUG")
+
+# Priority classes, most urgent first
+INTERACTIVE = "interactive"
+NORMAL = "normal"
+BULK = "bulk"
+PRIORITY_CLASSES = (INTERACTIVE, NORMAL, BULK)
+# Cheap, latency-sensitive device commands; anything not listed is NORMAL
+COMMAND_PRIORITIES = {
+    "GET_STATUS": INTERACTIVE,
+    "PING": INTERACTIVE,
+    "PASS": INTERACTIVE,
+    "LOGOUT": INTERACTIVE,
+    "GET_ADDR_REQ": INTERACTIVE,
+    "GET_ADDR_AUTH": INTERACTIVE,
+    "GET_NFT_REQ": INTERACTIVE,
+    "GET_NFT_AUTH": INTERACTIVE,
+    "SIGN_MSG_REQ": BULK,
+    "SIGN_MSG_AUTH": BULK,
+}
+# Jobs a class may have queued before new ones are refused with SchedulerBusy
+QUEUE_LIMITS = {INTERACTIVE: 64, NORMAL: 256, BULK: 1024}
+# Seconds a job may wait in the queue before it is dropped as stale
+MAX_QUEUE_WAIT = {INTERACTIVE: 2, NORMAL: 10, BULK: 30}
+# Requests one channel may hand to the scheduler at once (AsyncESP32Device sizes itself by
+# this), so queued work from a single session can still be reordered by priority
+CHANNEL_DEPTH = 16
+
+
+class SchedulerBusy(Exception):
+    """The queue for this priority class is full; the caller should back off."""
+
+
+class RequestExpired(Exception):
+    """The request waited longer than its class allows and was never sent."""
+
+
+def command_priority(command):
+    return COMMAND_PRIORITIES.get(command_name(command), NORMAL)
+
+
+class FairScheduler:
+    """The single queue in front of one wallet (or DevicePool), shared by every user of it.
+
+    Server sessions and the heartbeat each talk to the wallet through their
+    own Channel. Jobs are queued by priority class: an interactive read or
+    health check always goes before queued signing work, so its latency stays
+    flat however deep the signing backlog is. Within a class the channels are
+    served round-robin, so one session's flood cannot starve the others.
+
+    Each class has a queue limit (submit() raises SchedulerBusy beyond it) and
+    a maximum queue wait (jobs not started in time fail with RequestExpired
+    instead of reaching the wallet late). There are as many workers as the
+    device can keep busy.
+    """
+
+    def __init__(self, device, queue_limits=None, max_queue_wait=None):
+        self.device = device
+        self.queue_limits = queue_limits or QUEUE_LIMITS
+        self.max_queue_wait = max_queue_wait or MAX_QUEUE_WAIT
+        self._queues = {priority: collections.OrderedDict() for priority in PRIORITY_CLASSES}
+        self._depth = collections.Counter()
+        self._ready = threading.Condition()
+        self._closed = False
+        self._workers = [
+            threading.Thread(target=self._worker_loop, name=f"FairScheduler-{device.port}-{i}", daemon=True)
+            for i in range(device.concurrency)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def channel(self, name):
+        return Channel(self, name)
+
+    def submit(self, name, priority, func, *args, deadline=None):
+        """Queue func(*args) for channel name; returns a Future with a deadline attribute.
+
+        The job expires at the class's maximum queue wait, or at deadline (a
+        time.monotonic() value) if that comes first.
+        """
+        future = concurrent.futures.Future()
+        future.deadline = time.monotonic() + self.max_queue_wait[priority]
+        if deadline is not None:
+            future.deadline = min(future.deadline, deadline)
+        with self._ready:
+            if self._closed:
+                raise RuntimeError(f"Scheduler for {self.device.port} is closed")
+            if self._depth[priority] >= self.queue_limits[priority]:
+                METRICS.increment("rejected", priority)
+                raise SchedulerBusy(f"{priority} queue for {self.device.port} is full")
+            self._queues[priority].setdefault(name, collections.deque()).append((future, func, args))
+            self._depth[priority] += 1
+            self._ready.notify()
+        return future
+
+    def wait(self, future):
+        """Wait for a submitted job, expiring it if it is still queued at its deadline."""
+        try:
+            return future.result(max(0, future.deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            if future.cancel():
+                METRICS.increment("expired", "queued")
+                raise RequestExpired(f"Request for {self.device.port} expired in the queue") from None
+        # Already running on the wallet: its own timeout bounds it from here
+        return future.result()
+
+    def depth(self):
+        with self._ready:
+            return dict(self._depth)
+
+    def _next_job(self):
+        # Caller holds self._ready. Highest class first; the channel served goes to the back of its rotation.
+        for priority in PRIORITY_CLASSES:
+            channels = self._queues[priority]
+            for name, queue in channels.items():
+                if queue:
+                    channels.move_to_end(name)
+                    self._depth[priority] -= 1
+                    return queue.popleft()
+        return None
+
+    def _worker_loop(self):
+        while True:
+            with self._ready:
+                while not self._closed and (job := self._next_job()) is None:
+                    self._ready.wait()
+                if self._closed:
+                    return
+            future, func, args = job
+            if time.monotonic() > future.deadline and future.cancel():
+                METRICS.increment("expired", "queued")
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def close(self):
+        with self._ready:
+            self._closed = True
+            pending = [job for channels in self._queues.values() for queue in channels.values() for job in queue]
+            for channels in self._queues.values():
+                channels.clear()
+            self._depth.clear()
+            self._ready.notify_all()
+        for future, _, _ in pending:
+            future.cancel()
+
+
+class Channel:
+    """One user's view of a scheduled device, with the request() interface of ESP32Device.
+
+    Replies cached for the device are shared by every channel (cache_owner),
+    so a state change made through one session invalidates them for all.
+    """
+
+    # Requests are queued here rather than submitted to the firmware directly
+    framed = False
+
+    def __init__(self, scheduler, name):
+        self.scheduler = scheduler
+        self.name = name
+        self.cache_owner = scheduler.device
+        self.port = f"{scheduler.device.port}/{name}"
+
+    @property
+    def concurrency(self):
+        return max(self.scheduler.device.concurrency, CHANNEL_DEPTH)
+
+    @property
+    def last_activity(self):
+        return self.scheduler.device.last_activity
+
+    def request(self, command, timeout=COMMAND_TIMEOUT, expect=None):
+        """Queue command; time spent waiting in the queue counts against timeout."""
+        expires = time.monotonic() + timeout
+
+        def send():
+            return self.scheduler.device.request(command, max(expires - time.monotonic(), 0), expect)
+
+        future = self.scheduler.submit(self.name, command_priority(command), send, deadline=expires)
+        return self.scheduler.wait(future)
+
+    def call(self, func, *args, priority=NORMAL):
+        """Queue func(device, *args) as one job, for exchanges that must run on the device itself."""
+        future = self.scheduler.submit(self.name, priority, func, self.scheduler.device, *args)
+        return self.scheduler.wait(future)
+
+    def request_many(self, commands, timeout=COMMAND_TIMEOUT, window=PIPELINE_WINDOW):
+        """Run a batch as BULK work, one window at a time, letting other work in between windows."""
+        commands = iter(commands)
+        responses = []
+        while batch := list(itertools.islice(commands, window)):
+            future = self.scheduler.submit(self.name, BULK, self.scheduler.device.request_many, batch, timeout, window)
+            responses.extend(self.scheduler.wait(future))
+        return responses
@@ -0,0 +1,181 @@
+import hashlib
+import os
+import random
+import threading
+import time
+import tty
+import zlib
+
+try:
+    import pty
+except ImportError:  # pragma: no cover - Windows has no pty module
+    pty = None
+
+STARTUP_BANNER = "Secure Wallet Starting"
+
+
+class VirtualESP32:
+    """A simulated SecureWallet speaking the ESP32 line protocol on a pseudo-terminal.
+
+    Open virtual.port with ESP32Device like a real wallet. Commands are served
+    one at a time, as the firmware does, each taking latency seconds (plus up to
+    jitter, with sign_latency for SIGN_MSG_*). With baud set, every reply is also
+    paced at the serial line rate so large payloads cost what they would on the
+    wire. Framed "#<seq>" mode is answered when supports_framing is True, and
+    "BAUD <rate>" (which then paces replies at the new rate) when supports_baud is.
+    Chunked NFT uploads are accepted when supports_chunked is True; max_line
+    rejects longer lines the way a firmware with a fixed line buffer would.
+    """
+
+    def __init__(self, password="password", latency=0.0, sign_latency=None, jitter=0.0,
+                 baud=None, supports_framing=True, supports_baud=True, supports_chunked=True,
+                 max_line=None, banner=True):
+        if pty is None:
+            raise RuntimeError("VirtualESP32 needs a POSIX pseudo-terminal")
+        self.password = password
+        self.latency = latency
+        self.sign_latency = latency if sign_latency is None else sign_latency
+        self.jitter = jitter
+        self.baud = baud
+        self.supports_framing = supports_framing
+        self.supports_baud = supports_baud
+        self.supports_chunked = supports_chunked
+        self.max_line = max_line
+        self.banner = banner
+        self.authenticated = False
+        self.commands_served = 0
+        self.nfts = {"REQ": "", "AUTH": ""}
+        # (slot, expected length, chunks received) while a chunked upload is open
+        self._upload = None
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="VirtualESP32", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _run(self):
+        if self.banner:
+            self._write(STARTUP_BANNER)
+        buffer = b""
+        while not self._stop.is_set():
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                line = line.decode(errors="replace").strip()
+                if line:
+                    self._serve(line)
+
+    def _serve(self, line):
+        tag = ""
+        if line.startswith("#") and self.supports_framing:
+            tag, _, line = line.partition(" ")
+            tag += " "
+        command, _, data = line.partition(" ")
+        if self.max_line and len(line) > self.max_line:
+            self._write(tag + "ERROR: Line too long")
+            return
+        delay = self.sign_latency if command.startswith("SIGN_MSG_") else self.latency
+        if delay or self.jitter:
+            time.sleep(delay + random.uniform(0, self.jitter))
+        self.commands_served += 1
+        self._write(tag + self._respond(command, data))
+        if command == "BAUD" and self.supports_baud and self.baud:
+            # The reply goes out at the old rate, everything after it at the new one
+            self.baud = int(data)
+
+    def _respond(self, command, data):
+        if command == "PASS":
+            self.authenticated = data == self.password
+            return "PASSWORD_OK" if self.authenticated else "FAIL"
+        if command == "PROTO":
+            return "OK" if self.supports_framing and data == "FRAMED" else "ERROR: Unknown command"
+        if command == "BAUD":
+            return "OK" if self.supports_baud and data.isdigit() else "ERROR: Unknown command"
+        if command in ("GET_STATUS", "PING"):
+            return "STATUS: READY" if self.authenticated else "STATUS: LOCKED"
+        if not self.authenticated:
+            return "ERROR: Not authenticated"
+        if command == "LOGOUT":
+            self.authenticated = False
+            return "Logged out"
+
+        if command.startswith("NFT_") and self.supports_chunked:
+            return self._upload_step(command, data)
+
+        slot = command.rsplit("_", 1)[-1]
+        if slot not in self.nfts:
+            return "ERROR: Unknown command"
+        if command.startswith("GET_ADDR_"):
+            return "0x" + _digest(self.password, slot)[:40]
+        if command.startswith("GET_NFT_"):
+            return self.nfts[slot] or "NO_NFT"
+        if command.startswith("SET_NFT_"):
+            self.nfts[slot] = data
+            return "NFT_SET"
+        if command.startswith("REMOVE_NFT_"):
+            self.nfts[slot] = ""
+            return "NFT_REMOVED"
+        if command.startswith("SIGN_MSG_"):
+            return _digest(self.password, slot, data)
+        return "ERROR: Unknown command"
+
+    def _upload_step(self, command, data):
+        if command == "NFT_BEGIN":
+            slot, _, length = data.partition(" ")
+            if slot not in self.nfts or not length.isdigit():
+                return "ERROR: Bad upload"
+            self._upload = (slot, int(length), [])
+            return "READY"
+        if self._upload is None:
+            return "ERROR: No upload in progress"
+        slot, length, chunks = self._upload
+        if command == "NFT_CHUNK":
+            offset, _, chunk = data.partition(" ")
+            received = sum(len(part) for part in chunks)
+            if offset != str(received):
+                return f"ERROR: Expected offset {received}"
+            chunks.append(chunk)
+            return f"ACK {received + len(chunk)}"
+        self._upload = None
+        if command == "NFT_ABORT":
+            return "ABORTED"
+        if command == "NFT_END":
+            nft = "".join(chunks)
+            if len(nft) != length or data != f"{slot} {zlib.crc32(nft.encode()):08x}":
+                return "ERROR: Checksum mismatch"
+            self.nfts[slot] = nft
+            return "NFT_SET"
+        return "ERROR: Unknown command"
+
+    def _write(self, line):
+        payload = (line + "\n").encode()
+        if self.baud:
+            # 10 bits per byte on an 8N1 UART
+            time.sleep(len(payload) * 10 / self.baud)
+        try:
+            os.write(self._master, payload)
+        except OSError:
+            pass
+
+
+def _digest(*parts):
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
@@ -0,0 +1,235 @@
+import atexit
+import random
+import socket
+import threading
+import time
+from command import ESP32Device, GetAuthAddr, GetReqAddr, authenticate_device, check_password, command_timeout, negotiate_target_baud
+from fingerprint import remember_wallet
+from heartbeat import HeartbeatMonitor
+from logger import setup_logger
+from multiplex import FairScheduler
+from util import ConnectSocketServer, wait_for_device
+
+logger = setup_logger(log_file="logs/connServer.log", log_level="DEBUG")
+
+# Reconnect delays: start almost immediately, double per failure, cap at BACKOFF_MAX seconds
+BACKOFF_INITIAL = 0.05
+BACKOFF_FACTOR = 2
+BACKOFF_MAX = 5
+# Seconds to wait for a freshly opened wallet to answer: opening the port toggles DTR, which reboots the ESP32
+BOOT_TIMEOUT = 10
+
+
+class Backoff:
+    """Exponential backoff with jitter between reconnect attempts."""
+
+    def __init__(self, initial=BACKOFF_INITIAL, factor=BACKOFF_FACTOR, maximum=BACKOFF_MAX):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.delay = initial
+
+    def wait(self, stop_event):
+        """Sleep for the current delay (or until stop_event is set) and grow it; False if stopped."""
+        delay = self.delay * random.uniform(0.5, 1.0)
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return not stop_event.wait(delay)
+
+    def reset(self):
+        self.delay = self.initial
+
+
+class SecretPassword:
+    """Wallet password kept in a mutable buffer that is zeroed when no longer needed.
+
+    reveal() necessarily creates a short-lived str for the PASS command; the
+    long-lived copy is the bytearray, which erase() overwrites in place. erase()
+    also runs at interpreter exit.
+    """
+
+    def __init__(self, password):
+        self._buf = bytearray(password.encode('utf-8'))
+        atexit.register(self.erase)
+
+    def reveal(self):
+        return self._buf.decode('utf-8')
+
+    def erase(self):
+        for i in range(len(self._buf)):
+            self._buf[i] = 0
+        self._buf.clear()
+
+
+class Supervisor:
+    """Keeps one wallet connected to the server, recovering from serial and socket failures.
+
+    The serial link is reopened as soon as the wallet reappears (hot-plug events
+    make that immediate), re-authenticated with the password held in memory, and
+    the address handshake is replayed on a fresh server connection. A wallet that
+    reboots in place is re-authenticated without dropping the server session.
+    Only a rejected password stops the supervisor.
+
+    Every server session (sessions of them, each reconnecting on its own) and
+    the heartbeat reach the wallet through one FairScheduler.
+    """
+
+    def __init__(self, password, remote_server, run_session, negotiate_framing=False, sessions=1,
+                 device_factory=ESP32Device):
+        self.password = password
+        self.remote_server = remote_server
+        self.run_session = run_session
+        self.negotiate_framing = negotiate_framing
+        self.sessions = sessions
+        # Opens the wallet on a port: ESP32Device, or workers.WorkerDevice to serve it from its own process
+        self.device_factory = device_factory
+        self._stop = threading.Event()
+        self._sockets = set()
+        self._sockets_lock = threading.Lock()
+        self._heartbeat = None
+
+    def stop(self):
+        self._stop.set()
+        self._interrupt_session()
+
+    def run(self):
+        backoff = Backoff()
+        try:
+            while not self._stop.is_set():
+                device = self._open_device(backoff)
+                if device is None:
+                    break
+                try:
+                    addresses = self._authenticate(device)
+                    if addresses is False:
+                        logger.error("Wallet rejected the password; stopping.")
+                        break
+                    if addresses is None:
+                        backoff.wait(self._stop)
+                        continue
+                    backoff.reset()
+                    self._serve(device, *addresses)
+                finally:
+                    self._close_device(device)
+                if not self._stop.is_set():
+                    logger.warning("Lost the wallet connection; reconnecting...")
+        finally:
+            self.password.erase()
+
+    def _open_device(self, backoff):
+        while not self._stop.is_set():
+            port = wait_for_device(self._stop)
+            if port is None:
+                return None
+            try:
+                device = self.device_factory(port)
+            except Exception:
+                # The port may appear before it can be opened; try again shortly
+                if not backoff.wait(self._stop):
+                    return None
+                continue
+            if self.negotiate_framing:
+                device.negotiate_framing()
+            return device
+        return None
+
+    def _authenticate(self, device):
+        """Returns the wallet's addresses, False if the password was rejected, None on a transient failure."""
+        # A PASS sent while the wallet is still booting would go unanswered
+        if not self._wait_until_ready(device):
+            logger.warning("Wallet did not answer after the port was opened.")
+            return None
+        accepted = check_password(device, self.password.reveal())
+        if accepted is None:
+            # Only an explicit FAIL means the password is wrong; no answer is worth another try
+            logger.warning("Wallet did not answer the password; retrying.")
+            return None
+        if not accepted:
+            return False
+        logger.info("Authentication successful.")
+        negotiate_target_baud(device)
+        requestPubAddr = GetReqAddr(device)
+        authpubAddr = GetAuthAddr(device)
+        if not requestPubAddr or not authpubAddr:
+            logger.warning("Could not read the wallet addresses.")
+            return None
+        remember_wallet(device.port, requestPubAddr, authpubAddr)
+        return requestPubAddr, authpubAddr
+
+    def _wait_until_ready(self, device):
+        """Poll GET_STATUS until the wallet answers; False if it stays silent for BOOT_TIMEOUT."""
+        deadline = time.monotonic() + BOOT_TIMEOUT
+        while not self._stop.is_set() and not device.closed and time.monotonic() < deadline:
+            if device.request("GET_STATUS", command_timeout("GET_STATUS")):
+                return True
+        return False
+
+    def _serve(self, device, requestPubAddr, authpubAddr):
+        device.add_reset_listener(lambda: self._on_device_reset(device))
+        # Sessions and heartbeats share one prioritised queue in front of the wallet
+        scheduler = FairScheduler(device)
+        self._heartbeat = HeartbeatMonitor(scheduler.channel("heartbeat"), on_down=device.close).start()
+        links = [
+            threading.Thread(
+                target=self._serve_link,
+                args=(scheduler.channel(f"session-{n}"), device, n, requestPubAddr, authpubAddr),
+                name=f"ServerSession-{n}",
+                daemon=True,
+            )
+            for n in range(self.sessions)
+        ]
+        for link in links:
+            link.start()
+        for link in links:
+            link.join()
+        scheduler.close()
+
+    def _serve_link(self, link_device, device, index, requestPubAddr, authpubAddr):
+        """Keep one server session up for as long as the wallet is; index spreads sessions over the backends."""
+        backoff = Backoff()
+        while not self._stop.is_set() and not device.closed:
+            client_socket = ConnectSocketServer(remote_server=self.remote_server, first=index)
+            if not client_socket:
+                backoff.wait(self._stop)
+                continue
+            backoff.reset()
+            with self._sockets_lock:
+                self._sockets.add(client_socket)
+            try:
+                self.run_session(client_socket, link_device, requestPubAddr, authpubAddr)
+            finally:
+                with self._sockets_lock:
+                    self._sockets.discard(client_socket)
+            if not device.closed and not self._stop.is_set():
+                logger.warning("Server connection lost; reconnecting...")
+                backoff.wait(self._stop)
+
+    def _on_device_reset(self, device):
+        # Runs on the device's reader thread, so anything that talks to the device is handed off
+        if device.closed:
+            self._interrupt_session()
+        elif not self._stop.is_set():
+            logger.warning("Wallet restarted; re-authenticating.")
+            threading.Thread(target=self._reauthenticate, args=(device,), name="WalletReauth", daemon=True).start()
+
+    def _reauthenticate(self, device):
+        if not authenticate_device(device, self.password.reveal()):
+            logger.error("Re-authentication failed; reconnecting the wallet.")
+            device.close()
+
+    def _interrupt_session(self):
+        with self._sockets_lock:
+            sockets = list(self._sockets)
+        for client_socket in sockets:
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _close_device(self, device):
+        if self._heartbeat is not None:
+            self._heartbeat.stop()
+            self._heartbeat = None
+        try:
+            device.close()
+        except Exception as e:
+            logger.error(f"Error closing the wallet connection: {e}")
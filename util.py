@@ -1,20 +1,38 @@
-import threading
 import serial
+import serial.tools.list_ports
 import time
-import sys
 import os
 import socket
 import logger
-from plyer import notification
+from fingerprint import identify_wallets
+from heartbeat import HeartbeatMonitor
+from hotplug import DeviceWatcher, POLL_INTERVAL
 
-
-serial_lock = threading.Lock()
-# ----- Configuration -----
-BAUD_RATE = 115200
-READ_TIMEOUT = 1
+# Desktop notifications; turned off in headless mode so plyer is never imported
+notifications_enabled = True
+# Seconds to wait for one backend to accept before failing over to the next
+CONNECT_TIMEOUT = 3
+# How often a wait for the wallet checks whether it has been told to stop
+STOP_CHECK_INTERVAL = 0.5
 
 Wallet_logger = logger.setup_logger("logs/securewallet.log", log_level="DEBUG")
 
+def set_notifications_enabled(enabled):
+    global notifications_enabled
+    notifications_enabled = enabled
+
+
+def notify(title, message, timeout=5):
+    """Show a desktop notification, importing plyer only on first use."""
+    if not notifications_enabled:
+        return
+    try:
+        from plyer import notification
+        notification.notify(title=title, message=message, timeout=timeout)
+    except Exception as e:
+        Wallet_logger.warning(f"Desktop notification failed: {e}")
+
+
 # ----- Serial Port Detection -----
 def list_serial_ports():
     """List available serial ports."""
@@ -22,114 +40,124 @@ def list_serial_ports():
     return ports
 
 
+def find_wallet_ports():
+    """Return every port holding a SecureWallet, known wallets first (see fingerprint.py)."""
+    return identify_wallets(list_serial_ports())
+
+
 def auto_select_port():
-    """Attempt to auto-select the ESP32 device by scanning port descriptions."""
-    ports = list_serial_ports()
-    # Look for common identifiers; adjust the filtering as needed
-    for port in ports:
-        if "USB" in port.description or "ESP32" in port.description or "CDC" in port.description:
-            return port.device
-    return None
+    """Attempt to auto-select the ESP32 device by its USB fingerprint."""
+    ports = find_wallet_ports()
+    return ports[0] if ports else None
 
-def check_wallet_online(port) -> bool:
-    #print(f"Checking if SecureWallet is online on port {port}...")
-    """Check if the SecureWallet device is online by sending a command."""
-    while True:
-        #print("Thread is running")
-        try:
-            with serial.Serial(port, BAUD_RATE, timeout=READ_TIMEOUT) as ser:
-                time.sleep(2)
-                if ser.in_waiting:
-                    line = ser.readline().decode(errors="replace").strip()
-                    if "Secure Wallet Starting" in line:
-                        Wallet_logger.info("Verified SecureWallet startup message.")
-                        notification.notify(
-                            title="SecureWallet",
-                            message="SecureWallet device is ready.",
-                            timeout=5
-                        )
-                        return True
-                    else:
-                        Wallet_logger.warning("SecureWallet is not online.")
-                        return False
-                else:
-                    Wallet_logger.warning("Device did not send the expected startup message.")
-                    return False
-        except Exception as e:
-            Wallet_logger.error(f"Error reading from port {port}: {e}")
-            return False
+def monitor_wallet_status(port, esp_device,socket):
+    """Monitor the secure wallet over its open connection and disconnect the user if it goes offline."""
+    def on_down():
+        Wallet_logger.error("Wallet offline for too long. Disconnecting user from the server.")
+        monitor.stop()
+        DisconnectSocketServer(socket)
+        esp_device.close()
 
-        time.sleep(2)
+    monitor = HeartbeatMonitor(esp_device, on_down=on_down)
+    monitor.run()
 
-wallet_busy = threading.Event()
 
-def monitor_wallet_status(port, esp_device,socket):
-    """Monitor the secure wallet status and handle authentication."""
-    consecutive_failures = 0
-    max_failures = 5
-    while True:
-        if not wallet_busy.is_set():  # Skip status checks if the wallet is busy
-            if check_wallet_online(port):
-                Wallet_logger.info("SecureWallet is online.")
-                consecutive_failures = 0
-                with serial_lock:
-                    esp_device.send_command("GET_STATUS")
-            else:
-                consecutive_failures += 1
-                Wallet_logger.warning(f"Failed to connect to SecureWallet. Attempt {consecutive_failures}/{max_failures}")
-                if consecutive_failures >= max_failures:
-                    Wallet_logger.error("Max failures reached. Exiting...")
-                    Wallet_logger.error("Wallet offline for too long. Disconnecting user from the server.")
-                    DisconnectSocketServer(socket)
-                    esp_device.close()
-                    sys.exit(1)
-        time.sleep(2)
-
-
-def wait_for_device():
-    """Loop until the SecureWallet device is detected and return its port."""
+def _wait_for_change(watcher, stop_event):
+    """Wait for a device event or POLL_INTERVAL, returning early once stop_event is set."""
+    deadline = time.monotonic() + POLL_INTERVAL
+    while (remaining := deadline - time.monotonic()) > 0:
+        if stop_event is not None and stop_event.is_set():
+            return
+        if watcher.wait_for_event(timeout=min(remaining, STOP_CHECK_INTERVAL)):
+            return
+
+
+def wait_for_device(stop_event=None):
+    """Wait until the SecureWallet device is detected and return its port; None once stop_event is set."""
     Wallet_logger.info("Waiting for SecureWallet device to be plugged in...")
-    while True:
-        port = auto_select_port()
-        if port:
-            Wallet_logger.info(f"Detected device on port: {port}")
-            notification.notify(
-                title="SecureWallet",
-                message="SecureWallet device detected. Please wait...",
-                timeout=5
-            )
-            return port
-        else:
-            time.sleep(2)
+    # Start watching before the first scan so a device plugged in meanwhile is not missed
+    with DeviceWatcher() as watcher:
+        while stop_event is None or not stop_event.is_set():
+            port = auto_select_port()
+            if port:
+                Wallet_logger.info(f"Detected device on port: {port}")
+                notify(
+                    title="SecureWallet",
+                    message="SecureWallet device detected. Please wait...",
+                    timeout=5
+                )
+                return port
+            _wait_for_change(watcher, stop_event)
+    return None
 
 
+def wait_for_devices(stop_event=None):
+    """Wait until at least one SecureWallet is detected and return the ports of all of them (None once stop_event is set)."""
+    Wallet_logger.info("Waiting for SecureWallet devices to be plugged in...")
+    with DeviceWatcher() as watcher:
+        while stop_event is None or not stop_event.is_set():
+            ports = find_wallet_ports()
+            if ports:
+                Wallet_logger.info(f"Detected {len(ports)} device(s) on ports: {', '.join(ports)}")
+                notify(
+                    title="SecureWallet",
+                    message=f"{len(ports)} SecureWallet device(s) detected. Please wait...",
+                    timeout=5
+                )
+                return ports
+            _wait_for_change(watcher, stop_event)
+    return None
 
-def ConnectSocketServer(remote_server):
-    try:
-        if not remote_server or not isinstance(remote_server, str):
-            raise ValueError("Invalid remote_server. It must be a non-empty string in 'host:port' format.")
 
-        parts = remote_server.split(":")
+
+def parse_endpoints(remote_server):
+    """Split "host:port[,host:port...]" into (host, port) pairs; raises ValueError if malformed."""
+    if not remote_server or not isinstance(remote_server, str):
+        raise ValueError("Invalid remote_server. It must be a non-empty string in 'host:port' format.")
+    endpoints = []
+    for endpoint in remote_server.split(","):
+        parts = endpoint.strip().split(":")
         if len(parts) != 2:
             raise ValueError("remote_server must be in 'host:port' format.")
-        
-        host, port = parts[0], int(parts[1])
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((host, port))
-        Wallet_logger.info(f"Connected to socket server at {remote_server}")
-        return sock
+        endpoints.append((parts[0], int(parts[1])))
+    return endpoints
+
+
+def ConnectSocketServer(remote_server, first=0):
+    """Connect to the first reachable backend in remote_server, a comma-separated endpoint list.
+
+    Endpoints are tried in order starting at index first (wrapping round), so
+    sessions given different values of first spread over the backends and each
+    fails over to the others. Returns None if none of them accepts.
+    """
+    try:
+        endpoints = parse_endpoints(remote_server)
     except ValueError as ve:
         Wallet_logger.error(f"Invalid remote_server format or value: {ve}")
         return None
-    except Exception as e:
-        Wallet_logger.error(f"Could not connect to the socket server: {e}")
-        return None
+
+    first %= len(endpoints)
+    for host, port in endpoints[first:] + endpoints[:first]:
+        try:
+            sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+            sock.settimeout(None)
+            Wallet_logger.info(f"Connected to socket server at {host}:{port}")
+            return sock
+        except Exception as e:
+            Wallet_logger.warning(f"Could not connect to the socket server at {host}:{port}: {e}")
+    Wallet_logger.error(f"Could not connect to any socket server in {remote_server}")
+    return None
 
 
 
 def DisconnectSocketServer(client_socket):
     try:
         if client_socket:
+            # shutdown() wakes a thread blocked reading the socket; close() alone may not
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             client_socket.close()
             Wallet_logger.info("Disconnected from socket server.")
         else:
@@ -0,0 +1,444 @@
+"""Wallets served from worker processes, over shared-memory request rings.
+
+In worker mode each wallet's ESP32Device, with its serial reader thread,
+lives in a process of its own, and the front process (server link, parsing,
+caching, reply framing) reaches it through a WorkerDevice, which has the same
+request() interface. Neither side's work then holds the other's GIL, so a
+burst of socket or logging work no longer delays serial reads.
+
+Requests and replies cross in two ShmRing queues per wallet: byte records in a
+multiprocessing.shared_memory block, with a semaphore counting the records
+waiting. Nothing is pickled after start-up. The worker's log records come back
+over the reply ring and are written by the front, so one process alone writes
+and rotates the log files.
+"""
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+import serial
+import command
+from command import COMMAND_TIMEOUT, PIPELINE_WINDOW, READ_TIMEOUT, command_name, invalidate_cache
+from logger import WORKER_PROCESS_PREFIX, forward_records, setup_logger
+from metrics import METRICS
+
+logger = setup_logger(log_file="logs/securewalletOpr.log", log_level="DEBUG")
+
+# Bytes of each ring's data area; one request or reply must fit
+RING_SIZE = 1024 * 1024
+# Seconds a producer sleeps between checks while a ring is full
+RING_FULL_WAIT = 0.0005
+# Seconds a ring consumer waits for a record before checking on the other process
+WORKER_POLL_INTERVAL = 0.5
+# Seconds a worker may take to start and open its serial port
+WORKER_START_TIMEOUT = 15
+# Seconds a worker may take to exit after being told to close, before it is terminated
+WORKER_STOP_TIMEOUT = 5
+# Seconds allowed on top of a command's timeout for the hop to the worker and back
+WORKER_REPLY_GRACE = 1.0
+# Commands of a request_many() sent to the worker in one message; it pipelines each slice in the caller's window
+BATCH_SLICE = 256
+# "fork" would copy the front's threads' locks in whatever state they happen to be
+WORKER_START_METHOD = "spawn"
+# command.py settings the worker's serial link depends on, copied into the freshly started worker
+WORKER_SETTINGS = (
+    "BAUD_RATE", "TARGET_BAUD_RATE", "READ_TIMEOUT", "INTER_BYTE_TIMEOUT", "LOW_LATENCY",
+    "RX_BUFFER_SIZE", "TX_BUFFER_SIZE", "FRAMED_CONCURRENCY", "STALE_REPLY_GRACE",
+)
+
+# Ring layout: head and tail byte counters, each on its own cache line, then the data area
+RING_HEADER_SIZE = 128
+TAIL_INDEX = 8
+RECORD_LENGTH = struct.Struct(">I")
+
+# Request: call id | op | timeout (s) | window; payload is the command line(s), newline separated
+REQUEST_HEADER = struct.Struct(">IBdI")
+OP_REQUEST = 1
+OP_REQUEST_EXPECT = 2
+OP_REQUEST_MANY = 3
+OP_NEGOTIATE_FRAMING = 4
+OP_CLOSE = 5
+OP_NEGOTIATE_BAUD = 6
+# Reply: call id | kind | device last_activity; for LOG the id is the level and the time the record's
+REPLY_HEADER = struct.Struct(">IBd")
+REPLY = 1
+READY = 2
+RESET = 3
+CLOSED = 4
+LOG = 5
+
+
+class ShmRing:
+    """Queue of byte records in a shared memory block, for one producing and one consuming process.
+
+    head and tail count the bytes ever written and read; each record is a u32
+    length and its bytes, wrapping at the end of the data area. The counters
+    are aligned native 64-bit words, each stored whole by its one writer, and
+    the semaphore's release/acquire orders a record's bytes before its use.
+    Threads of the producing process take turns through a lock.
+    """
+
+    def __init__(self, size=RING_SIZE, name=None, items=None, context=None):
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=RING_HEADER_SIZE + size)
+            self._owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        self.capacity = size
+        self._items = items if items is not None else (context or multiprocessing).Semaphore(0)
+        self._counters = self._shm.buf[:RING_HEADER_SIZE].cast("Q")
+        self._data = self._shm.buf[RING_HEADER_SIZE:RING_HEADER_SIZE + size]
+        self._put_lock = threading.Lock()
+
+    def __reduce__(self):
+        # Sent to the worker by name: it attaches to the same block and semaphore
+        return ShmRing, (self.capacity, self._shm.name, self._items)
+
+    def put(self, payload, timeout=None):
+        """Append a record; False if the ring stayed too full for it until timeout (None waits for good)."""
+        size = RECORD_LENGTH.size + len(payload)
+        if size > self.capacity:
+            raise ValueError(f"Record of {len(payload)} bytes does not fit a {self.capacity}-byte ring")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._put_lock:
+            head = self._counters[0]
+            while self.capacity - (head - self._counters[TAIL_INDEX]) < size:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+                time.sleep(RING_FULL_WAIT)
+            self._write(head, RECORD_LENGTH.pack(len(payload)))
+            self._write(head + RECORD_LENGTH.size, payload)
+            self._counters[0] = head + size
+        self._items.release()
+        return True
+
+    def get(self, timeout=None):
+        """Remove and return the oldest record, or None if none arrives within timeout."""
+        if not self._items.acquire(timeout=timeout):
+            return None
+        tail = self._counters[TAIL_INDEX]
+        (length,) = RECORD_LENGTH.unpack(self._read(tail, RECORD_LENGTH.size))
+        payload = self._read(tail + RECORD_LENGTH.size, length)
+        self._counters[TAIL_INDEX] = tail + RECORD_LENGTH.size + length
+        return payload
+
+    def _write(self, position, data):
+        offset = position % self.capacity
+        first = min(len(data), self.capacity - offset)
+        self._data[offset:offset + first] = data[:first]
+        if first < len(data):
+            self._data[:len(data) - first] = data[first:]
+
+    def _read(self, position, length):
+        offset = position % self.capacity
+        first = min(length, self.capacity - offset)
+        if first == length:
+            return bytes(self._data[offset:offset + length])
+        return bytes(self._data[offset:]) + bytes(self._data[:length - first])
+
+    def close(self):
+        """Detach from the block; the process that created it also removes it."""
+        self._counters.release()
+        self._data.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class WorkerDevice:
+    """An ESP32Device run in a worker process of its own, with the same request() interface.
+
+    The worker owns the serial port; this side forwards each request over the
+    request ring and waits for its reply, records the device metrics, and
+    relays the worker's reset and closed events to its own listeners.
+    """
+
+    def __init__(self, port, framed=False):
+        self.port = port
+        self.framed = framed
+        # Monotonic time the device last sent anything, as of the latest message from the worker
+        self.last_activity = time.monotonic()
+        self._closed = threading.Event()
+        self._shut_down = False
+        self._reset_listeners = []
+        self._calls = itertools.count(1)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._ready = concurrent.futures.Future()
+
+        context = multiprocessing.get_context(WORKER_START_METHOD)
+        self._requests = ShmRing(context=context)
+        self._replies = ShmRing(context=context)
+        settings = {name: getattr(command, name) for name in WORKER_SETTINGS}
+        self._process = context.Process(
+            target=_worker_main,
+            args=(port, framed, settings, logger.getEffectiveLevel(), self._requests, self._replies),
+            name=f"{WORKER_PROCESS_PREFIX}{port}",
+            daemon=True,
+        )
+        self._process.start()
+        self._dispatcher = threading.Thread(target=self._reply_loop, name=f"WorkerReplies-{port}", daemon=True)
+        self._dispatcher.start()
+
+        try:
+            error = self._ready.result(WORKER_START_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            error = f"worker did not start within {WORKER_START_TIMEOUT} s"
+        if error:
+            logger.error(f"Failed to open serial port {port} in a worker process: {error}")
+            self.close()
+            raise serial.SerialException(error)
+        logger.info(f"Serving {port} from worker process {self._process.pid}")
+
+    @property
+    def closed(self):
+        """True once the worker's serial link is gone, or the worker itself."""
+        return self._closed.is_set()
+
+    @property
+    def concurrency(self):
+        """How many commands this device can usefully have in flight at once."""
+        return command.FRAMED_CONCURRENCY if self.framed else 1
+
+    def add_reset_listener(self, callback):
+        """Call callback whenever the wallet reboots or the link to it goes away."""
+        self._reset_listeners.append(callback)
+
+    def request(self, command, timeout=COMMAND_TIMEOUT, expect=None):
+        """Send a command through the worker and return its reply, or "" if none arrives in time."""
+        name = command_name(command)
+        sent_at = time.perf_counter()
+        if expect is None:
+            call_id, future = self._call(OP_REQUEST, timeout, [command])
+        else:
+            call_id, future = self._call(OP_REQUEST_EXPECT, timeout, [command, *expect])
+        response = self._result(call_id, future, timeout + WORKER_REPLY_GRACE) or ""
+        if response:
+            METRICS.observe(name, "device", time.perf_counter() - sent_at)
+        else:
+            METRICS.increment("timeouts", name)
+        return response
+
+    def request_many(self, commands, timeout=COMMAND_TIMEOUT, window=PIPELINE_WINDOW):
+        """Send several commands through the worker, BATCH_SLICE at a time, and return their replies in order."""
+        commands = iter(commands)
+        responses = []
+        while batch := list(itertools.islice(commands, BATCH_SLICE)):
+            call_id, future = self._call(OP_REQUEST_MANY, timeout, batch, window)
+            payload = self._result(call_id, future, timeout * len(batch) + WORKER_REPLY_GRACE)
+            replies = payload.split("\n") if payload is not None else [""] * len(batch)
+            responses.extend(replies)
+            if "" in replies and not self.framed:
+                # As in ESP32Device: after a missing line-mode reply the rest cannot be attributed
+                responses.extend("" for _ in commands)
+                break
+        return responses
+
+    def negotiate_framing(self, timeout=READ_TIMEOUT):
+        """Switch the worker's link to framed mode if the firmware acknowledges it."""
+        call_id, future = self._call(OP_NEGOTIATE_FRAMING, timeout, [])
+        self.framed = self._result(call_id, future, timeout * 2 + WORKER_REPLY_GRACE) == "OK"
+        return self.framed
+
+    def negotiate_baud(self, rate, timeout=READ_TIMEOUT):
+        """Move the worker's link to a faster rate if the firmware agrees (see ESP32Device.negotiate_baud)."""
+        call_id, future = self._call(OP_NEGOTIATE_BAUD, timeout, [str(rate)])
+        return self._result(call_id, future, timeout * 2 + WORKER_REPLY_GRACE) == "OK"
+
+    def close(self):
+        if self._shut_down:
+            return
+        self._shut_down = True
+        if self._process.is_alive() and not self.closed:
+            try:
+                self._requests.put(REQUEST_HEADER.pack(0, OP_CLOSE, 0, 0), timeout=WORKER_POLL_INTERVAL)
+            except ValueError:
+                pass
+        self._process.join(WORKER_STOP_TIMEOUT)
+        if self._process.is_alive():
+            logger.warning(f"Worker for {self.port} did not exit; terminating it.")
+            self._process.terminate()
+            self._process.join(WORKER_STOP_TIMEOUT)
+        if threading.current_thread() is not self._dispatcher:
+            self._dispatcher.join(WORKER_POLL_INTERVAL * 2)
+        self._on_closed(None)
+        if not self._dispatcher.is_alive():
+            self._requests.close()
+            self._replies.close()
+
+    def _call(self, op, timeout, lines, window=0):
+        if self.closed:
+            raise serial.SerialException(f"Serial port {self.port} closed")
+        call_id = next(self._calls) % 0xFFFFFFFF + 1
+        future = concurrent.futures.Future()
+        with self._pending_lock:
+            self._pending[call_id] = future
+        message = REQUEST_HEADER.pack(call_id, op, max(timeout, 0), window) + "\n".join(lines).encode('utf-8')
+        try:
+            if not self._requests.put(message, timeout=max(timeout, WORKER_POLL_INTERVAL)):
+                raise serial.SerialException(f"Worker for {self.port} is not taking requests")
+        except Exception:
+            with self._pending_lock:
+                self._pending.pop(call_id, None)
+            raise
+        return call_id, future
+
+    def _result(self, call_id, future, timeout):
+        """The reply text, or None if the worker never answered (the request is then forgotten)."""
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            with self._pending_lock:
+                self._pending.pop(call_id, None)
+            return None
+
+    def _reply_loop(self):
+        """Route the worker's replies and events; runs until the worker closes or exits."""
+        while not self.closed:
+            message = self._replies.get(WORKER_POLL_INTERVAL)
+            if message is None:
+                if not self._process.is_alive():
+                    self._on_closed(f"worker exited with code {self._process.exitcode}")
+                continue
+            call_id, kind, stamp = REPLY_HEADER.unpack_from(message)
+            payload = message[REPLY_HEADER.size:].decode('utf-8', errors="replace")
+            if kind == LOG:
+                self._log(call_id, stamp, payload)
+                continue
+            self.last_activity = max(self.last_activity, stamp)
+            if kind == REPLY:
+                with self._pending_lock:
+                    future = self._pending.pop(call_id, None)
+                if future is not None:
+                    future.set_result(payload)
+            elif kind == READY:
+                self._ready.set_result(None)
+            elif kind == RESET:
+                self._notify_reset()
+            elif kind == CLOSED:
+                self._on_closed(payload or None)
+
+    def _log(self, levelno, created, message):
+        # Written here with the worker's timestamp, so the log reads as if one process wrote it
+        if logger.isEnabledFor(levelno):
+            logger.handle(logging.makeLogRecord({
+                "name": logger.name,
+                "levelno": levelno,
+                "levelname": logging.getLevelName(levelno),
+                "msg": message,
+                "created": created,
+                "msecs": created % 1 * 1000,
+                "processName": f"WalletWorker-{self.port}",
+            }))
+
+    def _on_closed(self, reason):
+        started = self._ready.done()
+        if not started:
+            # __init__ reports why the worker never got going
+            self._ready.set_result(reason or "worker closed before opening the port")
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if reason and started:
+            logger.error(f"Worker for {self.port} stopped: {reason}")
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_result(None)
+        self._notify_reset()
+
+    def _notify_reset(self):
+        # Runs on the reply thread: a listener that talks to the device must hand that off
+        invalidate_cache(self)
+        for callback in self._reset_listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Reset listener failed for {self.port}: {e}")
+
+
+def _worker_main(port, framed, settings, log_level, requests, replies):
+    """Entry point of a worker process: serve one wallet's requests until told to close."""
+    for name, value in settings.items():
+        setattr(command, name, value)
+    logger.setLevel(log_level)
+    # The front process writes the worker's records, so only one process writes the log files
+    log_queue = forward_records()
+    forwarder = threading.Thread(target=_forward_logs, args=(log_queue, replies), name="LogForwarder", daemon=True)
+    forwarder.start()
+
+    def send(kind, call_id=0, payload=b"", stamp=0.0):
+        replies.put(REPLY_HEADER.pack(call_id, kind, stamp) + payload)
+
+    try:
+        device = command.ESP32Device(port, framed)
+    except Exception as e:
+        _stop_forwarding(forwarder)
+        send(CLOSED, payload=str(e).encode('utf-8'))
+        requests.close()
+        replies.close()
+        return
+    # Closing also notifies reset listeners; the front learns of that from CLOSED instead
+    device.add_reset_listener(lambda: None if device.closed else send(RESET, stamp=device.last_activity))
+    send(READY, stamp=device.last_activity)
+
+    def serve(call_id, op, timeout, window, lines):
+        try:
+            if op == OP_REQUEST:
+                response = device.request(lines[0], timeout)
+            elif op == OP_REQUEST_EXPECT:
+                response = device.request(lines[0], timeout, tuple(lines[1:]))
+            elif op == OP_REQUEST_MANY:
+                response = "\n".join(device.request_many(lines, timeout, window))
+            elif op == OP_NEGOTIATE_FRAMING:
+                response = "OK" if device.negotiate_framing(timeout) else ""
+            elif op == OP_NEGOTIATE_BAUD:
+                response = "OK" if device.negotiate_baud(int(lines[0]), timeout) else ""
+            else:
+                logger.error(f"Unknown worker request {op} for {port}")
+                response = ""
+        except Exception as e:
+            logger.error(f"Worker request failed on {port}: {e}")
+            response = ""
+        send(REPLY, call_id, response.encode('utf-8'), device.last_activity)
+
+    parent = multiprocessing.parent_process()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=command.FRAMED_CONCURRENCY, thread_name_prefix="WorkerRequest")
+    try:
+        while not device.closed:
+            message = requests.get(WORKER_POLL_INTERVAL)
+            if message is None:
+                if parent is not None and not parent.is_alive():
+                    break
+                continue
+            call_id, op, timeout, window = REQUEST_HEADER.unpack_from(message)
+            if op == OP_CLOSE:
+                break
+            lines = message[REQUEST_HEADER.size:].decode('utf-8', errors="replace").split("\n")
+            executor.submit(serve, call_id, op, timeout, window, lines)
+    finally:
+        device.close()
+        executor.shutdown(wait=True, cancel_futures=True)
+        _stop_forwarding(forwarder)
+        send(CLOSED)
+        requests.close()
+        replies.close()
+
+
+def _forward_logs(log_queue, replies):
+    """Send the worker's log records to the front process over the reply ring until stopped."""
+    while (record := log_queue.get()) is not None:
+        # A record too long for the ring is cut short rather than lost
+        message = record.getMessage().encode('utf-8')[:replies.capacity // 2]
+        # Dropped, like a record the log queue sheds, rather than hold up the worker
+        replies.put(REPLY_HEADER.pack(record.levelno, LOG, record.created) + message, timeout=WORKER_POLL_INTERVAL)
+
+
+def _stop_forwarding(forwarder):
+    forward_records().put(None)
+    forwarder.join(WORKER_STOP_TIMEOUT)